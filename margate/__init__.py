@@ -2,10 +2,14 @@
 Compiled templates
 """
 
-import os.path
 from django.template import TemplateDoesNotExist
 from django.template.backends.base import BaseEngine
 
+# This must be kept in step with the version in setup.py. It is
+# recorded in bytecode cache entries, so that templates are
+# recompiled when Margate is upgraded.
+__version__ = '0.0.1'
+
 
 class Template:
     def __init__(self, code, engine):
@@ -26,12 +30,14 @@ class FasterEngine(BaseEngine):
 
         super(FasterEngine, self).__init__(params)
 
+        from .template_index import TemplateIndex
+        self.template_index = TemplateIndex(self.template_dirs)
+
     def get_template(self, template_name):
-        for template_dir in self.template_dirs:
-            candidate_file = os.path.join(template_dir, template_name)
-            if os.path.exists(candidate_file):
-                with open(candidate_file, "r") as template_contents:
-                    return Template(template_contents.read(), self)
+        candidate_file = self.template_index.find_template(template_name)
+        if candidate_file is not None:
+            with open(candidate_file, "r") as template_contents:
+                return Template(template_contents.read(), self)
         raise TemplateDoesNotExist("Template %s does not exist"
                                    % template_name)
 
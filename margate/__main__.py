@@ -0,0 +1,135 @@
+"""Command line interface to Margate.
+
+The ``compile`` command compiles every template in one or more
+template directories ahead of time, and writes the compiled templates
+into a directory in the :py:mod:`bytecode cache
+<margate.bytecode_cache>` format. The directory can be shipped as
+part of a deployment and configured as the bytecode cache of a
+:py:class:`~margate.django.MargateEngine`, so that templates are
+loaded without running the parser or the code generator at all::
+
+  python -m margate compile --output build/margate templates/
+
+The command prints the time taken to compile each template, reports
+any templates that fail to compile, and exits with a non-zero status
+if there were any failures.
+
+"""
+
+import sys
+import time
+import argparse
+
+from .compiler import Compiler, DirectoryTemplateLocator, find_templates
+from .bytecode_cache import BytecodeCache
+
+
+def compile_templates(directories, output, extensions=None,
+                      backend=None, output_strategy="list", optimise=True,
+                      autoescape=True):
+    """Compile all the templates in the directories into a bytecode
+    cache in the output directory.
+
+    :return: The number of templates that failed to compile.
+
+    """
+    cache = BytecodeCache(output)
+    compiler = Compiler(DirectoryTemplateLocator(directories),
+                        bytecode_cache=cache,
+                        backend=backend,
+                        output_strategy=output_strategy,
+                        optimise=optimise,
+                        autoescape=autoescape)
+    failures = 0
+    compiled = 0
+
+    for directory in directories:
+        for (name, path) in find_templates(directory, extensions):
+            start = time.perf_counter()
+
+            try:
+                with open(path) as template_file:
+                    source = template_file.read()
+
+                compiler.compile(source)
+
+                # Make sure the entry was actually written and can be
+                # read back, since the compiler ignores errors writing
+                # to the cache.
+                key = cache.get_key(source, compiler._get_configuration())
+                if cache.load(key) is None:
+                    raise OSError("Unable to write to %s" % output)
+            except Exception as e:
+                failures += 1
+                print("FAILED {name}: {error}".format(name=name,
+                                                      error=e),
+                      file=sys.stderr)
+            else:
+                compiled += 1
+                print("{name}: {time} ms".format(
+                    name=name,
+                    time=round((time.perf_counter() - start) * 1000, 2)))
+
+    print("Compiled {compiled} templates, {failures} failed".format(
+        compiled=compiled, failures=failures))
+
+    return failures
+
+
+def main(argv=None):
+    argument_parser = argparse.ArgumentParser(prog="margate")
+    subparsers = argument_parser.add_subparsers(dest="command")
+
+    compile_parser = subparsers.add_parser(
+        "compile",
+        help="Compile templates ahead of time")
+    compile_parser.add_argument(
+        "directories", nargs="+", metavar="DIR",
+        help="Template directories, searched in order when one "
+        "template extends another")
+    compile_parser.add_argument(
+        "-o", "--output", required=True,
+        help="Directory to write the compiled templates to")
+    compile_parser.add_argument(
+        "-e", "--extension", action="append", dest="extensions",
+        help="Only compile files with this extension (for example "
+        "'.html'). May be given more than once.")
+    compile_parser.add_argument(
+        "--backend", choices=["bytecode", "ast"],
+        help="The code generation backend. This must match the "
+        "backend used by the engine that loads the templates.")
+    compile_parser.add_argument(
+        "--output-strategy", choices=["list", "stringio", "bytes"],
+        default="list",
+        help="How templates accumulate their output. This must match "
+        "the output strategy used by the engine that loads the "
+        "templates.")
+    compile_parser.add_argument(
+        "--no-optimise", action="store_false", dest="optimise",
+        help="Don't optimise the templates. This must match the "
+        "optimise option of the engine that loads the templates.")
+    compile_parser.add_argument(
+        "--no-autoescape", action="store_false", dest="autoescape",
+        help="Don't escape the output of expressions for HTML. This "
+        "must match the autoescape option of the engine that loads "
+        "the templates.")
+
+    arguments = argument_parser.parse_args(argv)
+
+    if arguments.command != "compile":
+        argument_parser.print_help()
+        return 2
+
+    failures = compile_templates(arguments.directories,
+                                 arguments.output,
+                                 arguments.extensions,
+                                 arguments.backend,
+                                 arguments.output_strategy,
+                                 arguments.optimise,
+                                 arguments.autoescape)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
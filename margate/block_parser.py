@@ -11,6 +11,12 @@ It's implemented as a state machine, where the template starts out in
 literal text and transitions to a different state depending on whether
 it encounters ``{{``, ``}}``, ``{%`` or ``%}``.
 
+Every state holds a reference to the complete template source along
+with the offset at which the state begins, rather than a copy of the
+remaining text. The offsets passed to the ``accept_*`` methods are
+offsets into the complete source, so moving from one state to the
+next never copies the unprocessed tail of the template.
+
 """
 
 from . import code_generation
@@ -23,25 +29,26 @@ class LiteralState:
     transitions back into it every time a block is closed.
     """
 
-    def __init__(self, text):
+    def __init__(self, text, start=0):
         self.text = text
+        self.start = start
 
     def __eq__(self, other):
         if not isinstance(other, LiteralState):
             return False
 
-        return self.text == other.text
+        return self.text[self.start:] == other.text[other.start:]
 
     def __repr__(self):
-        return "<LiteralState %r>" % self.text
+        return "<LiteralState %r>" % self.text[self.start:]
 
     def accept_open_expression(self, offset, length):
-        return (ExpressionState(self.text[offset + length:]),
-                code_generation.Literal(self.text[:offset]))
+        return (ExpressionState(self.text, offset + length),
+                code_generation.Literal(self.text[self.start:offset]))
 
     def accept_open_execution(self, offset, length):
-        return (ExecutionState(self.text[offset + length:]),
-                code_generation.Literal(self.text[:offset]))
+        return (ExecutionState(self.text, offset + length),
+                code_generation.Literal(self.text[self.start:offset]))
 
     def accept_close_expression(self, offset, length):
         raise Exception("Syntax error")
@@ -50,7 +57,7 @@ class LiteralState:
         raise Exception("Syntax error")
 
     def accept_end_input(self):
-        return (None, code_generation.Literal(self.text))
+        return (None, code_generation.Literal(self.text[self.start:]))
 
 
 class ExecutionState:
@@ -58,8 +65,9 @@ class ExecutionState:
     occurring. This includes the start and ends of blocks.
     """
 
-    def __init__(self, text):
+    def __init__(self, text, start=0):
         self.text = text
+        self.start = start
 
     def accept_open_expression(self, offset, length):
         raise Exception("Syntax error")
@@ -71,8 +79,9 @@ class ExecutionState:
         raise Exception("Syntax error")
 
     def accept_close_execution(self, offset, length):
-        return (LiteralState(self.text[offset + length:]),
-                code_generation.Execution(self.text[:offset].strip()))
+        return (LiteralState(self.text, offset + length),
+                code_generation.Execution(
+                    self.text[self.start:offset].strip()))
 
     def accept_end_input(self):
         raise Exception("Syntax error")
@@ -83,8 +92,9 @@ class ExpressionState:
     that embeds the value of an expression into the output.
 
     """
-    def __init__(self, text):
+    def __init__(self, text, start=0):
         self.text = text
+        self.start = start
 
     def accept_open_expression(self, offset, length):
         raise Exception("Syntax error: opened expression inside expression")
@@ -96,8 +106,9 @@ class ExpressionState:
         raise Exception("Syntax error")
 
     def accept_close_expression(self, offset, length):
-        return (LiteralState(self.text[offset + length:]),
-                code_generation.VariableExpansion(self.text[:offset].strip()))
+        return (LiteralState(self.text, offset + length),
+                code_generation.VariableExpansion(
+                    self.text[self.start:offset].strip()))
 
     def accept_end_input(self):
         raise Exception("Syntax error")
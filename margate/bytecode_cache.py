@@ -0,0 +1,164 @@
+"""The bytecode cache stores compiled templates on disk, in a similar
+way to the ``.pyc`` files that Python writes for modules.
+
+Compiling a template means tokenising it, parsing it and generating
+bytecode, which is slow compared to rendering it. With a bytecode
+cache, the code object for each template is marshalled into a cache
+directory the first time it is compiled, and any other process that
+compiles the same template loads the code object directly without
+running the parser or the code generator.
+
+Each entry records the hashes of the templates that the cached
+template extends (via ``{% extends %}``), so that a change to a parent
+template makes the entry stale even though the source of the template
+itself is unchanged.
+
+"""
+
+import os
+import sys
+import hashlib
+import marshal
+import tempfile
+import importlib.util
+
+import margate
+
+# Identifies the format of the cache files, and of the code objects
+# that they contain, so that a change to either doesn't cause an old
+# entry to be misread.
+_CACHE_FORMAT = 2
+
+
+def source_hash(source):
+    """Return a hash of template source code, as used to key cache
+    entries and to record the templates that a template depends on.
+
+    """
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def dump_code(code, source, dependencies):
+    """Serialise a compiled template to bytes.
+
+    :param code: The code object for the template.
+    :param str source: The template source that the code was
+      compiled from.
+    :param list dependencies: A list of ``(template_name, hash)``
+      pairs for the templates that this template extends.
+
+    """
+    return marshal.dumps((_CACHE_FORMAT,
+                          importlib.util.MAGIC_NUMBER,
+                          margate.__version__,
+                          source_hash(source),
+                          tuple(tuple(dependency)
+                                for dependency in dependencies),
+                          code))
+
+
+def load_code(data):
+    """Deserialise a compiled template that was serialised with
+    :py:func:`dump_code`.
+
+    :return: A tuple of the code object, the hash of the source it
+      was compiled from and the dependencies, or ``None`` if the data
+      was written by a different version of Python or of Margate.
+
+    """
+    try:
+        (cache_format, magic_number, version,
+         compiled_source_hash, dependencies, code) = marshal.loads(data)
+    except (EOFError, ValueError, TypeError):
+        return None
+
+    if cache_format != _CACHE_FORMAT \
+       or magic_number != importlib.util.MAGIC_NUMBER \
+       or version != margate.__version__:
+        return None
+
+    return (code, compiled_source_hash, list(dependencies))
+
+
+class BytecodeCache:
+    """A bytecode cache that stores one file per template in a
+    directory.
+
+    Entries are keyed by a hash of the template source and of the
+    compiler configuration, and the file name also includes the
+    Python implementation's cache tag (for example ``cpython-36``), so
+    several versions of Python can share one cache directory.
+
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_key(self, source, configuration=""):
+        """Return the key for the cache entry for a template.
+
+        :param str source: The template source.
+        :param str configuration: Describes any compiler settings
+          that affect the generated code.
+
+        """
+        return hashlib.sha1(
+            ("%s\0%s" % (source_hash(source),
+                         configuration)).encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        """Load an entry from the cache.
+
+        :return: A tuple of the code object and the list of
+          dependencies, or ``None`` if there is no valid entry for
+          this key.
+
+        """
+        try:
+            with open(self._get_path(key), "rb") as cache_file:
+                data = cache_file.read()
+        except OSError:
+            return None
+
+        entry = load_code(data)
+        if entry is None:
+            return None
+
+        (code, _, dependencies) = entry
+        return (code, dependencies)
+
+    def store(self, key, code, source, dependencies):
+        """Store a compiled template in the cache.
+
+        The entry is written to a temporary file that is then renamed
+        into place, so that other processes never see a partly-written
+        entry.
+
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        (handle, temp_path) = tempfile.mkstemp(dir=self.directory,
+                                               suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as cache_file:
+                cache_file.write(dump_code(code, source, dependencies))
+            os.replace(temp_path, self._get_path(key))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        try:
+            filenames = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+
+        for filename in filenames:
+            if filename.endswith(".mgc"):
+                os.unlink(os.path.join(self.directory, filename))
+
+    def _get_path(self, key):
+        return os.path.join(self.directory,
+                            "%s.%s.mgc" % (key,
+                                           sys.implementation.cache_tag))
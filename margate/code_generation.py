@@ -3,11 +3,76 @@ function, in the form of bytecode generators.
 
 There are a series of classes in here that are used as nodes in the
 code generation tree, and each one implements a ``make_bytecode()``
-method.
+method. Each one also implements a ``make_ast()`` method, which is
+used by the alternative backend that generates a Python abstract
+syntax tree and passes it to the built-in :py:func:`compile` (which
+works on versions of Python where the hand-assembled bytecode
+doesn't).
 
 """
 
-from bytecode import Instr, Label, ConcreteBytecode
+import ast
+import copy
+import inspect
+import keyword
+from collections import OrderedDict
+
+from bytecode import Instr, Label, Bytecode, ConcreteBytecode, Compare
+
+from .filters import filter_argument_name
+
+
+def _make_write_statement(symbol_table, value):
+    """Make the statement that writes the result of an expression to
+    the template output.
+
+    """
+    return ast.Expr(ast.Call(ast.Name(symbol_table["write_func"],
+                                      ast.Load()),
+                             [value],
+                             []))
+
+
+def _make_block_body(statements):
+    """The body of a compound statement can't be empty, so an empty
+    body gets a ``pass`` statement.
+
+    """
+    return statements or [ast.Pass()]
+
+
+def _parse_expression(expression, forloop_names=None):
+    """Parse the source of an expression.
+
+    :param forloop_names: If given, maps ``forloop`` attributes to the
+      local variables that replace them (see
+      :py:meth:`ForBlock._lower_body`).
+
+    """
+    tree = ast.parse(expression, mode="eval").body
+    if forloop_names:
+        tree = _ForloopRewriter(forloop_names).visit(tree)
+    return tree
+
+
+def _is_async_iterable(name):
+    return ast.Call(ast.Name("hasattr", ast.Load()),
+                    [ast.Name(name, ast.Load()),
+                     ast.Constant("__aiter__")],
+                    [])
+
+
+def _make_await_if_awaitable(name):
+    """In an async template, make the statement that replaces the value
+    of a variable with the result of awaiting it, if it's awaitable.
+
+    """
+    return ast.If(ast.Call(ast.Name("_isawaitable", ast.Load()),
+                           [ast.Name(name, ast.Load())],
+                           []),
+                  [ast.Assign([ast.Name(name, ast.Store())],
+                              ast.Await(ast.Name(name, ast.Load())))],
+                  [])
 
 
 class Sequence:
@@ -32,10 +97,27 @@ class Sequence:
 
 
 class ForBlock:
+    """The ForBlock generates code for a ``{% for %}`` loop, with an
+    optional ``{% empty %}`` clause that is used when the collection is
+    empty.
+
+    The body of the loop can use ``forloop.counter``,
+    ``forloop.counter0``, ``forloop.revcounter``,
+    ``forloop.revcounter0``, ``forloop.first``, ``forloop.last`` and
+    ``forloop.length``. These are found when the template is compiled,
+    and the loop only keeps track of the ones that are used, in local
+    variables. ``forloop.last`` looks one item ahead rather than
+    finding the length of the collection, so it works with generators
+    without reading them into a list, but ``length`` and the
+    ``revcounter`` values need the length.
+
+    """
+
     def __init__(self, for_node):
         self.variable = for_node.variable
         self.collection = for_node.collection
         self.sequence = Sequence()
+        self.empty_sequence = Sequence()
 
     def __eq__(self, other):
         if not isinstance(other, ForBlock):
@@ -43,7 +125,8 @@ class ForBlock:
 
         return (self.variable == other.variable) \
             and (self.collection == other.collection) \
-            and (self.sequence == other.sequence)
+            and (self.sequence == other.sequence) \
+            and (self.empty_sequence == other.empty_sequence)
 
     def __repr__(self):
         return "<ForBlock %r in %r (%r)>" % (self.variable,
@@ -51,50 +134,487 @@ class ForBlock:
                                              self.sequence)
 
     def make_bytecode(self, symbol_table):
-        catch_block = Label()
         start_loop = Label()
         end_loop = Label()
         end_for = Label()
-        end_of_function = Label()
+        end_empty = Label()
 
-        inner = [Instr("SETUP_EXCEPT", catch_block),
-                 Instr("SETUP_LOOP", end_for),
-                 Instr("LOAD_NAME", self.collection),
-                 Instr("GET_ITER"),
-                 start_loop,
-                 Instr("FOR_ITER", end_loop),
-                 Instr("STORE_NAME", self.variable)]
+        loop = self._lower_body(symbol_table)
+        names = loop.names
+        collection = self.collection
 
-        for element in self.sequence.elements:
+        inner = []
+
+        for local_name in loop.invariants:
+            inner += [Instr("LOAD_GLOBAL", "_undefined"),
+                      Instr("STORE_NAME", local_name)]
+
+        if "length" in names:
+            inner += [Instr("LOAD_GLOBAL", "_sized"),
+                      Instr("LOAD_NAME", collection),
+                      Instr("CALL_FUNCTION", 1),
+                      Instr("STORE_NAME", loop.collection_name),
+                      Instr("LOAD_NAME", "len"),
+                      Instr("LOAD_NAME", loop.collection_name),
+                      Instr("CALL_FUNCTION", 1),
+                      Instr("STORE_NAME", names["length"])]
+            collection = loop.collection_name
+
+        if loop.empty_flag:
+            inner += [Instr("LOAD_CONST", True),
+                      Instr("STORE_NAME", loop.empty_flag)]
+
+        inner += [Instr("SETUP_LOOP", end_for)]
+
+        if "counter0" in names:
+            inner += [Instr("LOAD_NAME", "enumerate")]
+        if "last" in names:
+            inner += [Instr("LOAD_GLOBAL", "_lookahead")]
+        inner += [Instr("LOAD_NAME", collection)]
+        if "last" in names:
+            inner += [Instr("CALL_FUNCTION", 1)]
+        if "counter0" in names:
+            inner += [Instr("CALL_FUNCTION", 1)]
+
+        inner += [Instr("GET_ITER"),
+                  start_loop,
+                  Instr("FOR_ITER", end_loop)]
+
+        if "counter0" in names:
+            inner += [Instr("UNPACK_SEQUENCE", 2),
+                      Instr("STORE_NAME", names["counter0"])]
+        if "last" in names:
+            inner += [Instr("UNPACK_SEQUENCE", 2),
+                      Instr("STORE_NAME", names["last"])]
+        inner += [Instr("STORE_NAME", self.variable)]
+
+        if loop.empty_flag:
+            inner += [Instr("LOAD_CONST", False),
+                      Instr("STORE_NAME", loop.empty_flag)]
+
+        for (name, source) in loop.derived:
+            inner += _make_expression_bytecode(source)
+            inner += [Instr("STORE_NAME", name)]
+
+        for element in loop.elements:
             inner += element.make_bytecode(symbol_table)
 
         inner += [Instr("JUMP_ABSOLUTE", start_loop),
                   end_loop,
                   Instr("POP_BLOCK"),
-                  end_for,
-                  Instr("POP_BLOCK"),
-                  Instr("JUMP_FORWARD", end_of_function)]
-
-        inner += [catch_block,
-                  # In the catch block, we catch everything
-                  # unconditionally (this is wrong, we should filter
-                  # out just StopException, which is the only thing we
-                  # have any business catching here).
-                  #
-                  # We pop (I think?) the exception and the stack
-                  # frame data.
-                  Instr("POP_TOP"),
-                  Instr("POP_TOP"),
-                  Instr("POP_TOP"),
-
-                  # Pop the exception frame from the block stack.
-                  Instr("POP_EXCEPT"),
-                  Instr("JUMP_FORWARD", end_of_function),
-                  Instr("END_FINALLY"),
-                  end_of_function]
+                  end_for]
+
+        if loop.empty_flag:
+            inner += [Instr("LOAD_NAME", loop.empty_flag),
+                      Instr("POP_JUMP_IF_FALSE", end_empty)]
+            for element in self.empty_sequence.elements:
+                inner += element.make_bytecode(symbol_table)
+            inner += [end_empty]
 
         return inner
 
+    def make_ast(self, symbol_table):
+        loop = self._lower_body(symbol_table)
+        names = loop.names
+
+        setup = []
+        collection = self.collection
+        is_async = symbol_table.get("async")
+
+        if is_async:
+            # In an async template the collection may be awaitable, or
+            # an asynchronous iterable, which is iterated with async
+            # for. The length of an asynchronous iterable can only be
+            # found by reading all of it, so it's only gathered into a
+            # list if the loop uses forloop.length or revcounter.
+            collection = loop.collection_name
+            setup += [
+                ast.Assign([ast.Name(collection, ast.Store())],
+                           ast.Name(self.collection, ast.Load())),
+                _make_await_if_awaitable(collection)]
+
+            if "length" in names:
+                setup += [ast.If(
+                    _is_async_iterable(collection),
+                    [ast.Assign(
+                        [ast.Name(collection, ast.Store())],
+                        ast.ListComp(
+                            ast.Name("_item", ast.Load()),
+                            [ast.comprehension(
+                                ast.Name("_item", ast.Store()),
+                                ast.Name(collection, ast.Load()),
+                                [],
+                                1)]))],
+                    [])]
+                is_async = False
+
+        setup += [ast.Assign([ast.Name(local_name, ast.Store())],
+                             ast.Name("_undefined", ast.Load()))
+                  for local_name in loop.invariants]
+
+        if "length" in names:
+            source = "%s = _sized(%s)\n%s = len(%s)\n" % (
+                loop.collection_name,
+                collection,
+                names["length"],
+                loop.collection_name)
+            setup += ast.parse(source).body
+            collection = loop.collection_name
+
+        body = []
+        if loop.empty_flag:
+            setup += [ast.Assign([ast.Name(loop.empty_flag, ast.Store())],
+                                 ast.Constant(True))]
+            body += [ast.Assign([ast.Name(loop.empty_flag, ast.Store())],
+                                ast.Constant(False))]
+
+        body += [ast.Assign([ast.Name(name, ast.Store())],
+                            _parse_expression(source))
+                 for (name, source) in loop.derived]
+
+        for element in loop.elements:
+            body += element.make_ast(symbol_table)
+
+        if is_async:
+            statements = setup + [
+                ast.If(_is_async_iterable(collection),
+                       [self._make_loop_ast(collection,
+                                            names,
+                                            copy.deepcopy(body),
+                                            True)],
+                       [self._make_loop_ast(collection,
+                                            names,
+                                            body,
+                                            False)])]
+        else:
+            statements = setup + [self._make_loop_ast(collection,
+                                                      names,
+                                                      body,
+                                                      False)]
+
+        if loop.empty_flag:
+            empty_body = []
+            for element in self.empty_sequence.elements:
+                empty_body += element.make_ast(symbol_table)
+
+            statements += [ast.If(ast.Name(loop.empty_flag, ast.Load()),
+                                  _make_block_body(empty_body),
+                                  [])]
+
+        return statements
+
+    def _make_loop_ast(self, collection, names, body, is_async):
+        """Make the ``for`` (or ``async for``) statement of the loop,
+        which also tracks the ``forloop`` values that it needs."""
+        iterable = ast.Name(collection, ast.Load())
+        target = ast.Name(self.variable, ast.Store())
+
+        if "last" in names:
+            iterable = ast.Call(
+                ast.Name("_alookahead" if is_async else "_lookahead",
+                         ast.Load()),
+                [iterable],
+                [])
+            target = ast.Tuple([ast.Name(names["last"], ast.Store()),
+                                target],
+                               ast.Store())
+        if "counter0" in names:
+            iterable = ast.Call(
+                ast.Name("_aenumerate" if is_async else "enumerate",
+                         ast.Load()),
+                [iterable],
+                [])
+            target = ast.Tuple([ast.Name(names["counter0"], ast.Store()),
+                                target],
+                               ast.Store())
+
+        loop_type = ast.AsyncFor if is_async else ast.For
+        return loop_type(target, iterable, _make_block_body(body), [])
+
+    def _lower_body(self, symbol_table):
+        """Rewrite the body of the loop so that each iteration does as
+        little work as possible.
+
+        References to ``forloop`` attributes are replaced by local
+        variables. Expansions of variables that the loop doesn't
+        change are evaluated once, the first time they're reached,
+        and runs of literals and expansions are written with a single
+        call (except in async templates, where expansions may need to
+        be awaited).
+
+        :return: A :py:class:`_LoweredLoop`.
+
+        """
+        loop = _LoweredLoop()
+
+        used = _get_forloop_attributes(self.sequence.elements)
+        unknown = used - set(_FORLOOP_ATTRIBUTES)
+        if unknown:
+            raise Exception("Unknown loop attribute 'forloop.%s'"
+                            % sorted(unknown)[0])
+
+        # Work out which values need to be tracked to compute the
+        # attributes that are used.
+        tracked = set()
+        for attribute in used:
+            tracked.add(attribute)
+            tracked.update(_FORLOOP_ATTRIBUTES[attribute][0])
+
+        prefix = _make_local_name(symbol_table, "_forloop")
+        loop.names = {attribute: "%s_%s" % (prefix, attribute)
+                      for attribute in tracked}
+        loop.collection_name = "%s_collection" % prefix
+        loop.derived = [
+            (loop.names[attribute],
+             _FORLOOP_ATTRIBUTES[attribute][1] % loop.names)
+            for attribute in _FORLOOP_ATTRIBUTES
+            if attribute in tracked and _FORLOOP_ATTRIBUTES[attribute][1]]
+
+        if self.empty_sequence.elements:
+            loop.empty_flag = _make_local_name(symbol_table, "_empty")
+
+        bound_names = {self.variable}
+        bound_names.update(_get_loop_variables(self.sequence.elements))
+
+        invariants = {}
+        loop.elements = _lower_loop_body(
+            self.sequence.elements,
+            bound_names,
+            invariants,
+            loop.names,
+            symbol_table,
+            not symbol_table.get("async"))
+        loop.invariants = list(invariants.values())
+
+        return loop
+
+
+class _LoweredLoop:
+    """The parts of a loop worked out by :py:meth:`ForBlock._lower_body`.
+
+    :ivar invariants: The local variables that hold the values of
+      hoisted expansions, which are reset to ``_undefined`` before the
+      loop starts.
+    :ivar elements: The elements of the new loop body.
+    :ivar names: Maps the ``forloop`` values that are tracked to the
+      local variables that hold them.
+    :ivar derived: The values computed at the start of each
+      iteration, as pairs of the local variable and the source of the
+      expression.
+    :ivar collection_name: The local variable for the collection, if
+      its length is needed.
+    :ivar empty_flag: The local variable that records whether the
+      collection was empty, if there's an ``{% empty %}`` clause.
+
+    """
+
+    invariants = ()
+    elements = ()
+    names = {}
+    derived = ()
+    collection_name = None
+    empty_flag = None
+
+
+# The attributes of forloop, with the other values that each is
+# computed from, and the source of the expression that computes it
+# at the start of each iteration (with the local variables for the
+# other values substituted in). The values with no expression are
+# taken from the iteration itself: "counter0" from enumerate(),
+# "last" from _lookahead() and "length" from len(). These are in
+# dependency order.
+_FORLOOP_ATTRIBUTES = OrderedDict([
+    ("counter0", ((), None)),
+    ("last", ((), None)),
+    ("length", ((), None)),
+    ("counter", (("counter0",), "%(counter0)s + 1")),
+    ("first", (("counter0",), "%(counter0)s == 0")),
+    ("revcounter", (("counter0", "length"),
+                    "%(length)s - %(counter0)s")),
+    ("revcounter0", (("counter0", "length"),
+                     "%(length)s - %(counter0)s - 1")),
+])
+
+
+def _get_forloop_attributes(elements):
+    """Find the attributes of ``forloop`` that elements of a loop body
+    use, not counting the bodies of nested loops, which have their own
+    ``forloop``, or of macros.
+
+    """
+    used = set()
+
+    for element in elements:
+        if isinstance(element, VariableExpansion):
+            for source in _get_expansion_sources(element):
+                used.update(_find_forloop_attributes(
+                    _parse_expression(source)))
+        elif isinstance(element, IfBlock):
+            used.update(_find_forloop_attributes(element.condition))
+        elif isinstance(element, CacheBlock):
+            for source in (element.key, element.ttl):
+                if source is not None:
+                    used.update(_find_forloop_attributes(
+                        _parse_expression(source)))
+
+        if hasattr(element, "sequence") \
+           and not isinstance(element, (ForBlock, MacroBlock)):
+            used.update(_get_forloop_attributes(element.sequence.elements))
+
+    return used
+
+
+def _get_expansion_sources(expansion):
+    """Return the source of the expression of an expansion and of the
+    arguments of its filters."""
+    return [expansion.variable_name] + [argument
+                                        for (_, argument) in expansion.filters
+                                        if argument is not None]
+
+
+def _find_forloop_attributes(tree):
+    """Find the attributes of ``forloop`` that an expression uses."""
+    return {node.attr
+            for node in ast.walk(tree)
+            if isinstance(node, ast.Attribute)
+            and isinstance(node.value, ast.Name)
+            and node.value.id == "forloop"}
+
+
+class _ForloopRewriter(ast.NodeTransformer):
+    """Replaces ``forloop`` attributes with local variables."""
+
+    def __init__(self, names):
+        self.names = names
+
+    def visit_Attribute(self, node):
+        if isinstance(node.value, ast.Name) \
+           and node.value.id == "forloop":
+            return ast.copy_location(ast.Name(self.names[node.attr],
+                                              node.ctx),
+                                     node)
+
+        return self.generic_visit(node)
+
+
+def _make_expression_bytecode(source):
+    """Make the instructions that evaluate an expression and leave its
+    value on the stack.
+
+    :param source: The source of the expression, or its
+      :py:class:`ast.Expression`.
+
+    """
+    if isinstance(source, ast.AST):
+        source = ast.fix_missing_locations(source)
+
+    compiled_expr = compile(source, filename="<none>", mode="eval")
+    inner = ConcreteBytecode.from_code(compiled_expr).to_bytecode()
+
+    # Strip off the return statement at the end of the expression.
+    inner.pop()
+
+    return list(inner)
+
+
+def _get_loop_variables(elements):
+    """Find the names that loops among the elements assign to."""
+    names = set()
+
+    for element in elements:
+        if isinstance(element, ForBlock):
+            names.add(element.variable)
+        if hasattr(element, "sequence"):
+            names.update(_get_loop_variables(element.sequence.elements))
+
+    return names
+
+
+def _lower_loop_body(elements, bound_names, invariants, forloop_names,
+                     symbol_table, optimise=True):
+    """Rewrite the elements of a loop body (see
+    :py:meth:`ForBlock._lower_body`).
+
+    Only expansions of a single variable, with no filters, are moved
+    out of the loop, since evaluating anything else could have side
+    effects. Even so, the value is only computed when the expansion is
+    first reached, rather than before the loop starts, since the
+    variable may not be set (see :py:class:`HoistedExpansion`).
+
+    :param dict invariants: Collects the variables whose expansions
+      are moved out of the loop, mapped to the names of the local
+      variables that hold their values.
+    :param dict forloop_names: Maps ``forloop`` attributes to the
+      local variables that replace them.
+    :param bool optimise: Whether to hoist and batch writes, rather
+      than just replacing ``forloop`` attributes.
+
+    """
+    result = []
+    parts = []
+
+    for element in elements:
+        if isinstance(element, VariableExpansion):
+            name = element.variable_name.strip()
+
+            if forloop_names and _get_forloop_attributes([element]):
+                element = VariableExpansion(element.variable_name,
+                                            element.filters,
+                                            forloop_names)
+            elif optimise \
+                    and not element.filters \
+                    and name.isidentifier() \
+                    and not keyword.iskeyword(name) \
+                    and name not in bound_names:
+                if name not in invariants:
+                    invariants[name] = _make_local_name(symbol_table,
+                                                        "_invariant")
+                element = HoistedExpansion(invariants[name], element)
+
+            parts.append(element)
+        elif isinstance(element, Literal):
+            parts.append(element)
+        else:
+            result += _batch_writes(parts, optimise)
+            parts = []
+
+            if hasattr(element, "sequence") \
+               and not isinstance(element, (ForBlock, MacroBlock)):
+                element = copy.copy(element)
+                element.sequence = _make_sequence(
+                    _lower_loop_body(element.sequence.elements,
+                                     bound_names,
+                                     invariants,
+                                     forloop_names,
+                                     symbol_table,
+                                     optimise))
+
+                if isinstance(element, IfBlock) and forloop_names:
+                    element.condition = _ForloopRewriter(
+                        forloop_names).visit(
+                            copy.deepcopy(element.condition))
+                elif isinstance(element, CacheBlock) and forloop_names:
+                    element.forloop_names = forloop_names
+
+            result.append(element)
+
+    return result + _batch_writes(parts, optimise)
+
+
+def _batch_writes(parts, optimise):
+    if optimise and len(parts) > 1:
+        return [WriteBatch(parts)]
+    else:
+        return parts
+
+
+def _make_local_name(symbol_table, prefix):
+    """Make a name for a local variable of the template function that
+    is different from any other made for the same template."""
+    index = symbol_table.get("local_count", 0)
+    symbol_table["local_count"] = index + 1
+    return "%s_%d" % (prefix, index)
+
 
 class IfBlock:
     """The IfBlock generates code for a conditional expression.
@@ -140,30 +660,188 @@ class IfBlock:
 
         return inner
 
+    def make_ast(self, symbol_table):
+        body = []
+        for element in self.sequence.elements:
+            body += element.make_ast(symbol_table)
+
+        return [ast.If(self.condition.body,
+                       _make_block_body(body),
+                       [])]
+
 
 class ExtendsBlock:
+    """The ExtendsBlock represents a template that extends another one.
+    The ``template`` is the parse tree of the parent template and the
+    ``sequence`` holds the blocks that this template overrides.
+
+    The parent template may itself extend another template, to any
+    depth. The whole chain is resolved when code is generated (see
+    :py:meth:`resolve`), so the template function contains the content
+    of every level inline and never calls out to another template.
+
+    """
+
     def __init__(self, template):
         self.template = template
         self.sequence = Sequence()
 
+    def resolve(self):
+        """Resolve the inheritance chain into a single tree.
+
+        The result is the root template's tree, in which each
+        ``{% block %}`` holds the content of the most derived template
+        that overrides it, and each ``{{ block.super }}`` is replaced
+        by the content of the block that it overrides.
+
+        :return: A new :py:class:`Sequence`. The nodes of the parse
+          trees that it's resolved from are shared, not copied, so
+          they must not be modified.
+
+        """
+        return _resolve_inheritance(self, {})
+
     def make_bytecode(self, symbol_table):
         inner = []
 
-        block_dict = {}
-        for entry in self.sequence.elements:
-            if isinstance(entry, ReplaceableBlock):
-                block_dict[entry.name] = entry.make_bytecode(symbol_table)
+        for entry in self.resolve().elements:
+            inner += entry.make_bytecode(symbol_table)
 
-        for entry in self.template.elements:
-            if isinstance(entry, ReplaceableBlock) \
-               and (entry.name in block_dict):
-                inner += block_dict[entry.name]
-            else:
-                inner += entry.make_bytecode(symbol_table)
+        return inner
+
+    def make_ast(self, symbol_table):
+        inner = []
+
+        for entry in self.resolve().elements:
+            inner += entry.make_ast(symbol_table)
 
         return inner
 
 
+def _resolve_inheritance(extends_block, overrides):
+    """Resolve an :py:class:`ExtendsBlock`.
+
+    :param dict overrides: Maps block names to the blocks that override
+      them in the templates that extend this one, most derived first.
+
+    """
+    # The blocks defined in this template (at any depth, since a block
+    # can be overridden from inside another block) come after the
+    # ones from more derived templates.
+    chains = dict(overrides)
+    defined = set()
+    for block in _find_blocks(extends_block.sequence.elements):
+        if block.name not in defined:
+            defined.add(block.name)
+            chains[block.name] = overrides.get(block.name, ()) + (block,)
+
+    # Anything in the parent outside its own {% extends %} is ignored,
+    # the same as anything in this template outside a block.
+    for element in extends_block.template.elements:
+        if isinstance(element, ExtendsBlock):
+            return _resolve_inheritance(element, chains)
+
+    return _make_sequence(
+        _substitute_blocks(extends_block.template.elements, chains, ()))
+
+
+def extract_block(sequence, block_name):
+    """Make a tree that renders only one ``{% block %}`` of a template.
+
+    Inheritance is resolved first, so the block holds the content of
+    its most derived override, and blocks that are only defined in a
+    template that this one extends can be found. Macros defined at the
+    top level before the block are kept, so the block can call them.
+
+    :return: A new :py:class:`Sequence`.
+    :raise Exception: If the template has no block with the name.
+
+    """
+    resolved = _substitute_blocks(sequence.elements, {}, ())
+
+    elements = []
+    for element in resolved:
+        for block in _find_blocks([element]):
+            if block.name == block_name:
+                return _make_sequence(elements + [block])
+
+        if isinstance(element, MacroBlock):
+            elements.append(element)
+
+    raise Exception("Template has no block '%s'" % block_name)
+
+
+def _find_blocks(elements):
+    for element in elements:
+        if isinstance(element, IncludeBlock):
+            continue
+
+        if isinstance(element, ReplaceableBlock):
+            yield element
+
+        if hasattr(element, "sequence"):
+            yield from _find_blocks(element.sequence.elements)
+        if isinstance(element, ForBlock):
+            yield from _find_blocks(element.empty_sequence.elements)
+
+
+def _substitute_blocks(elements, chains, super_chain):
+    """Return a copy of a list of elements in which every block holds
+    the content of its most derived override.
+
+    :param tuple super_chain: The blocks that ``{{ block.super }}``
+      refers to in these elements, most derived first.
+
+    """
+    result = []
+
+    for element in elements:
+        if isinstance(element, ReplaceableBlock):
+            chain = chains.get(element.name, ())
+            if not any(block is element for block in chain):
+                chain += (element,)
+            result.append(_resolve_block(chain, chains))
+        elif isinstance(element, BlockSuper):
+            if super_chain:
+                result += _resolve_block(super_chain, chains).sequence.elements
+        elif isinstance(element, ExtendsBlock):
+            result += _resolve_inheritance(element, chains).elements
+        elif isinstance(element, IncludeBlock):
+            result.append(element)
+        elif hasattr(element, "sequence"):
+            element = copy.copy(element)
+            element.sequence = _make_sequence(
+                _substitute_blocks(element.sequence.elements,
+                                   chains,
+                                   super_chain))
+            if isinstance(element, ForBlock):
+                element.empty_sequence = _make_sequence(
+                    _substitute_blocks(element.empty_sequence.elements,
+                                       chains,
+                                       super_chain))
+            result.append(element)
+        else:
+            result.append(element)
+
+    return result
+
+
+def _resolve_block(chain, chains):
+    """Resolve the first block in a chain of blocks with the same name,
+    where each block overrides the next."""
+    resolved = ReplaceableBlock(chain[0].name)
+    resolved.sequence = _make_sequence(
+        _substitute_blocks(chain[0].sequence.elements, chains, chain[1:]))
+    return resolved
+
+
+def _make_sequence(elements):
+    sequence = Sequence()
+    for element in elements:
+        sequence.add_element(element)
+    return sequence
+
+
 class ReplaceableBlock:
     def __init__(self, name):
         self.name = name
@@ -184,40 +862,581 @@ class ReplaceableBlock:
 
         return inner
 
+    def make_ast(self, symbol_table):
+        inner = []
+
+        for entry in self.sequence.elements:
+            inner += entry.make_ast(symbol_table)
+
+        return inner
+
+
+class IncludeBlock:
+    """An ``{% include %}`` of a template whose name is a literal. The
+    parse tree of the included template is inlined when the template
+    is compiled, so it's rendered with the variables of the including
+    template (including loop variables) without a function call.
+
+    Blocks in the included template are rendered as they are, and
+    can't be overridden by a template that the including template
+    extends, as in Django.
+
+    """
+
+    def __init__(self, template_name, sequence):
+        self.template_name = template_name
+        self.sequence = sequence
+
+    def __eq__(self, other):
+        if not isinstance(other, IncludeBlock):
+            return False
+
+        return (self.template_name == other.template_name) \
+            and (self.sequence == other.sequence)
+
+    def __repr__(self):
+        return "<IncludeBlock %r>" % self.template_name
+
+    def make_bytecode(self, symbol_table):
+        inner = []
+
+        for entry in self.sequence.elements:
+            inner += entry.make_bytecode(symbol_table)
+
+        return inner
+
+    def make_ast(self, symbol_table):
+        inner = []
+
+        for entry in self.sequence.elements:
+            inner += entry.make_ast(symbol_table)
+
+        return inner
+
+
+class DynamicInclude:
+    """An ``{% include %}`` of a template whose name is given by an
+    expression. The included template is compiled separately, and
+    called when the template is rendered through the ``_include``
+    argument of the template function (see
+    :py:class:`~margate.compiler.Includer`), which is passed the local
+    variables of the template function, so that the included template
+    sees the variables of the including template.
+
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+
+    def __eq__(self, other):
+        if not isinstance(other, DynamicInclude):
+            return False
+
+        return self.expression == other.expression
+
+    def __repr__(self):
+        return "<DynamicInclude %r>" % self.expression
+
+    def make_bytecode(self, symbol_table):
+        return ([Instr("LOAD_NAME", symbol_table["write_func"]),
+                 Instr("LOAD_NAME", "_include")]
+                + _make_expression_bytecode(self.expression)
+                + [Instr("LOAD_NAME", "locals"),
+                   Instr("CALL_FUNCTION", 0),
+                   Instr("CALL_FUNCTION", 2),
+                   Instr("CALL_FUNCTION", 1),
+                   Instr("POP_TOP")])
+
+    def make_ast(self, symbol_table):
+        if symbol_table.get("async"):
+            raise Exception("Templates included by a dynamic name are "
+                            "not supported in async templates")
+
+        return [_make_write_statement(
+            symbol_table,
+            ast.Call(ast.Name("_include", ast.Load()),
+                     [_parse_expression(self.expression),
+                      ast.Call(ast.Name("locals", ast.Load()), [], [])],
+                     []))]
+
+
+class MacroBlock:
+    """A ``{% macro name(arguments) %}`` block, which defines a
+    fragment of template that can be rendered many times with
+    different arguments with ``{% call %}``.
+
+    The macro becomes a nested function, which is made at the point
+    where the macro is defined and held in a local variable of the
+    template function. The arguments of the macro are fast locals of
+    the nested function. Any other variable that the body of the
+    macro uses (including the write function of the output) becomes
+    a keyword-only argument, which each :py:class:`MacroCall` passes
+    from the template function, so the macro sees the values at the
+    point where it's called. Each call passes its own write function,
+    so the macro writes straight to the output at the point of the
+    call (which may be the output of a :py:class:`CacheBlock`). A
+    macro can't call itself.
+
+    :param arguments: The arguments of the macro, as the
+      :py:class:`ast.arguments` of a function definition.
+
+    """
+
+    def __init__(self, name, arguments):
+        self.name = name
+        self.arguments = arguments
+        self.sequence = Sequence()
+
+    def __eq__(self, other):
+        if not isinstance(other, MacroBlock):
+            return False
+
+        return (self.name == other.name) \
+            and (ast.dump(self.arguments) == ast.dump(other.arguments)) \
+            and (self.sequence == other.sequence)
+
+    def __repr__(self):
+        return "<MacroBlock %r (%r)>" % (self.name, self.sequence)
+
+    def make_bytecode(self, symbol_table):
+        parameters = [argument.arg for argument in self.arguments.args]
+
+        inner = []
+        for element in self.sequence.elements:
+            inner += element.make_bytecode(symbol_table)
+        inner += [Instr("LOAD_CONST", None),
+                  Instr("RETURN_VALUE")]
+
+        # As in the template function, every name that the macro
+        # loads becomes a fast local, and the ones that it doesn't
+        # assign and aren't arguments are passed in when it's called.
+        loaded = set()
+        stored = set()
+        instructions = []
+
+        for instr in inner:
+            if isinstance(instr, Instr) and instr.name == "LOAD_NAME":
+                loaded.add(instr.arg)
+                instr = Instr("LOAD_FAST", instr.arg, lineno=instr.lineno)
+            elif isinstance(instr, Instr) and instr.name == "STORE_NAME":
+                stored.add(instr.arg)
+                instr = Instr("STORE_FAST", instr.arg, lineno=instr.lineno)
+
+            instructions.append(instr)
+
+        free_names = sorted(loaded - stored - set(parameters))
+        _add_macro(symbol_table, self.name, free_names)
+
+        bytecode = Bytecode(instructions)
+        bytecode.name = self.name
+        bytecode.filename = "<template>"
+        bytecode.argnames = parameters + free_names
+        bytecode.argcount = len(parameters)
+        bytecode.kwonlyargcount = len(free_names)
+        bytecode.flags = (inspect.CO_OPTIMIZED
+                          | inspect.CO_NEWLOCALS
+                          | inspect.CO_NOFREE)
+
+        code = []
+        flags = 0
+
+        if self.arguments.defaults:
+            for default in self.arguments.defaults:
+                code += _make_expression_bytecode(ast.Expression(default))
+            code += [Instr("BUILD_TUPLE", len(self.arguments.defaults))]
+            flags |= 0x01
+
+        code += [Instr("LOAD_CONST", bytecode.to_code()),
+                 Instr("LOAD_CONST", self.name),
+                 Instr("MAKE_FUNCTION", flags),
+                 Instr("STORE_NAME", _make_macro_name(self.name))]
+
+        return code
+
+    def make_ast(self, symbol_table):
+        from .compiler import _get_global_names, _template_globals
+
+        body = []
+        for element in self.sequence.elements:
+            body += element.make_ast(symbol_table)
+
+        if symbol_table.get("async"):
+            function_type = ast.AsyncFunctionDef
+        else:
+            function_type = ast.FunctionDef
+
+        # The function is compiled on its own first, to find the names
+        # that it uses from the template function.
+        arguments = copy.deepcopy(self.arguments)
+        function_def = function_type(name=_make_macro_name(self.name),
+                                     args=arguments,
+                                     body=_make_block_body(body),
+                                     decorator_list=[],
+                                     returns=None)
+
+        module = ast.Module(body=[copy.deepcopy(function_def)],
+                            type_ignores=[])
+        ast.fix_missing_locations(module)
+        free_names = sorted(
+            name
+            for name in _get_global_names(compile(module,
+                                                  filename="<template>",
+                                                  mode="exec"))
+            if name not in _template_globals)
+        _add_macro(symbol_table, self.name, free_names)
+
+        arguments.kwonlyargs += [ast.arg(name, None) for name in free_names]
+        arguments.kw_defaults += [None] * len(free_names)
+
+        return [function_def]
+
+
+class MacroCall:
+    """A ``{% call name(arguments) %}``, which renders a macro that has
+    already been defined.
+
+    :param call: The call, as an :py:class:`ast.Call` whose function
+      is the name of the macro.
+
+    """
+
+    def __init__(self, call):
+        self.call = call
+
+    def __eq__(self, other):
+        if not isinstance(other, MacroCall):
+            return False
+
+        return ast.dump(self.call) == ast.dump(other.call)
+
+    def __repr__(self):
+        return "<MacroCall %r>" % self.call.func.id
+
+    def make_bytecode(self, symbol_table):
+        return (_make_expression_bytecode(
+            ast.Expression(self._make_call(symbol_table)))
+                + [Instr("POP_TOP")])
+
+    def make_ast(self, symbol_table):
+        call = self._make_call(symbol_table)
+
+        if symbol_table.get("async"):
+            call = ast.Await(call)
+
+        return [ast.Expr(call)]
+
+    def _make_call(self, symbol_table):
+        name = self.call.func.id
+        macros = symbol_table.get("macros", {})
+        if name not in macros:
+            raise Exception("Macro '%s' is called before it's defined"
+                            % name)
+
+        # The macro writes to the output that was current where it
+        # was defined, and the call passes its own output instead.
+        (free_names, output_names) = macros[name]
+        replacements = dict(zip(output_names,
+                                _get_output_names(symbol_table)))
+
+        call = copy.deepcopy(self.call)
+        call.func = ast.Name(_make_macro_name(name), ast.Load())
+        call.keywords += [ast.keyword(free_name,
+                                      ast.Name(replacements.get(free_name,
+                                                                free_name),
+                                               ast.Load()))
+                          for free_name in free_names]
+        return call
+
+
+def _make_macro_name(name):
+    """Make the name of the local variable that holds a macro."""
+    return "_macro_%s" % name
+
+
+def _add_macro(symbol_table, name, free_names):
+    """Record that a macro has been defined, the names that its callers
+    pass to it, and the names of the write function and the output
+    that its body uses."""
+    macros = dict(symbol_table.get("macros", {}))
+    macros[name] = (free_names, _get_output_names(symbol_table))
+    symbol_table["macros"] = macros
+
+
+def _get_output_names(symbol_table):
+    """Return the names of the current write function and output."""
+    return (symbol_table["write_func"],
+            symbol_table.get("output_name", "_output"))
+
+
+class CacheBlock:
+    """A ``{% cache key ttl=ttl %}`` block, whose output is kept in the
+    :py:mod:`fragment cache <margate.fragment_cache>`, which the
+    template function gets through its ``_fragment_cache`` argument.
+
+    When the output for the key is in the cache, it's written without
+    rendering the body. Otherwise the body is rendered into a list of
+    its own, and the joined output is stored and written.
+
+    The fragment cache is shared by many templates, so the value of
+    the key is paired with the fragment ID, which identifies this
+    block, and the key only needs to tell apart the outputs of this
+    block.
+
+    :param key: The source of the expression for the key.
+    :param ttl: The source of the expression for the number of
+      seconds to keep the output for, or ``None``.
+    :param str fragment_id: Identifies the block among the blocks of
+      all templates.
+
+    In the body of a loop, ``forloop_names`` maps the ``forloop``
+    attributes that the key and the TTL use to the local variables
+    that replace them.
+
+    """
+
+    def __init__(self, key, ttl=None, fragment_id=""):
+        self.key = key
+        self.ttl = ttl
+        self.fragment_id = fragment_id
+        self.forloop_names = None
+        self.sequence = Sequence()
+
+    def __eq__(self, other):
+        if not isinstance(other, CacheBlock):
+            return False
+
+        return (self.key == other.key) \
+            and (self.ttl == other.ttl) \
+            and (self.fragment_id == other.fragment_id) \
+            and (self.sequence == other.sequence)
+
+    def __repr__(self):
+        return "<CacheBlock %r %r (%r)>" % (self.key,
+                                            self.ttl,
+                                            self.sequence)
+
+    def make_bytecode(self, symbol_table):
+        names = self._make_names(symbol_table)
+        hit = Label()
+
+        body = self._make_body(symbol_table,
+                               names,
+                               lambda element:
+                               element.make_bytecode(symbol_table))
+
+        return ([Instr("LOAD_CONST", self.fragment_id)]
+                + _make_expression_bytecode(
+                    ast.Expression(self._make_key_ast()))
+                + [Instr("BUILD_TUPLE", 2),
+                   Instr("STORE_NAME", names["key"]),
+                   Instr("LOAD_NAME", "_fragment_cache"),
+                   Instr("LOAD_ATTR", "get"),
+                   Instr("LOAD_NAME", names["key"]),
+                   Instr("CALL_FUNCTION", 1),
+                   Instr("STORE_NAME", names["fragment"])]
+                + _make_expression_bytecode("%(fragment)s is None" % names)
+                + [Instr("POP_JUMP_IF_FALSE", hit),
+                   Instr("BUILD_LIST", 0),
+                   Instr("DUP_TOP"),
+                   Instr("STORE_NAME", names["output"]),
+                   Instr("LOAD_ATTR", "append"),
+                   Instr("STORE_NAME", names["write"])]
+                + body
+                + [Instr("LOAD_CONST",
+                         symbol_table["output"].encode_literal("")),
+                   Instr("LOAD_ATTR", "join"),
+                   Instr("LOAD_NAME", names["output"]),
+                   Instr("CALL_FUNCTION", 1),
+                   Instr("STORE_NAME", names["fragment"]),
+                   Instr("LOAD_NAME", "_fragment_cache"),
+                   Instr("LOAD_ATTR", "set"),
+                   Instr("LOAD_NAME", names["key"]),
+                   Instr("LOAD_NAME", names["fragment"])]
+                + _make_expression_bytecode(
+                    ast.Expression(self._make_ttl_ast()))
+                + [Instr("CALL_FUNCTION", 3),
+                   Instr("POP_TOP"),
+                   hit,
+                   Instr("LOAD_NAME", symbol_table["write_func"]),
+                   Instr("LOAD_NAME", names["fragment"]),
+                   Instr("CALL_FUNCTION", 1),
+                   Instr("POP_TOP")])
+
+    def make_ast(self, symbol_table):
+        names = dict(self._make_names(symbol_table),
+                     empty=symbol_table["output"].encode_literal(""))
+
+        body = self._make_body(symbol_table,
+                               names,
+                               lambda element: element.make_ast(symbol_table))
+
+        setup = [ast.Assign([ast.Name(names["key"], ast.Store())],
+                            ast.Tuple([ast.Constant(self.fragment_id),
+                                       self._make_key_ast()],
+                                      ast.Load()))]
+        setup += ast.parse(
+            "%(fragment)s = _fragment_cache.get(%(key)s)\n" % names).body
+        start_miss = ast.parse(
+            "%(output)s = []\n"
+            "%(write)s = %(output)s.append\n" % names).body
+        end_miss = ast.parse(
+            "%(fragment)s = %(empty)r.join(%(output)s)\n" % names).body
+        end_miss += [ast.Expr(ast.Call(
+            ast.Attribute(ast.Name("_fragment_cache", ast.Load()),
+                          "set",
+                          ast.Load()),
+            [ast.Name(names["key"], ast.Load()),
+             ast.Name(names["fragment"], ast.Load()),
+             self._make_ttl_ast()],
+            []))]
+
+        return setup + [
+            ast.If(_parse_expression("%(fragment)s is None" % names),
+                   start_miss + body + end_miss,
+                   []),
+            _make_write_statement(symbol_table,
+                                  ast.Name(names["fragment"], ast.Load()))]
+
+    def _make_key_ast(self):
+        return _parse_expression(self.key, self.forloop_names)
+
+    def _make_ttl_ast(self):
+        if self.ttl is None:
+            return ast.Constant(None)
+        return _parse_expression(self.ttl, self.forloop_names)
+
+    def _make_names(self, symbol_table):
+        prefix = _make_local_name(symbol_table, "_fragment")
+        return {"fragment": prefix,
+                "key": prefix + "_key",
+                "output": prefix + "_output",
+                "write": prefix + "_write"}
+
+    def _make_body(self, symbol_table, names, make_code):
+        # The body writes to the fragment's own output instead of the
+        # template's.
+        saved = (symbol_table["write_func"], symbol_table.get("output_name"))
+        symbol_table["write_func"] = names["write"]
+        symbol_table["output_name"] = names["output"]
+
+        try:
+            body = []
+            for element in self.sequence.elements:
+                body += make_code(element)
+            return body
+        finally:
+            (symbol_table["write_func"], symbol_table["output_name"]) = saved
+
 
 class VariableExpansion:
     """A variable expansion takes the value of an expression and includes
-    it in the template output.
+    it in the template output. If the template is autoescaped, the
+    value is passed through :py:func:`~margate.escaping.escape`,
+    otherwise it's converted with :py:func:`str`.
+
+    :param filters: The filters to apply to the value, in order, as
+      pairs of the name of the filter and the source of the
+      expression for its argument (or ``None`` if it has none).
+    :param forloop_names: In the body of a loop, maps the ``forloop``
+      attributes that the expressions use to the local variables that
+      replace them.
 
     """
 
-    def __init__(self, variable_name):
+    def __init__(self, variable_name, filters=(), forloop_names=None):
         self.variable_name = variable_name
+        self.filters = tuple(filters)
+        self.forloop_names = forloop_names
 
-    def make_bytecode(self, symbol_table):
-        code = [Instr("LOAD_CONST", symbol_table["write_func"]),
-                Instr("LOAD_NAME", "_output"),
-                Instr("LOAD_NAME", "str")]
+    def __eq__(self, other):
+        if not isinstance(other, VariableExpansion):
+            return False
 
-        compiled_expr = compile(self.variable_name,
-                                filename="<none>",
-                                mode="eval")
-        concrete_bytecode = ConcreteBytecode.from_code(compiled_expr)
-        inner = concrete_bytecode.to_bytecode()
+        return (self.variable_name == other.variable_name) \
+            and (self.filters == other.filters)
 
-        # The compiler drops a return statement at the end of the
-        # expression, which we want to strip off so that we can use
-        # the result
-        inner.pop()
+    def __repr__(self):
+        return "<VariableExpansion %r %r>" % (self.variable_name,
+                                              self.filters)
 
-        code += inner
+    def make_bytecode(self, symbol_table):
+        return ([Instr("LOAD_NAME", symbol_table["write_func"])]
+                + self.make_value_bytecode(symbol_table)
+                + [Instr("CALL_FUNCTION", 1),
+                   Instr("POP_TOP")])
 
-        code += [Instr("CALL_FUNCTION", 1),
-                 Instr("CALL_FUNCTION", 2),
-                 Instr("POP_TOP")]
+    def make_value_bytecode(self, symbol_table):
+        """Make the instructions that push the value to write to the
+        output on to the stack."""
+        if symbol_table.get("autoescape"):
+            code = [Instr("LOAD_GLOBAL", "_escape")]
+        else:
+            code = [Instr("LOAD_NAME", "str")]
+
+        code += _make_expression_bytecode(ast.Expression(
+            self._apply_filters(self._parse(self.variable_name))))
+
+        code += [Instr("CALL_FUNCTION", 1)]
+        code += symbol_table["output"].make_encode_bytecode()
 
         return code
 
+    def make_value_ast(self, symbol_table, expression=None):
+        """Make the expression for the value to write to the output.
+
+        :param expression: The AST of the expression to use in place
+          of the one in the template. The filters are applied to it.
+
+        """
+        if expression is None:
+            expression = self._parse(self.variable_name)
+
+        expression = self._apply_filters(expression)
+
+        if symbol_table.get("autoescape"):
+            conversion = "_escape"
+        else:
+            conversion = "str"
+
+        value = ast.Call(ast.Name(conversion, ast.Load()),
+                         [expression],
+                         [])
+
+        return symbol_table["output"].make_encode_ast(value)
+
+    def make_ast(self, symbol_table):
+        if not symbol_table.get("async"):
+            return [_make_write_statement(symbol_table,
+                                          self.make_value_ast(symbol_table))]
+
+        # Await the value of the expression if it's awaitable.
+        return [ast.Assign([ast.Name("_value", ast.Store())],
+                           self._parse(self.variable_name)),
+                _make_await_if_awaitable("_value"),
+                _make_write_statement(
+                    symbol_table,
+                    self.make_value_ast(symbol_table,
+                                        ast.Name("_value", ast.Load())))]
+
+    def _parse(self, source):
+        return _parse_expression(source, self.forloop_names)
+
+    def _apply_filters(self, expression):
+        """Apply the filters to the AST of an expression. Each filter
+        becomes a call of the argument that holds the filter
+        function."""
+        for (name, argument) in self.filters:
+            arguments = [expression]
+            if argument is not None:
+                arguments.append(self._parse(argument))
+
+            expression = ast.Call(ast.Name(filter_argument_name(name),
+                                           ast.Load()),
+                                  arguments,
+                                  [])
+
+        return expression
+
 
 class Literal:
     def __init__(self, contents):
@@ -233,11 +1452,173 @@ class Literal:
         return "<Literal %r>" % self.contents
 
     def make_bytecode(self, symbol_table):
-        return [Instr("LOAD_CONST", symbol_table["write_func"]),
-                Instr("LOAD_NAME", "_output"),
-                Instr("LOAD_CONST", self.contents),
-                Instr("CALL_FUNCTION", 2),
-                Instr("POP_TOP")]
+        return ([Instr("LOAD_NAME", symbol_table["write_func"])]
+                + self.make_value_bytecode(symbol_table)
+                + [Instr("CALL_FUNCTION", 1),
+                   Instr("POP_TOP")])
+
+    def make_ast(self, symbol_table):
+        return [_make_write_statement(symbol_table,
+                                      self.make_value_ast(symbol_table))]
+
+    def make_value_bytecode(self, symbol_table):
+        return [Instr("LOAD_CONST",
+                      symbol_table["output"].encode_literal(self.contents))]
+
+    def make_value_ast(self, symbol_table):
+        return ast.Constant(
+            symbol_table["output"].encode_literal(self.contents))
+
+
+class HoistedExpansion:
+    """An expansion in the body of a loop whose value is computed once,
+    and held in a local variable for the rest of the loop.
+
+    The local variable is set to ``_undefined`` before the loop starts,
+    and the value is computed the first time the expansion is reached,
+    so that a template variable that isn't set is still only an error
+    if the loop runs the code that uses it.
+
+    """
+
+    def __init__(self, local_name, expansion):
+        self.local_name = local_name
+        self.expansion = expansion
+
+    def __repr__(self):
+        return "<HoistedExpansion %r (%r)>" % (self.local_name,
+                                               self.expansion)
+
+    def make_bytecode(self, symbol_table):
+        return (self.make_evaluate_bytecode(symbol_table)
+                + [Instr("LOAD_NAME", symbol_table["write_func"])]
+                + self.make_value_bytecode(symbol_table)
+                + [Instr("CALL_FUNCTION", 1),
+                   Instr("POP_TOP")])
+
+    def make_ast(self, symbol_table):
+        return (self.make_evaluate_ast(symbol_table)
+                + [_make_write_statement(
+                    symbol_table,
+                    self.make_value_ast(symbol_table))])
+
+    def make_evaluate_bytecode(self, symbol_table):
+        """Make the instructions that compute the value, unless it has
+        already been computed."""
+        computed = Label()
+        return ([Instr("LOAD_NAME", self.local_name),
+                 Instr("LOAD_GLOBAL", "_undefined"),
+                 Instr("COMPARE_OP", Compare.IS),
+                 Instr("POP_JUMP_IF_FALSE", computed)]
+                + self.expansion.make_value_bytecode(symbol_table)
+                + [Instr("STORE_NAME", self.local_name),
+                   computed])
+
+    def make_evaluate_ast(self, symbol_table):
+        return [ast.If(
+            ast.Compare(ast.Name(self.local_name, ast.Load()),
+                        [ast.Is()],
+                        [ast.Name("_undefined", ast.Load())]),
+            [ast.Assign([ast.Name(self.local_name, ast.Store())],
+                        self.expansion.make_value_ast(symbol_table))],
+            [])]
+
+    def make_value_bytecode(self, symbol_table):
+        return [Instr("LOAD_NAME", self.local_name)]
+
+    def make_value_ast(self, symbol_table):
+        return ast.Name(self.local_name, ast.Load())
+
+
+class WriteBatch:
+    """Writes the values of several literals and expansions to the
+    output with a single call.
+
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def __repr__(self):
+        return "<WriteBatch %r>" % self.parts
+
+    def make_bytecode(self, symbol_table):
+        instructions = []
+        for part in self._get_hoisted_parts():
+            instructions += part.make_evaluate_bytecode(symbol_table)
+
+        return instructions + symbol_table["output"].make_write_many_bytecode(
+            symbol_table["write_func"],
+            [part.make_value_bytecode(symbol_table)
+             for part in self.parts],
+            symbol_table.get("output_name", "_output"))
+
+    def make_ast(self, symbol_table):
+        statements = []
+        for part in self._get_hoisted_parts():
+            statements += part.make_evaluate_ast(symbol_table)
+
+        return statements + [symbol_table["output"].make_write_many_ast(
+            symbol_table["write_func"],
+            [part.make_value_ast(symbol_table)
+             for part in self.parts],
+            symbol_table.get("output_name", "_output"))]
+
+    def _get_hoisted_parts(self):
+        """The hoisted expansions in the batch, whose values need to
+        be computed before the batch is written."""
+        return [part for part in self.parts
+                if isinstance(part, HoistedExpansion)]
+
+
+class BlockSuper:
+    """The ``{{ block.super }}`` expansion, which includes the content of
+    the block that the enclosing block overrides.
+
+    This is replaced when an :py:class:`ExtendsBlock` is resolved, so
+    it only generates code (which outputs nothing) when it's used in
+    a template that doesn't extend another one.
+
+    """
+
+    def __eq__(self, other):
+        return isinstance(other, BlockSuper)
+
+    def __repr__(self):
+        return "<BlockSuper>"
+
+    def make_bytecode(self, symbol_table):
+        return []
+
+    def make_ast(self, symbol_table):
+        return []
+
+
+class FlushPoint:
+    """A flush point is a point in a template compiled in streaming
+    mode at which the output buffered so far is yielded, provided that
+    at least ``min_size`` characters (or bytes) have been buffered.
+
+    """
+
+    def __init__(self, min_size):
+        self.min_size = min_size
+
+    def __eq__(self, other):
+        if not isinstance(other, FlushPoint):
+            return False
+
+        return other.min_size == self.min_size
+
+    def __repr__(self):
+        return "<FlushPoint %r>" % self.min_size
+
+    def make_bytecode(self, symbol_table):
+        return symbol_table["output"].make_flush_bytecode(self.min_size)
+
+    def make_ast(self, symbol_table):
+        return ast.parse(
+            symbol_table["output"].flush_source(self.min_size)).body
 
 
 class Execution:
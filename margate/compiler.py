@@ -3,10 +3,116 @@
 """
 
 import re
-import io
-from bytecode import Bytecode, Instr
+import sys
+import dis
+import copy
+import types
+import inspect
+import os
+import marshal
+import builtins
+import multiprocessing
 
-from . import parser, block_parser
+from . import bytecode_cache, output, escaping, \
+    filters as filters_module, fragment_cache as fragment_cache_module
+
+# All the delimiters that move the block parser from one state to
+# another. This is compiled once and then used to make a single pass
+# over the template source.
+_delimiter_pattern = re.compile(r"\{\{|\}\}|\{%|%\}")
+
+
+def _lookahead(iterable):
+    """Iterate over pairs of a flag that says whether an item is the
+    last one and the item, reading one item ahead. This is used by
+    loops that refer to ``forloop.last``, so that they don't have to
+    find the length of the collection.
+
+    """
+    iterator = iter(iterable)
+    try:
+        item = next(iterator)
+    except StopIteration:
+        return
+
+    for next_item in iterator:
+        yield (False, item)
+        item = next_item
+
+    yield (True, item)
+
+
+async def _alookahead(iterable):
+    """The same as :py:func:`_lookahead`, for asynchronous
+    iterables."""
+    started = False
+    item = None
+    async for next_item in iterable:
+        if started:
+            yield (False, item)
+        item = next_item
+        started = True
+
+    if started:
+        yield (True, item)
+
+
+async def _aenumerate(iterable):
+    """The same as the builtin ``enumerate``, for asynchronous
+    iterables."""
+    index = 0
+    async for item in iterable:
+        yield (index, item)
+        index += 1
+
+
+def _sized(collection):
+    """Return a collection whose length can be found, for loops that
+    refer to ``forloop.length`` or ``forloop.revcounter``. Only
+    collections that don't already have a length are read into a list.
+
+    """
+    if hasattr(collection, "__len__"):
+        return collection
+    return list(collection)
+
+
+# The default of the arguments that hold template variables. The
+# template function deletes any argument that still holds it when it
+# starts, so that a variable that isn't passed in is only an error
+# (a NameError) if the template actually uses it.
+_undefined = object()
+
+# The globals of every template function. These are only used by the
+# code that sets up the output at the start of the function, by
+# autoescaping, by loops that need to track their position and by
+# async templates to recognise awaitable values; template variables
+# and builtins are all passed in as arguments.
+_template_globals = dict(output.RUNTIME_GLOBALS,
+                         _undefined=_undefined,
+                         _escape=escaping.escape,
+                         _isawaitable=inspect.isawaitable,
+                         _lookahead=_lookahead,
+                         _alookahead=_alookahead,
+                         _aenumerate=_aenumerate,
+                         _sized=_sized,
+                         __builtins__=builtins)
+
+# The name of the argument that collects any context variables that
+# the template doesn't refer to.
+_context_argument = "_context"
+
+# The code generation backends. The bytecode backend assembles
+# bytecode by hand, using instructions that were removed in Python
+# 3.8, so later versions use the backend that generates an abstract
+# syntax tree.
+BYTECODE_BACKEND = "bytecode"
+AST_BACKEND = "ast"
+
+if sys.version_info < (3, 8):
+    DEFAULT_BACKEND = BYTECODE_BACKEND
+else:
+    DEFAULT_BACKEND = AST_BACKEND
 
 
 class TemplateLocator:
@@ -19,71 +125,763 @@ class TemplateLocator:
         pass
 
 
+class DirectoryTemplateLocator(TemplateLocator):
+    """Locates templates by searching a list of directories in order,
+    in the same way as Django's filesystem template loader.
+
+    """
+
+    def __init__(self, directories):
+        self.directories = list(directories)
+
+    def find_template(self, template_name):
+        for directory in self.directories:
+            candidate = os.path.join(directory, template_name)
+            if os.path.isfile(candidate):
+                return candidate
+
+        return None
+
+
+def find_templates(directory, extensions=None):
+    """Find all the templates in a directory, recursively.
+
+    :return: An iterator over pairs of the template name (the path
+      relative to the directory, with ``/`` as the separator) and the
+      full path to the template.
+
+    """
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        dirnames[:] = sorted(name for name in dirnames
+                             if not name.startswith("."))
+
+        for filename in sorted(filenames):
+            if filename.startswith("."):
+                continue
+            if extensions \
+               and os.path.splitext(filename)[1] not in extensions:
+                continue
+
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, directory).replace(os.sep, "/")
+            yield (name, path)
+
+
+class Includer:
+    """Renders the templates that are included with a name that's
+    only known when the template is rendered, as in ``{% include
+    template_name %}``. Templates included with a literal name are
+    inlined when the including template is compiled instead.
+
+    The template function calls the includer with the name and its
+    local variables, and the included template is rendered with the
+    same variables. Variables whose names start with an underscore
+    are internal to the template function, and aren't passed on.
+
+    :param load: A function that takes the name of a template and
+      returns its template function. This is called for every
+      include, so it should cache the functions.
+
+    """
+
+    def __init__(self, load):
+        self._load = load
+
+    def __call__(self, template_name, variables):
+        context = dict(variables.get(_context_argument, ()))
+        for (name, value) in variables.items():
+            # Builtins are passed to the template function as
+            # arguments too.
+            if not name.startswith("_") \
+               and getattr(builtins, name, None) is not value:
+                context[name] = value
+
+        return self._load(template_name)(**context)
+
+
 class Compiler:
     """The Compiler takes a template in string form and returns bytecode
     that implements the template.
     """
 
-    def __init__(self, template_locator=None):
+    def __init__(self, template_locator=None, bytecode_cache=None,
+                 backend=None, output_strategy="list", optimise=True,
+                 filters=None, autoescape=True, include_loader=None,
+                 fragment_cache=None):
+        """
+        :param template_locator: Used to find other templates that are
+          referred to by the template being compiled.
+        :param bytecode_cache: An optional
+          :py:class:`~margate.bytecode_cache.BytecodeCache` in which
+          to store compiled templates, so that they don't need to be
+          compiled again by other processes.
+        :param str backend: The code generation backend to use, either
+          ``"bytecode"`` or ``"ast"``. The default depends on the
+          version of Python.
+        :param str output_strategy: How the template function
+          accumulates its output (see :py:mod:`margate.output`):
+          ``"list"`` (the default, which is the fastest in most
+          cases), ``"stringio"`` or ``"bytes"``. With ``"bytes"`` the
+          template function returns UTF-8 encoded ``bytes`` rather
+          than a string.
+        :param bool optimise: Whether to run the
+          :py:mod:`optimiser <margate.optimiser>` over the parse tree
+          before generating code.
+        :param dict filters: Custom :py:mod:`filters <margate.filters>`,
+          mapping the name used in templates to the filter function.
+          These are available in addition to the built-in filters,
+          and replace any built-in filter with the same name.
+        :param bool autoescape: Whether to escape the value of every
+          ``{{ }}`` expansion for HTML (see :py:mod:`margate.escaping`).
+        :param include_loader: A function that takes the name of a
+          template that's included with a dynamic name and returns its
+          template function (see :py:class:`Includer`). By default, the
+          template is found with the template locator and compiled by
+          this compiler the first time it's included, and the function
+          is kept for as long as the compiler.
+        :param fragment_cache: Where ``{% cache %}`` blocks keep their
+          output (see :py:mod:`margate.fragment_cache`). By default,
+          this is a new
+          :py:class:`~margate.fragment_cache.LocMemFragmentCache`,
+          which is shared by all the templates that the compiler
+          compiles.
+        """
         if template_locator is None:
             template_locator = TemplateLocator()
 
+        if backend is None:
+            backend = DEFAULT_BACKEND
+        if backend not in (BYTECODE_BACKEND, AST_BACKEND):
+            raise ValueError("Unknown backend '%s'" % backend)
+
         self._template_locator = template_locator
+        self._bytecode_cache = bytecode_cache
+        self._backend = backend
+        self._output_strategy = output.get_output_strategy(output_strategy)
+        self._optimise = optimise
+        self._filters = dict(filters or {})
+        self._autoescape = autoescape
+
+        self._included = {}
+        self.includer = Includer(include_loader or self._load_included)
+
+        if fragment_cache is None:
+            fragment_cache = fragment_cache_module.LocMemFragmentCache()
+        self.fragment_cache = fragment_cache
 
     def compile(self, source):
         """Compile the template source code into a callable function.
 
         :return: A callable function that returns rendered content as
-          a string when called.
+          a string when called. The template variables are passed to
+          the function as keyword arguments.
+        """
+        return make_template_function(*self._get_code(source),
+                                      filters=self._filters,
+                                      include=self.includer,
+                                      fragment_cache=self.fragment_cache)
+
+    def compile_stream(self, source, flush_size=8192, flush_at_blocks=True):
+        """Compile the template source code into a generator function
+        that yields the rendered content in chunks, for example to
+        pass to Django's ``StreamingHttpResponse``.
+
+        The output is buffered, and the buffer is yielded at flush
+        points in the template, so that the whole of the output
+        never needs to be held in memory at once.
+
+        :param int flush_size: At the end of each iteration of a
+          ``{% for %}`` loop, the buffer is yielded if it holds at
+          least this many characters. If this is ``None``, the buffer
+          is not flushed inside loops.
+        :param bool flush_at_blocks: Whether to yield the buffer at
+          the end of every ``{% block %}``.
+        :return: A generator function that takes the template
+          variables as keyword arguments. The chunks are strings, or
+          ``bytes`` if the compiler's output strategy is ``"bytes"``.
+        """
+        return make_template_function(
+            *self._get_code(source, streaming=(flush_size, flush_at_blocks)),
+            filters=self._filters,
+            include=self.includer,
+            fragment_cache=self.fragment_cache)
+
+    def compile_async(self, source):
+        """Compile the template source code into a coroutine function,
+        for rendering templates without blocking an event loop.
+
+        When the value of a ``{{ }}`` expression is awaitable, it is
+        awaited before it is included in the output. When the
+        collection of a ``{% for %}`` loop is awaitable it is awaited,
+        and when it is an asynchronous iterable it is iterated with
+        ``async for``.
+
+        Async templates are always generated with the AST backend,
+        whichever backend the compiler is configured with, and need
+        Python 3.6 or later.
+
+        :return: A coroutine function that takes the template
+          variables as keyword arguments and returns the rendered
+          content.
+        """
+        return make_template_function(*self._get_code(source, is_async=True),
+                                      filters=self._filters,
+                                      include=self.includer,
+                                      fragment_cache=self.fragment_cache)
+
+    def compile_block(self, source, block_name):
+        """Compile one ``{% block %}`` of a template into a function of
+        its own, which renders only that block, for example to send a
+        fragment of a page in response to a partial update.
+
+        The block can be defined in the template or in a template that
+        it extends. Only the code for the block is run, so any loop
+        variables that it uses must be passed to the function along
+        with the template variables.
+
+        :return: A callable function that returns the rendered content
+          of the block, in the same way as :py:meth:`compile`.
+        :raise Exception: If the template has no block with the name.
+        """
+        return make_template_function(
+            *self._get_code(source, block_name=block_name),
+            filters=self._filters,
+            include=self.includer,
+            fragment_cache=self.fragment_cache)
+
+    def _load_included(self, template_name):
+        function = self._included.get(template_name)
+
+        if function is None:
+            path = self._template_locator.find_template(template_name)
+            if not path:
+                raise FileNotFoundError(
+                    "Included template '%s' not found" % template_name)
+
+            with open(path) as template_file:
+                function = self.compile(template_file.read())
+            self._included[template_name] = function
+
+        return function
+
+    def _get_code(self, source, streaming=None, is_async=False,
+                  block_name=None):
+        """Get the code object for a template, from the bytecode cache
+        if there is one.
+
+        :return: A tuple of the code object and the templates that the
+          template extends.
+
+        """
+        if self._bytecode_cache is None:
+            return self._make_code(source, self._template_locator,
+                                   streaming, is_async, block_name)
+
+        key = self._bytecode_cache.get_key(
+            source, self._get_configuration(streaming, is_async, block_name))
+        entry = self._load_cached_code(key)
+
+        if entry is not None:
+            return entry
+        else:
+            (code, dependencies) = self._make_code(
+                source, self._template_locator, streaming, is_async,
+                block_name)
+
+            # The cache is only an optimisation, so failing to write
+            # to it (for example because it's been deployed to a
+            # read-only location) isn't an error.
+            try:
+                self._bytecode_cache.store(key, code, source, dependencies)
+            except OSError:
+                pass
+
+            return (code, dependencies)
+
+    def _get_configuration(self, streaming=None, is_async=False,
+                           block_name=None):
+        """Describe the settings that affect the generated code, for
+        use in bytecode cache keys.
+
         """
-        bytecode = self._make_bytecode(source, self._template_locator)
+        # Built-in filters are applied at compile time, but not when a
+        # custom filter has replaced them.
+        replaced_filters = sorted(name for name in self._filters
+                                  if name in filters_module.BUILTIN_FILTERS)
+
+        return ("backend=%s,output=%s,optimise=%s,streaming=%r,"
+                "async=%s,autoescape=%s,replaced_filters=%s,block=%r" % (
+                    self._backend,
+                    self._output_strategy.name,
+                    self._optimise,
+                    streaming,
+                    is_async,
+                    self._autoescape,
+                    ",".join(replaced_filters),
+                    block_name))
 
-        def inner(**local_scope):
-            local_scope["_output"] = io.StringIO()
-            exec(bytecode, {}, local_scope)
-            return local_scope['_output'].getvalue()
+    def _load_cached_code(self, key):
+        """Load a code object from the bytecode cache, provided that
+        none of the templates that it extends have changed since it
+        was compiled.
+
+        :return: A tuple of the code object and its dependencies, or
+          ``None``.
+
+        """
+        entry = self._bytecode_cache.load(key)
+        if entry is None:
+            return None
 
-        return inner
+        (code, dependencies) = entry
+
+        for (template_name, expected_hash) in dependencies:
+            template = self._template_locator.find_template(template_name)
+            if not template:
+                return None
+
+            try:
+                with open(template) as template_file:
+                    current_hash = bytecode_cache.source_hash(
+                        template_file.read())
+            except OSError:
+                return None
+
+            if current_hash != expected_hash:
+                return None
+
+        return entry
 
     def _get_chunks(self, source):
+        """Split the template source into a sequence of chunks (literal
+        text, expansions and execution blocks).
+
+        This makes a single pass over the source, and the block
+        parser states track offsets into the source rather than
+        copying the text that remains to be processed, so the time
+        taken is linear in the size of the template.
+
+        """
+        from . import block_parser
+
         state = block_parser.LiteralState(source)
 
-        while state:
-            match = re.search(r"\{\{|\}\}|\{%|%\}",
-                              state.text)
-            if match is None:
-                (state, chunk) = state.accept_end_input()
+        for match in _delimiter_pattern.finditer(source):
+            separator = match.group(0)
+
+            if separator == "{{":
+                action = state.accept_open_expression
+            elif separator == "}}":
+                action = state.accept_close_expression
+            elif separator == "{%":
+                action = state.accept_open_execution
+            elif separator == "%}":
+                action = state.accept_close_execution
             else:
-                separator = match.group(0)
-
-                if separator == "{{":
-                    action = state.accept_open_expression
-                elif separator == "}}":
-                    action = state.accept_close_expression
-                elif separator == "{%":
-                    action = state.accept_open_execution
-                elif separator == "%}":
-                    action = state.accept_close_execution
-                else:
-                    raise Exception("Unrecognised separator")
-
-                (state, chunk) = action(match.start(0),
-                                        len(match.group(0)))
+                raise Exception("Unrecognised separator")
+
+            (state, chunk) = action(match.start(0),
+                                    len(separator))
 
             yield chunk
 
-    def _make_bytecode(self, source, template_locator):
-        instructions = []
+        (state, chunk) = state.accept_end_input()
+        yield chunk
+
+    def _make_code(self, source, template_locator, streaming=None,
+                   is_async=False, block_name=None):
+        """Parse the template source and generate a code object for it.
+
+        :param streaming: ``None`` for a normal template function, or
+          a tuple of the flush size and whether to flush at blocks to
+          generate a streaming one (see :py:meth:`compile_stream`).
+        :param bool is_async: Whether to generate a coroutine function
+          (see :py:meth:`compile_async`).
+        :param str block_name: The block to generate code for, or
+          ``None`` for the whole template (see
+          :py:meth:`compile_block`).
+        :return: A tuple of the code object and the templates that the
+          template depends on, in the form used by the bytecode cache.
+
+        """
+        # These are imported here rather than at the top of the
+        # module, so that a process that loads all its templates from
+        # a bytecode cache never needs to import the parser or the
+        # bytecode library.
+        from . import parser, optimiser
+
+        # Generated code must only contain constants that can be
+        # marshalled, so that it can be stored in a bytecode cache. The
+        # symbol table gives the names under which runtime objects are
+        # made available to the code.
         symbol_table = {
-            "write_func": io.StringIO.write
+            "write_func": "_write",
+            "output": self._output_strategy,
+            "streaming": streaming is not None,
+            "async": is_async,
+            "autoescape": self._autoescape
         }
 
-        parser_obj = parser.Parser(self._template_locator)
+        parser_obj = parser.Parser(
+            template_locator,
+            template_id=bytecode_cache.source_hash(source))
         sequence = parser_obj.parse(self._get_chunks(source))
 
+        if block_name is not None:
+            from . import code_generation
+            sequence = code_generation.extract_block(sequence, block_name)
+
+        if streaming is not None:
+            sequence = _add_flush_points(sequence, *streaming)
+
+            # Streaming needs to know how much output is buffered,
+            # which the list strategy can't tell cheaply.
+            if not self._output_strategy.streamable:
+                symbol_table["output"] = output.StringIOOutput()
+
+        if self._optimise:
+            sequence = optimiser.optimise(sequence, self._filters,
+                                          self._autoescape)
+
+        if self._backend == AST_BACKEND or is_async:
+            code = self._make_ast_code(sequence, symbol_table)
+        else:
+            code = self._make_bytecode(sequence, symbol_table)
+
+        return (code, parser_obj.dependencies)
+
+    def _make_bytecode(self, sequence, symbol_table):
+        output_strategy = symbol_table["output"]
+
+        instructions = output_strategy.make_prologue_bytecode(
+            symbol_table["write_func"])
+
         for item in sequence.elements:
             instructions += item.make_bytecode(symbol_table)
 
-        bytecode = Bytecode(instructions + [Instr("LOAD_CONST", None),
-                                            Instr("RETURN_VALUE")])
+        if symbol_table["streaming"]:
+            instructions += output_strategy.make_stream_epilogue_bytecode()
+        else:
+            instructions += output_strategy.make_epilogue_bytecode()
+
+        return self._make_function_code(instructions)
+
+    def _make_ast_code(self, sequence, symbol_table):
+        """Generate the template function as an abstract syntax tree and
+        compile it with the Python compiler.
+
+        The arguments of the function are found the same way as in
+        :py:meth:`_make_function_code`. The function is first compiled
+        without any arguments. Every name that the Python compiler
+        resolves as a global (other than the names in the template
+        globals) becomes a keyword-only argument, as does every
+        template variable that the template assigns, such as a loop
+        variable.
+
+        """
+        statements = []
+        for item in sequence.elements:
+            statements += item.make_ast(symbol_table)
+
+        code = self._compile_function_ast(statements, [], symbol_table)
+
+        arguments = sorted(
+            {name for name in _get_global_names(code)
+             if name not in _template_globals}
+            | {name for name in code.co_varnames
+               if _is_template_variable(name)})
+
+        return self._compile_function_ast(statements, arguments,
+                                          symbol_table)
+
+    def _compile_function_ast(self, statements, arguments, symbol_table):
+        import ast
+
+        if arguments:
+            signature = "*, %s, **%s" % (", ".join(arguments),
+                                         _context_argument)
+        else:
+            signature = "**%s" % _context_argument
+
+        output_strategy = symbol_table["output"]
+        prologue = ast.parse(
+            "".join("if %s is _undefined:\n"
+                    "    del %s\n" % (name, name)
+                    for name in arguments
+                    if _is_template_variable(name))
+            + output_strategy.prologue_source(
+                symbol_table["write_func"])).body
+        if symbol_table["streaming"]:
+            epilogue = ast.parse(
+                output_strategy.stream_epilogue_source()).body
+        else:
+            epilogue = ast.parse(output_strategy.epilogue_source()).body
+
+        keyword = "async def" if symbol_table["async"] else "def"
+        module = ast.parse("%s template(%s):\n"
+                           "    pass\n" % (keyword, signature))
+
+        function_def = module.body[0]
+        function_def.body = prologue + statements + epilogue
+        ast.fix_missing_locations(module)
+
+        module_code = compile(module, filename="<template>", mode="exec")
+
+        for constant in module_code.co_consts:
+            if isinstance(constant, types.CodeType):
+                return constant
+
+    def _make_function_code(self, instructions):
+        """Turn the generated instructions into the code object for a
+        function.
+
+        The code generators refer to every variable with
+        ``LOAD_NAME`` and ``STORE_NAME``, which look the name up in a
+        dictionary. In the template function, all these become fast
+        locals instead. Any variable that the template reads but never
+        assigns becomes a keyword-only argument, as does any template
+        variable that it both reads and assigns (such as a loop
+        variable that has the same name as a context variable), and
+        the remaining context variables are collected by a ``**``
+        argument.
+
+        The template variables default to ``_undefined``, and the
+        function starts by deleting the ones that weren't passed in,
+        so that a variable is only needed if the template reaches the
+        code that uses it.
+
+        """
+        from bytecode import Bytecode, Instr, Label, Compare
+
+        loaded = set()
+        stored = set()
+        function_instructions = []
+        flags = (inspect.CO_OPTIMIZED
+                 | inspect.CO_NEWLOCALS
+                 | inspect.CO_VARKEYWORDS
+                 | inspect.CO_NOFREE)
+
+        for instr in instructions:
+            if isinstance(instr, Instr) and instr.name == "YIELD_VALUE":
+                flags |= inspect.CO_GENERATOR
+
+            if isinstance(instr, Instr) and instr.name == "LOAD_NAME":
+                loaded.add(instr.arg)
+                instr = Instr("LOAD_FAST", instr.arg, lineno=instr.lineno)
+            elif isinstance(instr, Instr) and instr.name == "STORE_NAME":
+                stored.add(instr.arg)
+                instr = Instr("STORE_FAST", instr.arg, lineno=instr.lineno)
+
+            function_instructions.append(instr)
+
+        arguments = sorted((loaded - stored)
+                           | {name for name in loaded & stored
+                              if _is_template_variable(name)})
+
+        prologue = []
+        for name in arguments:
+            if _is_template_variable(name):
+                passed = Label()
+                prologue += [Instr("LOAD_FAST", name),
+                             Instr("LOAD_GLOBAL", "_undefined"),
+                             Instr("COMPARE_OP", Compare.IS),
+                             Instr("POP_JUMP_IF_FALSE", passed),
+                             Instr("DELETE_FAST", name),
+                             passed]
+
+        bytecode = Bytecode(prologue + function_instructions)
+        bytecode.name = "template"
+        bytecode.filename = "<template>"
+        bytecode.argnames = arguments + [_context_argument]
+        bytecode.kwonlyargcount = len(arguments)
+        bytecode.flags = flags
+
         return bytecode.to_code()
+
+
+def make_template_function(code, dependencies=(), filters=None,
+                           include=None, fragment_cache=None):
+    """Make a template function from the code object generated by
+    the :py:class:`Compiler` (which may have been loaded from a
+    :py:mod:`bytecode cache <margate.bytecode_cache>`).
+
+    Any argument of the function that names a builtin (such as
+    ``str`` or ``len``) defaults to that builtin, so that builtins are
+    looked up once here rather than every time they're used. In the
+    same way, the arguments that hold :py:mod:`filters
+    <margate.filters>` default to the filter functions. The arguments
+    that hold template variables default to a marker that the function
+    removes when it starts, so that variables are optional. A variable
+    whose name starts with an underscore can't be told apart from the
+    names that the generated code uses itself, so it has no default,
+    and the template can't be rendered without it.
+
+    :param dependencies: The templates that the template extends,
+      directly or indirectly, as ``(template_name, source_hash)``
+      pairs. These are kept in the ``dependencies`` attribute of the
+      function, so that whoever caches the function can tell which
+      templates need to be recompiled when another one changes.
+    :param dict filters: The custom filters that the template may
+      use, in addition to the built-in ones.
+    :param include: The :py:class:`Includer` that renders templates
+      that the template includes with a dynamic name.
+    :param fragment_cache: Where the template's ``{% cache %}`` blocks
+      keep their output. If this isn't given, a new
+      :py:class:`~margate.fragment_cache.LocMemFragmentCache` is
+      made for the function.
+    :raise Exception: If the template uses a filter that doesn't
+      exist.
+
+    """
+    arguments = code.co_varnames[
+        code.co_argcount:code.co_argcount + code.co_kwonlyargcount]
+
+    defaults = {}
+    for name in arguments:
+        filter_name = filters_module.get_filter_name(name)
+        if filter_name is not None:
+            defaults[name] = filters_module.get_filter(filter_name, filters)
+        elif name == "_include" and include is not None:
+            defaults[name] = include
+        elif name == "_fragment_cache":
+            if fragment_cache is None:
+                fragment_cache = fragment_cache_module.LocMemFragmentCache()
+            defaults[name] = fragment_cache
+        elif hasattr(builtins, name):
+            defaults[name] = getattr(builtins, name)
+        elif _is_template_variable(name):
+            defaults[name] = _undefined
+
+    function = types.FunctionType(code, _template_globals, code.co_name)
+    function.__kwdefaults__ = defaults
+    function.dependencies = list(dependencies)
+
+    return function
+
+
+def render_many(template_function, contexts, processes=None,
+                chunk_size=64):
+    """Render a template function with each of a sequence of
+    contexts, for example to render the same email for many
+    recipients.
+
+    The results are yielded in the same order as the contexts, as soon
+    as they're available, so that they never all need to be held in
+    memory at once.
+
+    :param contexts: An iterable of dictionaries of template
+      variables.
+    :param int processes: If this is given, the templates are rendered
+      in a pool of this many worker processes. Each worker makes its
+      own template function from the marshalled code object when it
+      starts, so only the contexts and the results are sent between
+      processes, and both must be picklable, as must any custom
+      filters. Templates that include other templates by a dynamic
+      name can't be rendered in a pool, and ``{% cache %}`` blocks use
+      a fragment cache in each worker.
+    :param int chunk_size: The number of contexts sent to a worker at
+      a time.
+    """
+    if processes is None:
+        for context in contexts:
+            yield template_function(**context)
+        return
+
+    defaults = template_function.__kwdefaults__ or {}
+    if "_include" in defaults:
+        raise ValueError("Templates that include other templates by a "
+                         "dynamic name can't be rendered in a process pool")
+
+    filters = {filters_module.get_filter_name(name): function
+               for (name, function) in defaults.items()
+               if filters_module.get_filter_name(name) is not None}
+
+    with multiprocessing.Pool(processes,
+                              _start_render_worker,
+                              (marshal.dumps(template_function.__code__),
+                               filters)) as pool:
+        yield from pool.imap(_render_in_worker, contexts, chunk_size)
+
+
+# The template function of a render_many() worker process.
+_worker_function = None
+
+
+def _start_render_worker(code_data, filters):
+    global _worker_function
+    _worker_function = make_template_function(marshal.loads(code_data),
+                                              filters=filters)
+
+
+def _render_in_worker(context):
+    return _worker_function(**context)
+
+
+def _add_flush_points(sequence, flush_size, flush_at_blocks):
+    """Return a copy of a parse tree with flush points added at the
+    end of the body of every loop and every block (other than those
+    in macros), for streaming.
+
+    """
+    from . import code_generation
+
+    result = code_generation.Sequence()
+
+    for element in sequence.elements:
+        # Macros are functions of their own, which can't yield the
+        # output, and the output of a cached fragment is only written
+        # when it's complete.
+        if hasattr(element, "sequence") \
+           and not isinstance(element, (code_generation.MacroBlock,
+                                        code_generation.CacheBlock)):
+            element = copy.copy(element)
+            element.sequence = _add_flush_points(element.sequence,
+                                                 flush_size,
+                                                 flush_at_blocks)
+
+            if isinstance(element, code_generation.ExtendsBlock):
+                element.template = _add_flush_points(element.template,
+                                                     flush_size,
+                                                     flush_at_blocks)
+            elif isinstance(element, code_generation.ForBlock):
+                element.empty_sequence = _add_flush_points(
+                    element.empty_sequence,
+                    flush_size,
+                    flush_at_blocks)
+                if flush_size is not None:
+                    element.sequence.add_element(
+                        code_generation.FlushPoint(flush_size))
+            elif isinstance(element, code_generation.ReplaceableBlock) \
+                    and flush_at_blocks:
+                element.sequence.add_element(
+                    code_generation.FlushPoint(1))
+
+        result.add_element(element)
+
+    return result
+
+
+def _is_template_variable(name):
+    """Whether a variable in a template function holds a template
+    variable, rather than something that the generated code uses
+    itself (those names all start with an underscore)."""
+    return not name.startswith("_")
+
+
+def _get_global_names(code):
+    """Find all the names that are loaded as globals by a code object
+    or by any of the code objects nested inside it (such as those for
+    comprehensions).
+
+    """
+    names = set()
+
+    for instr in dis.get_instructions(code):
+        if instr.opname == "LOAD_GLOBAL":
+            names.add(instr.argval)
+
+    for constant in code.co_consts:
+        if isinstance(constant, types.CodeType):
+            names |= _get_global_names(constant)
+
+    return names
@@ -2,12 +2,25 @@
 Code for interfacing Margate with Django
 """
 
-from django.template import TemplateDoesNotExist
+import os.path
+import marshal
+import hashlib
+import concurrent.futures
+
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from django.template import TemplateDoesNotExist, Origin
 from django.template.utils import get_app_template_dirs
 from django.template.loaders.filesystem import Loader as DjangoFileSystemLoader
 from django.template.backends.base import BaseEngine
 
-from margate.compiler import Compiler
+from margate.compiler import (Compiler, DirectoryTemplateLocator,
+                              find_templates, make_template_function,
+                              render_many)
+from margate.bytecode_cache import BytecodeCache, source_hash
+from margate.template_cache import TemplateCache, DependencyGraph
+from margate.template_index import TemplateIndex
+from margate.fragment_cache import FragmentCache, LocMemFragmentCache
 
 
 class MargateLoader(DjangoFileSystemLoader):
@@ -15,16 +28,45 @@ class MargateLoader(DjangoFileSystemLoader):
         return get_app_template_dirs('margate')
 
 
+class DjangoFragmentCache(FragmentCache):
+    """A fragment cache that keeps the output of ``{% cache %}``
+    blocks in one of Django's caches (as configured in the ``CACHES``
+    setting), so that it can be shared between processes.
+
+    Fragment keys can be any value with a stable ``repr``, so they are
+    hashed to make the keys used in the Django cache.
+
+    :param str alias: The name of the Django cache to use.
+    :param str key_prefix: The prefix of the keys in the Django cache.
+
+    """
+
+    def __init__(self, alias="default", key_prefix="margate.fragment"):
+        self.cache = caches[alias]
+        self.key_prefix = key_prefix
+
+    def get(self, key):
+        return self.cache.get(self._make_key(key))
+
+    def set(self, key, value, ttl=None):
+        self.cache.set(self._make_key(key), value, ttl)
+
+    def clear(self):
+        """Clear the Django cache. Note that this removes everything in
+        it, not only the fragments."""
+        self.cache.clear()
+
+    def _make_key(self, key):
+        return "%s:%s" % (self.key_prefix,
+                          hashlib.sha1(repr(key).encode("utf-8")).hexdigest())
+
+
 class MargateEngine(BaseEngine):
     app_dirname = "margate"
 
     def __init__(self, params):
         params = params.copy()
-
-        try:
-            params.pop('OPTIONS')
-        except KeyError:
-            pass
+        options = params.pop('OPTIONS', {})
 
         super(MargateEngine, self).__init__(params)
 
@@ -33,35 +75,338 @@ class MargateEngine(BaseEngine):
         self.debug = False
         self.template_libraries = []
         self.template_builtins = []
-        self.cache = {}
 
-    def get_template(self, template_name):
-        if template_name in self.cache:
-            return self.cache[template_name]
+        # Templates are found through an index of the template
+        # directories rather than by searching them for every lookup.
+        self.template_locator = TemplateIndex(
+            self.loader.get_dirs(),
+            check_interval=options.get('template_check_interval', 2.0))
+
+        # Compiled templates are kept in a bounded LRU cache. Whether a
+        # template has changed is checked (by its modification time,
+        # or by a hash of its contents) at most once every
+        # template_check_interval seconds.
+        check_method = options.get('template_check_method', 'mtime')
+        if check_method not in self._fingerprint_methods:
+            raise ValueError("Unknown template check method '%s'"
+                             % check_method)
+        self._fingerprint_template = getattr(
+            self, self._fingerprint_methods[check_method])
+        self.cache = TemplateCache(
+            max_size=options.get('template_cache_size', 1000),
+            check_interval=options.get('template_check_interval', 2.0),
+            fingerprint=self._get_fingerprint)
+
+        # The templates that each cached template extends, and the
+        # fingerprints of those templates when they were last seen.
+        self.dependency_graph = DependencyGraph()
+        self._ancestor_fingerprints = {}
+
+        # If a bytecode cache directory is configured, compiled
+        # templates are shared between processes through it.
+        bytecode_cache_dir = options.get('bytecode_cache_dir')
+        if bytecode_cache_dir is not None:
+            self.bytecode_cache = BytecodeCache(bytecode_cache_dir)
         else:
-            compiler = Compiler()
-            template_func = compiler.compile(self.find_template(template_name))
-            template = Template(template_func)
-            self.cache[template_name] = template
-            return template
+            self.bytecode_cache = None
+
+        self.backend = options.get('backend')
+        self.output_strategy = options.get('output_strategy', 'list')
+        self.optimise = options.get('optimise', True)
+        self.stream_flush_size = options.get('stream_flush_size', 8192)
+        self.autoescape = options.get('autoescape', True)
+
+        # Custom filters, in addition to the built-in ones. More can be
+        # added with register_filter().
+        self.filters = dict(options.get('filters', {}))
+
+        # The output of {% cache %} blocks. The fragment_cache option
+        # is either a fragment cache or the dotted path of a class,
+        # which is made with the fragment_cache_options.
+        fragment_cache = options.get('fragment_cache')
+        if fragment_cache is None:
+            fragment_cache = LocMemFragmentCache
+        if isinstance(fragment_cache, str):
+            fragment_cache = import_string(fragment_cache)
+        if isinstance(fragment_cache, type):
+            fragment_cache = fragment_cache(
+                **options.get('fragment_cache_options', {}))
+        self.fragment_cache = fragment_cache
+
+        if options.get('warm_up', False):
+            self.warm_up()
+
+    _fingerprint_methods = {
+        'mtime': '_get_template_mtime',
+        'hash': '_get_template_hash'
+    }
+
+    def get_template(self, template_name):
+        return self.cache.get(template_name, self._load_template)
+
+    def invalidate(self, template_name):
+        """Remove a template from the cache, together with every
+        template that extends it, so that they're recompiled the next
+        time they're used.
+
+        """
+        self.cache.invalidate(template_name)
+        for descendant in self.dependency_graph.get_descendants(
+                template_name):
+            self.cache.invalidate(descendant)
+
+    def register_filter(self, name, function):
+        """Make a custom filter available to templates, as in
+        ``{{ value|name }}`` or ``{{ value|name:argument }}``.
+
+        The filter function is called with the value, and with the
+        argument if one is given. A custom filter replaces any
+        built-in filter with the same name.
+
+        Templates that have already been compiled are dropped from the
+        cache, since they were compiled without the filter.
+
+        """
+        self.filters[name] = function
+        self.cache.clear()
+
+    def warm_up(self, processes=None, extensions=None):
+        """Compile every template in the template directories and add
+        them to the cache, so that no request has to wait for a
+        template to be compiled.
+
+        The templates are compiled in parallel in a pool of worker
+        processes, which send the compiled code back marshalled. This
+        is run when the engine is created if the ``warm_up`` option is
+        set.
+
+        :param int processes: The number of worker processes. The
+          default is the number of CPUs.
+        :param extensions: If given, only files with these extensions
+          (for example ``[".html"]``) are compiled.
+        :return: The names of the templates that failed to compile.
+          These aren't cached, so the error is raised again when the
+          template is used.
+
+        """
+        directories = self.template_locator.directories
+
+        template_names = []
+        for directory in directories:
+            for (name, _) in find_templates(directory, extensions):
+                if name not in template_names:
+                    template_names.append(name)
+
+        # Filter functions may not be picklable, and the workers only
+        # need to know which filters are custom ones, so that they
+        # aren't applied at compile time.
+        options = dict(self._get_compiler_options(),
+                       filters=dict.fromkeys(self.filters))
+        compiler = self._make_compiler()
+        failed = []
+
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            jobs = []
+            for name in template_names:
+                fingerprint = self._get_fingerprint(name)
+                source = self.find_template(name)
+                future = executor.submit(_compile_template,
+                                         source, directories, options)
+                jobs.append((name, fingerprint, source, future))
+
+            for (name, fingerprint, source, future) in jobs:
+                try:
+                    (code_data, dependencies) = future.result()
+                except Exception:
+                    failed.append(name)
+                    continue
+
+                try:
+                    template_func = make_template_function(
+                        marshal.loads(code_data), dependencies,
+                        self.filters, compiler.includer,
+                        compiler.fragment_cache)
+                except Exception:
+                    failed.append(name)
+                    continue
+
+                self.cache.set(name,
+                               self._make_template(name, source, compiler,
+                                                   template_func),
+                               fingerprint)
+
+        return failed
+
+    def _get_compiler_options(self):
+        return {
+            "bytecode_cache": self.bytecode_cache,
+            "backend": self.backend,
+            "output_strategy": self.output_strategy,
+            "optimise": self.optimise,
+            "filters": self.filters,
+            "autoescape": self.autoescape
+        }
+
+    def _make_compiler(self):
+        return Compiler(self.template_locator,
+                        include_loader=self._get_included_function,
+                        fragment_cache=self.fragment_cache,
+                        **self._get_compiler_options())
+
+    def _get_included_function(self, template_name):
+        """Find the template function for a template that's included
+        with a dynamic name, through the cache, so that it's
+        recompiled when it changes."""
+        return self.get_template(template_name).template_func
+
+    def _load_template(self, template_name):
+        source = self.find_template(template_name)
+        compiler = self._make_compiler()
+        return self._make_template(template_name, source, compiler,
+                                   compiler.compile(source))
+
+    def _make_template(self, template_name, source, compiler,
+                       template_func):
+        """Make the template object for a compiled template, and record
+        the templates that it extends."""
+        ancestors = [name for (name, _) in template_func.dependencies]
+        self.dependency_graph.set_ancestors(template_name, ancestors)
+        for ancestor in ancestors:
+            if ancestor not in self._ancestor_fingerprints:
+                self._ancestor_fingerprints[ancestor] = \
+                    self._fingerprint_template(ancestor)
+
+        return Template(
+            template_func,
+            lambda: compiler.compile_stream(source,
+                                            self.stream_flush_size),
+            lambda: compiler.compile_async(source),
+            lambda block_name: compiler.compile_block(source, block_name))
+
+    def _get_fingerprint(self, template_name):
+        """Find the fingerprint of a template for the template cache.
+
+        This also checks the templates that it extends, and when one
+        of them has changed, invalidates every template that extends
+        it (including this one).
+
+        """
+        for ancestor in self.dependency_graph.get_ancestors(template_name):
+            fingerprint = self._fingerprint_template(ancestor)
+            if fingerprint != self._ancestor_fingerprints.get(ancestor):
+                self._ancestor_fingerprints[ancestor] = fingerprint
+                self.invalidate(ancestor)
+
+        return self._fingerprint_template(template_name)
+
+    def _get_template_mtime(self, template_name):
+        path = self.template_locator.find_template(template_name)
+        if path is None:
+            return None
+        try:
+            return (path, os.stat(path).st_mtime_ns)
+        except OSError:
+            return None
+
+    def _get_template_hash(self, template_name):
+        path = self.template_locator.find_template(template_name)
+        if path is None:
+            return None
+        try:
+            with open(path, encoding=self.file_charset) as template_file:
+                return (path, source_hash(template_file.read()))
+        except OSError:
+            return None
 
     def find_template(self, name):
-        tried = []
+        path = self.template_locator.find_template(name)
+        if path is None:
+            # The index has already ruled out every directory, so this
+            # only lists the places that were searched, for the
+            # debugging information in the error.
+            tried = [(Origin(os.path.join(directory, name), name, self.loader),
+                      'Source does not exist')
+                     for directory in self.template_locator.directories]
+            raise TemplateDoesNotExist(name, tried=tried, backend=self)
+
+        with open(path, encoding=self.file_charset) as template_file:
+            return template_file.read()
+
 
-        for source in self.loader.get_template_sources(name):
-            try:
-                contents = self.loader.get_contents(source)
-            except TemplateDoesNotExist:
-                tried.append((source, 'Source does not exist'))
-            else:
-                return contents
+def _compile_template(source, directories, options):
+    """Compile a template in a worker process for
+    :py:meth:`MargateEngine.warm_up`.
 
-        raise TemplateDoesNotExist(name, tried=tried)
+    :return: The marshalled code object, and the dependencies of the
+      template.
+
+    """
+    compiler = Compiler(DirectoryTemplateLocator(directories), **options)
+    (code, dependencies) = compiler._get_code(source)
+    return (marshal.dumps(code), dependencies)
 
 
 class Template:
-    def __init__(self, template_func):
+    def __init__(self, template_func, stream_compiler=None,
+                 async_compiler=None, block_compiler=None):
         self.template_func = template_func
 
+        # The streaming and async versions of the template are only
+        # compiled the first time they're needed.
+        self._stream_compiler = stream_compiler
+        self._stream_func = None
+        self._async_compiler = async_compiler
+        self._async_func = None
+        self._block_compiler = block_compiler
+        self._block_funcs = {}
+
     def render(self, context=None, request=None):
         return self.template_func(**context)
+
+    def render_many(self, contexts, processes=None):
+        """Render the template with each of an iterable of contexts,
+        yielding the results in order (see
+        :py:func:`margate.compiler.render_many`).
+
+        :param int processes: If given, the templates are rendered in a
+          pool of this many worker processes.
+
+        """
+        return render_many(self.template_func, contexts, processes)
+
+    def render_block(self, block_name, context=None, request=None):
+        """Render only one ``{% block %}`` of the template, for example
+        to respond to a partial page update. The block can be one that
+        the template inherits.
+
+        Each block is compiled into a function of its own the first
+        time it's rendered, which runs only the code for that block.
+
+        """
+        block_func = self._block_funcs.get(block_name)
+        if block_func is None:
+            block_func = self._block_compiler(block_name)
+            self._block_funcs[block_name] = block_func
+
+        return block_func(**(context or {}))
+
+    def stream(self, context=None, request=None):
+        """Render the template as an iterator over chunks of output,
+        which can be passed to a ``StreamingHttpResponse``.
+
+        """
+        if self._stream_func is None:
+            self._stream_func = self._stream_compiler()
+
+        return self._stream_func(**(context or {}))
+
+    async def render_async(self, context=None, request=None):
+        """Render the template without blocking the event loop, for use
+        in an ASGI application. Any awaitable values in the context are
+        awaited as the template is rendered.
+
+        """
+        if self._async_func is None:
+            self._async_func = self._async_compiler()
+
+        return await self._async_func(**(context or {}))
@@ -0,0 +1,68 @@
+"""HTML escaping for autoescaped templates.
+
+When autoescaping is on (which it is by default), the value of every
+``{{ }}`` expansion is passed through :py:func:`escape` before it's
+written. This is on the path of every expansion, so it tries to do as
+little as possible for the common cases:
+
+* A plain string is only copied if it contains one of the characters
+  that need escaping, which is found with a few substring tests
+  rather than a regular expression.
+* Integers and floats can't contain any of these characters, so they
+  are converted without being scanned.
+* A value that has an ``__html__`` method (as Django's ``SafeString``
+  and :py:class:`SafeString` do) is already safe, and is included
+  as it is.
+
+"""
+
+
+class SafeString(str):
+    """A string that has already been escaped, or is known to be safe
+    to include in HTML, so it's not escaped again.
+
+    """
+
+    def __html__(self):
+        return self
+
+
+def mark_safe(value):
+    """Mark a string as safe to include in HTML without escaping."""
+    if hasattr(value, "__html__"):
+        return value
+    return SafeString(value)
+
+
+def escape(value):
+    """Convert a value to a string that is safe to include in HTML.
+
+    :return: The string, with ``&``, ``<``, ``>``, ``"`` and ``'``
+      replaced by character references, unless it's already safe.
+
+    """
+    # The exact type is checked first, since subclasses of str may be
+    # safe strings.
+    value_type = type(value)
+    if value_type is not str:
+        if value_type is int or value_type is float:
+            return str(value)
+
+        html = getattr(value, "__html__", None)
+        if html is not None:
+            return html()
+
+        value = str(value)
+
+    # Testing for each character separately is much faster than
+    # searching with a regular expression, and most strings contain
+    # none of them.
+    if "&" in value or "<" in value or ">" in value \
+       or '"' in value or "'" in value:
+        return (value.replace("&", "&amp;")
+                .replace("<", "&lt;")
+                .replace(">", "&gt;")
+                .replace('"', "&quot;")
+                .replace("'", "&#39;"))
+
+    return value
@@ -0,0 +1,173 @@
+"""Filters transform the value of an expansion before it is written
+to the output, as in ``{{ title|lower|truncatechars:30 }}``.
+
+A filter is a function that takes the value and, optionally, a single
+argument (given after a ``:``). The filters in a template are found
+when it's compiled, and each becomes an argument of the template
+function that defaults to the filter function, so the filters are
+called directly, as fast locals, rather than looked up by name while
+the template is rendered.
+
+The built-in filters are a subset of Django's. Custom filters can be
+passed to the :py:class:`~margate.compiler.Compiler`, or registered
+with :py:meth:`MargateEngine.register_filter
+<margate.django.MargateEngine.register_filter>`. The built-in filters
+have no side effects, so when the value and arguments are constants,
+the :py:mod:`optimiser <margate.optimiser>` applies them when the
+template is compiled. Custom filters are always applied at render
+time.
+
+"""
+
+from . import escaping
+
+# Filters are passed to the template function as arguments with this
+# prefix, so that they can't clash with template variables.
+_ARGUMENT_PREFIX = "_filter_"
+
+
+def filter_argument_name(filter_name):
+    """Return the name of the template function argument that holds a
+    filter."""
+    return _ARGUMENT_PREFIX + filter_name
+
+
+def get_filter_name(argument_name):
+    """Return the name of the filter held in a template function
+    argument, or ``None`` if the argument isn't a filter."""
+    if argument_name.startswith(_ARGUMENT_PREFIX):
+        return argument_name[len(_ARGUMENT_PREFIX):]
+    return None
+
+
+def add(value, argument):
+    try:
+        return int(value) + int(argument)
+    except (ValueError, TypeError):
+        try:
+            return value + argument
+        except Exception:
+            return ""
+
+
+def capfirst(value):
+    value = str(value)
+    return value[:1].upper() + value[1:]
+
+
+def cut(value, argument):
+    return str(value).replace(argument, "")
+
+
+def default(value, argument):
+    return value or argument
+
+
+def default_if_none(value, argument):
+    return argument if value is None else value
+
+
+def escape(value):
+    """Escape a value for HTML, even if the template isn't
+    autoescaped."""
+    return escaping.SafeString(escaping.escape(value))
+
+
+def first(value):
+    try:
+        return value[0]
+    except IndexError:
+        return ""
+
+
+def join(value, argument):
+    return argument.join(str(item) for item in value)
+
+
+def last(value):
+    try:
+        return value[-1]
+    except IndexError:
+        return ""
+
+
+def length(value):
+    try:
+        return len(value)
+    except (ValueError, TypeError):
+        return 0
+
+
+def lower(value):
+    return str(value).lower()
+
+
+def safe(value):
+    """Mark a value as safe to include in an autoescaped template
+    without escaping it."""
+    return escaping.mark_safe(str(value))
+
+
+def title(value):
+    return str(value).title()
+
+
+def truncatechars(value, argument):
+    """Truncate a string to at most ``argument`` characters, including
+    the ellipsis that marks where it was truncated."""
+    value = str(value)
+    argument = int(argument)
+
+    if len(value) <= argument:
+        return value
+    return value[:max(argument - 1, 0)] + "\u2026"
+
+
+def truncatewords(value, argument):
+    words = str(value).split()
+    argument = int(argument)
+
+    if len(words) <= argument:
+        return " ".join(words)
+    return " ".join(words[:argument] + ["\u2026"])
+
+
+def upper(value):
+    return str(value).upper()
+
+
+BUILTIN_FILTERS = {
+    "add": add,
+    "capfirst": capfirst,
+    "cut": cut,
+    "default": default,
+    "default_if_none": default_if_none,
+    "escape": escape,
+    "first": first,
+    "join": join,
+    "last": last,
+    "length": length,
+    "lower": lower,
+    "safe": safe,
+    "title": title,
+    "truncatechars": truncatechars,
+    "truncatewords": truncatewords,
+    "upper": upper
+}
+
+
+def get_filter(filter_name, filters=None):
+    """Find a filter function by name.
+
+    :param filters: Custom filters, which take precedence over the
+      built-in ones.
+    :raise Exception: If there's no filter with the name.
+
+    """
+    if filters and filter_name in filters:
+        return filters[filter_name]
+
+    try:
+        return BUILTIN_FILTERS[filter_name]
+    except KeyError:
+        raise Exception("Unknown filter '%s'" % filter_name)
@@ -0,0 +1,105 @@
+"""Fragment caches hold the rendered output of ``{% cache %}`` blocks.
+
+A ``{% cache key ttl=ttl %}`` block looks up the value of ``key`` in the
+fragment cache. If it's there, the stored output is written and the
+body of the block isn't rendered at all. Otherwise, the body is
+rendered into a buffer of its own, and the result is written and
+stored for ``ttl`` seconds (or until it's evicted, if ``ttl`` is
+``None``).
+
+The fragment cache is shared by all the templates that a compiler
+compiles, so the value of the key is paired with an ID for the
+``{% cache %}`` block (made from a hash of the source of the template
+that it's in and its position there). The key only needs to tell
+apart the different outputs of one block, for example by including
+the user that it's rendered for. Since the ID changes when the
+template does, output rendered by an old version of a template isn't
+used by the new one.
+
+Any object with the methods of :py:class:`FragmentCache` can be used
+as the fragment cache, so the output can be shared between processes
+(see :py:class:`margate.django.DjangoFragmentCache`). The default is a
+:py:class:`LocMemFragmentCache`, which is local to the process.
+
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class FragmentCache:
+    """The interface of fragment caches."""
+
+    def get(self, key):
+        """Return the output stored for a key, or ``None`` if there
+        isn't any, or it has expired."""
+        raise NotImplementedError()
+
+    def set(self, key, value, ttl=None):
+        """Store the output for a key.
+
+        :param float ttl: The number of seconds to keep the output for,
+          or ``None`` to keep it until it's evicted.
+
+        """
+        raise NotImplementedError()
+
+    def clear(self):
+        """Remove all the stored output."""
+        raise NotImplementedError()
+
+
+class LocMemFragmentCache(FragmentCache):
+    """A thread-safe fragment cache in the memory of the process. When
+    it's full, the least recently used fragment is evicted.
+
+    :param int max_size: The maximum number of fragments, or ``None``
+      for no limit.
+    :param clock: The function used to find the current time.
+
+    """
+
+    def __init__(self, max_size=1000, clock=time.monotonic):
+        if max_size is not None and max_size < 1:
+            raise ValueError("The fragment cache size must be at least 1")
+
+        self.max_size = max_size
+        self._clock = clock
+
+        # Maps keys to pairs of the time the fragment expires (or
+        # None) and the fragment.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            (expires, value) = entry
+            if expires is not None and self._clock() >= expires:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = None if ttl is None else self._clock() + ttl
+
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+
+            if self.max_size is not None:
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,160 @@
+"""The optimiser rewrites the parse tree produced by the
+:py:class:`~margate.parser.Parser` before code is generated from it, so
+that the template function does less work when it is rendered.
+
+It makes the following changes:
+
+* ``{% extends %}`` blocks are resolved into the root template's
+  elements, with the blocks overridden at each level of inheritance
+  substituted in, and ``{% block %}`` nodes are replaced by their
+  contents. This doesn't change the generated code by itself, but it
+  lets literals on either side of a block boundary be merged.
+* The contents of templates included with ``{% include %}`` are
+  merged into the including template.
+* ``{% if %}`` blocks whose condition is a literal (such as ``True``
+  or ``0``) are replaced by their contents, or removed entirely.
+* Expansions of a constant (such as ``{{ "news"|upper }}``) that only
+  use built-in :py:mod:`filters <margate.filters>` with constant
+  arguments are replaced by the literal result.
+* Adjacent literals are merged into a single literal, and empty
+  literals are removed, so that the template makes fewer calls to
+  write its output.
+
+The optimiser never modifies the tree it is given, since parsed
+templates may be shared.
+
+"""
+
+import ast
+import copy
+
+from .code_generation import (Sequence, Literal, IfBlock, ExtendsBlock,
+                              ReplaceableBlock, ForBlock, VariableExpansion,
+                              IncludeBlock)
+from .filters import BUILTIN_FILTERS
+from .escaping import escape
+
+# Returned by _get_constant_condition when a condition isn't constant.
+_NOT_CONSTANT = object()
+
+
+def optimise(sequence, filters=None, autoescape=False):
+    """Optimise a parse tree.
+
+    :param sequence: A :py:class:`~margate.code_generation.Sequence`
+      as returned by the parser.
+    :param filters: The custom filters that the template is compiled
+      with. Built-in filters that these replace aren't applied at
+      compile time.
+    :param bool autoescape: Whether the template is autoescaped, so
+      that the values of expansions that are applied at compile time
+      must be escaped too.
+    :return: A new, optimised sequence.
+
+    """
+    result = Sequence()
+    pending_literals = []
+
+    for element in _flatten(sequence.elements, filters or {}, autoescape):
+        if isinstance(element, Literal):
+            pending_literals.append(element.contents)
+            continue
+
+        _add_literal(result, pending_literals)
+        pending_literals = []
+        result.add_element(element)
+
+    _add_literal(result, pending_literals)
+
+    return result
+
+
+def _add_literal(sequence, literals):
+    contents = "".join(literals)
+    if contents:
+        sequence.add_element(Literal(contents))
+
+
+def _flatten(elements, filters, autoescape):
+    """Iterate over the elements of a sequence, replacing any element
+    that can be resolved at compile time with the elements it
+    contains.
+
+    """
+    for element in elements:
+        if isinstance(element, ExtendsBlock):
+            yield from _flatten(_resolve_extends(element), filters, autoescape)
+        elif isinstance(element, (ReplaceableBlock, IncludeBlock)):
+            yield from _flatten(element.sequence.elements, filters, autoescape)
+        elif isinstance(element, IfBlock):
+            condition = _get_constant_condition(element.condition)
+
+            if condition is _NOT_CONSTANT:
+                yield _optimise_block(element, filters, autoescape)
+            elif condition:
+                yield from _flatten(element.sequence.elements,
+                                    filters,
+                                    autoescape)
+        elif isinstance(element, VariableExpansion) and element.filters:
+            yield _apply_constant_filters(element, filters, autoescape)
+        elif hasattr(element, "sequence"):
+            yield _optimise_block(element, filters, autoescape)
+        else:
+            yield element
+
+
+def _resolve_extends(extends_block):
+    """Return the elements of the root template of an inheritance
+    chain, with the overridden blocks substituted in (see
+    :py:meth:`ExtendsBlock.resolve
+    <margate.code_generation.ExtendsBlock.resolve>`).
+
+    """
+    return extends_block.resolve().elements
+
+
+def _optimise_block(block, filters, autoescape):
+    optimised = copy.copy(block)
+    optimised.sequence = optimise(block.sequence, filters, autoescape)
+    if isinstance(block, ForBlock):
+        optimised.empty_sequence = optimise(block.empty_sequence,
+                                            filters,
+                                            autoescape)
+    return optimised
+
+
+def _apply_constant_filters(expansion, filters, autoescape):
+    """Replace an expansion of a constant with a literal, if it only
+    uses built-in filters and their arguments are constants.
+
+    """
+    try:
+        value = ast.literal_eval(expansion.variable_name.strip())
+        arguments = [() if argument is None
+                     else (ast.literal_eval(argument),)
+                     for (_, argument) in expansion.filters]
+    except (ValueError, TypeError, SyntaxError):
+        return expansion
+
+    for ((name, _), argument) in zip(expansion.filters, arguments):
+        if name in filters or name not in BUILTIN_FILTERS:
+            return expansion
+
+        # If the filter fails, the error is left to be raised when the
+        # template is rendered.
+        try:
+            value = BUILTIN_FILTERS[name](value, *argument)
+        except Exception:
+            return expansion
+
+    if autoescape:
+        return Literal(escape(value))
+    else:
+        return Literal(str(value))
+
+
+def _get_constant_condition(condition):
+    try:
+        return bool(ast.literal_eval(condition))
+    except (ValueError, TypeError, SyntaxError):
+        return _NOT_CONSTANT
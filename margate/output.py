@@ -0,0 +1,345 @@
+"""Output strategies control how a template function accumulates its
+output and what it returns.
+
+Every literal and every expanded expression in a template becomes a
+call to a write function, which is bound once at the start of the
+template function. The strategy decides what that write function is,
+how literals and expanded values are converted before they are
+written, and how the final result is produced:
+
+* :py:class:`StringIOOutput` writes to an :py:class:`io.StringIO` and
+  returns its value.
+* :py:class:`ListOutput` appends to a list and joins it at the end.
+* :py:class:`BytesOutput` extends a :py:class:`bytearray` and returns
+  ``bytes``. Literals are encoded as UTF-8 when the template is
+  compiled, so only expanded values are encoded at render time, and
+  the result can be passed to an ``HttpResponse`` without being
+  encoded again.
+
+When a template is compiled in streaming mode (see
+:py:meth:`Compiler.compile_stream
+<margate.compiler.Compiler.compile_stream>`), the template function is
+a generator, and the strategy also supplies the code that yields the
+output buffered so far at each flush point. This needs the size of
+the buffer to be cheap to find, so only :py:class:`StringIOOutput` and
+:py:class:`BytesOutput` support streaming.
+
+"""
+
+import io
+
+# Objects that the set-up code of the strategies needs at runtime.
+# These become globals of the template function, since generated code
+# must only contain constants that can be marshalled into the bytecode
+# cache.
+RUNTIME_GLOBALS = {
+    "_StringIO": io.StringIO,
+    "_bytearray": bytearray,
+    "_bytes": bytes
+}
+
+
+class OutputStrategy:
+    """The base class of output strategies.
+
+    Subclasses give the source of the statements that set up the
+    output at the start of the function and return the result at the
+    end, which the AST backend parses and the bytecode backend
+    mirrors in :py:meth:`make_prologue_bytecode` and
+    :py:meth:`make_epilogue_bytecode`.
+
+    """
+
+    name = None
+
+    # Whether the strategy can be used in streaming mode.
+    streamable = False
+
+    # The method of the output object that writes several values in a
+    # single call, if it has one. Otherwise the values are joined and
+    # written with the write function.
+    write_many_method = None
+
+    def prologue_source(self, write_func):
+        raise NotImplementedError()
+
+    def epilogue_source(self):
+        raise NotImplementedError()
+
+    def make_prologue_bytecode(self, write_func):
+        raise NotImplementedError()
+
+    def make_epilogue_bytecode(self):
+        raise NotImplementedError()
+
+    def encode_literal(self, contents):
+        """Convert literal text into the value that is written to the
+        output."""
+        return contents
+
+    def make_encode_bytecode(self):
+        """Return the instructions that convert the string on top of
+        the stack into the value that is written to the output."""
+        return []
+
+    def make_encode_ast(self, value):
+        """Wrap an expression that evaluates to a string so that it
+        evaluates to the value that is written to the output."""
+        return value
+
+    def make_write_many_ast(self, write_func, values, output_name="_output"):
+        """Make the statement that writes several values to the output
+        with a single call.
+
+        :param values: The expressions for the values, which have
+          already been converted with :py:meth:`make_encode_ast`.
+        :param output_name: The variable that holds the output that
+          the write function writes to.
+
+        """
+        import ast
+
+        values = ast.Tuple(values, ast.Load())
+
+        if self.write_many_method is None:
+            function = ast.Name(write_func, ast.Load())
+            argument = ast.Call(
+                ast.Attribute(ast.Constant(self.encode_literal("")),
+                              "join",
+                              ast.Load()),
+                [values],
+                [])
+        else:
+            function = ast.Attribute(ast.Name(output_name, ast.Load()),
+                                     self.write_many_method,
+                                     ast.Load())
+            argument = values
+
+        return ast.Expr(ast.Call(function, [argument], []))
+
+    def make_write_many_bytecode(self, write_func, values,
+                                 output_name="_output"):
+        """The bytecode version of :py:meth:`make_write_many_ast`,
+        where each value is a list of instructions that pushes it on
+        to the stack."""
+        from bytecode import Instr
+
+        if self.write_many_method is None:
+            code = [Instr("LOAD_NAME", write_func),
+                    Instr("LOAD_CONST", self.encode_literal("")),
+                    Instr("LOAD_ATTR", "join")]
+        else:
+            code = [Instr("LOAD_NAME", output_name),
+                    Instr("LOAD_ATTR", self.write_many_method)]
+
+        for value in values:
+            code += value
+
+        code += [Instr("BUILD_TUPLE", len(values)),
+                 Instr("CALL_FUNCTION", 1)]
+
+        if self.write_many_method is None:
+            code += [Instr("CALL_FUNCTION", 1)]
+
+        return code + [Instr("POP_TOP")]
+
+    def flush_source(self, min_size):
+        """The source of the statements that yield the buffered output
+        and empty the buffer, if at least ``min_size`` characters (or
+        bytes) are buffered."""
+        raise NotImplementedError()
+
+    def stream_epilogue_source(self):
+        """The source of the statements that yield any remaining
+        output at the end of a streaming template."""
+        return self.flush_source(1)
+
+    def make_flush_bytecode(self, min_size):
+        raise NotImplementedError()
+
+    def make_stream_epilogue_bytecode(self):
+        from bytecode import Instr
+
+        return self.make_flush_bytecode(1) + [Instr("LOAD_CONST", None),
+                                              Instr("RETURN_VALUE")]
+
+
+class StringIOOutput(OutputStrategy):
+    name = "stringio"
+    streamable = True
+
+    def prologue_source(self, write_func):
+        return ("_output = _StringIO()\n"
+                "%s = _output.write\n" % write_func)
+
+    def epilogue_source(self):
+        return "return _output.getvalue()\n"
+
+    def make_prologue_bytecode(self, write_func):
+        from bytecode import Instr
+
+        return [Instr("LOAD_GLOBAL", "_StringIO"),
+                Instr("CALL_FUNCTION", 0),
+                Instr("DUP_TOP"),
+                Instr("STORE_NAME", "_output"),
+                Instr("LOAD_ATTR", "write"),
+                Instr("STORE_NAME", write_func)]
+
+    def make_epilogue_bytecode(self):
+        from bytecode import Instr
+
+        return [Instr("LOAD_NAME", "_output"),
+                Instr("LOAD_ATTR", "getvalue"),
+                Instr("CALL_FUNCTION", 0),
+                Instr("RETURN_VALUE")]
+
+    def flush_source(self, min_size):
+        return ("if _output.tell() >= %d:\n"
+                "    yield _output.getvalue()\n"
+                "    _output.seek(0)\n"
+                "    _output.truncate()\n" % min_size)
+
+    def make_flush_bytecode(self, min_size):
+        from bytecode import Instr, Label, Compare
+
+        end_flush = Label()
+
+        return [Instr("LOAD_NAME", "_output"),
+                Instr("LOAD_ATTR", "tell"),
+                Instr("CALL_FUNCTION", 0),
+                Instr("LOAD_CONST", min_size),
+                Instr("COMPARE_OP", Compare.GE),
+                Instr("POP_JUMP_IF_FALSE", end_flush),
+                Instr("LOAD_NAME", "_output"),
+                Instr("LOAD_ATTR", "getvalue"),
+                Instr("CALL_FUNCTION", 0),
+                Instr("YIELD_VALUE"),
+                Instr("POP_TOP"),
+                Instr("LOAD_NAME", "_output"),
+                Instr("LOAD_ATTR", "seek"),
+                Instr("LOAD_CONST", 0),
+                Instr("CALL_FUNCTION", 1),
+                Instr("POP_TOP"),
+                Instr("LOAD_NAME", "_output"),
+                Instr("LOAD_ATTR", "truncate"),
+                Instr("CALL_FUNCTION", 0),
+                Instr("POP_TOP"),
+                end_flush]
+
+
+class ListOutput(OutputStrategy):
+    name = "list"
+    write_many_method = "extend"
+
+    def prologue_source(self, write_func):
+        return ("_output = []\n"
+                "%s = _output.append\n" % write_func)
+
+    def epilogue_source(self):
+        return "return ''.join(_output)\n"
+
+    def make_prologue_bytecode(self, write_func):
+        from bytecode import Instr
+
+        return [Instr("BUILD_LIST", 0),
+                Instr("DUP_TOP"),
+                Instr("STORE_NAME", "_output"),
+                Instr("LOAD_ATTR", "append"),
+                Instr("STORE_NAME", write_func)]
+
+    def make_epilogue_bytecode(self):
+        from bytecode import Instr
+
+        return [Instr("LOAD_CONST", ""),
+                Instr("LOAD_ATTR", "join"),
+                Instr("LOAD_NAME", "_output"),
+                Instr("CALL_FUNCTION", 1),
+                Instr("RETURN_VALUE")]
+
+
+class BytesOutput(OutputStrategy):
+    name = "bytes"
+    streamable = True
+
+    def prologue_source(self, write_func):
+        return ("_output = _bytearray()\n"
+                "%s = _output.extend\n" % write_func)
+
+    def epilogue_source(self):
+        return "return _bytes(_output)\n"
+
+    def make_prologue_bytecode(self, write_func):
+        from bytecode import Instr
+
+        return [Instr("LOAD_GLOBAL", "_bytearray"),
+                Instr("CALL_FUNCTION", 0),
+                Instr("DUP_TOP"),
+                Instr("STORE_NAME", "_output"),
+                Instr("LOAD_ATTR", "extend"),
+                Instr("STORE_NAME", write_func)]
+
+    def make_epilogue_bytecode(self):
+        from bytecode import Instr
+
+        return [Instr("LOAD_GLOBAL", "_bytes"),
+                Instr("LOAD_NAME", "_output"),
+                Instr("CALL_FUNCTION", 1),
+                Instr("RETURN_VALUE")]
+
+    def encode_literal(self, contents):
+        return contents.encode("utf-8")
+
+    def make_encode_bytecode(self):
+        from bytecode import Instr
+
+        return [Instr("LOAD_ATTR", "encode"),
+                Instr("CALL_FUNCTION", 0)]
+
+    def make_encode_ast(self, value):
+        import ast
+
+        return ast.Call(ast.Attribute(value, "encode", ast.Load()),
+                        [],
+                        [])
+
+    def flush_source(self, min_size):
+        return ("if len(_output) >= %d:\n"
+                "    yield _bytes(_output)\n"
+                "    _output.clear()\n" % min_size)
+
+    def make_flush_bytecode(self, min_size):
+        from bytecode import Instr, Label, Compare
+
+        end_flush = Label()
+
+        return [Instr("LOAD_NAME", "len"),
+                Instr("LOAD_NAME", "_output"),
+                Instr("CALL_FUNCTION", 1),
+                Instr("LOAD_CONST", min_size),
+                Instr("COMPARE_OP", Compare.GE),
+                Instr("POP_JUMP_IF_FALSE", end_flush),
+                Instr("LOAD_GLOBAL", "_bytes"),
+                Instr("LOAD_NAME", "_output"),
+                Instr("CALL_FUNCTION", 1),
+                Instr("YIELD_VALUE"),
+                Instr("POP_TOP"),
+                Instr("LOAD_NAME", "_output"),
+                Instr("LOAD_ATTR", "clear"),
+                Instr("CALL_FUNCTION", 0),
+                Instr("POP_TOP"),
+                end_flush]
+
+
+OUTPUT_STRATEGIES = {
+    strategy.name: strategy
+    for strategy in [StringIOOutput(), ListOutput(), BytesOutput()]
+}
+
+
+def get_output_strategy(name):
+    """Look up an output strategy by name (``"stringio"``, ``"list"``
+    or ``"bytes"``)."""
+    try:
+        return OUTPUT_STRATEGIES[name]
+    except KeyError:
+        raise ValueError("Unknown output strategy '%s'" % name)
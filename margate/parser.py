@@ -17,41 +17,42 @@ parsed
 
 """
 
+import io
 import re
 import ast
-from collections import namedtuple
+import tokenize
+import threading
+from collections import namedtuple, OrderedDict
 import funcparserlib.parser
 
-from . import code_generation, compiler
+from . import code_generation, compiler, bytecode_cache
 
 IfNode = namedtuple('IfNode', ['expression'])
 ForNode = namedtuple('ForNode', ['variable', 'collection'])
 ExtendsNode = namedtuple('ExtendsNode', ['template_name'])
 BlockNode = namedtuple('BlockNode', ['block_name'])
+FilterNode = namedtuple('FilterNode', ['name', 'argument'])
+IncludeNode = namedtuple('IncludeNode', ['template_name', 'expression'])
+MacroNode = namedtuple('MacroNode', ['name', 'arguments'])
+CallNode = namedtuple('CallNode', ['call'])
+CacheNode = namedtuple('CacheNode', ['key', 'ttl'])
+
+# The deepest that templates can be nested by {% include %} and
+# {% extends %}, to catch runaway nesting when a template is compiled.
+MAX_TEMPLATE_DEPTH = 32
 
 
 class UnsupportedElementException(Exception):
     pass
 
 
-def parse_expression(expression):
-    """Parse an expression that appears in an execution node, i.e. a
-    block delimited by ``{% %}``.
-
-    This can be a compound expression like a ``for`` statement with
-    several sub-expressions, or it can just be a single statement such
-    as ``endif``.
-
-    :param list expression: Tokenised expression.
+def _make_grammar():
+    """Build the grammar for each kind of ``{% %}`` block other than
+    ``if``, keyed by the keyword that starts the block.
 
     """
     from funcparserlib.parser import a, skip, some
 
-    # For if expressions, we rely on the Python parser to process the
-    # expression rather than using our own parser.
-    if expression[0] == 'if':
-        return IfNode(ast.parse(' '.join(expression[1:]), mode="eval"))
-
     variable_name = some(lambda x: re.match(r'[a-zA-Z_]+', x))
 
     # TODO We use the same function twice, first to match the token
@@ -82,9 +83,56 @@ def parse_expression(expression):
 
     def make_extends_node(x): return ExtendsNode(*x)
 
-    parser = ((for_expression >> make_for_node)
-              | (extends_expression >> make_extends_node)
-              | (block_expression >> BlockNode))
+    return {
+        'for': for_expression >> make_for_node,
+        'extends': extends_expression >> make_extends_node,
+        'block': block_expression >> BlockNode
+    }
+
+
+# The grammar is built once, when the module is imported, rather than
+# for every block that's parsed.
+_grammar = _make_grammar()
+
+
+def parse_expression(expression):
+    """Parse an expression that appears in an execution node, i.e. a
+    block delimited by ``{% %}``.
+
+    This can be a compound expression like a ``for`` statement with
+    several sub-expressions, or it can just be a single statement such
+    as ``endif``.
+
+    :param list expression: Tokenised expression.
+
+    """
+    keyword = expression[0]
+
+    # For if expressions, we rely on the Python parser to process the
+    # expression rather than using our own parser.
+    if keyword == 'if':
+        return IfNode(ast.parse(' '.join(expression[1:]), mode="eval"))
+
+    # The argument of an include is either a quoted template name or
+    # an arbitrary expression that gives the name.
+    if keyword == 'include':
+        return _parse_include(' '.join(expression[1:]))
+
+    # Macro definitions and calls use Python's syntax for function
+    # definitions and calls.
+    if keyword == 'macro':
+        return _parse_macro(' '.join(expression[1:]))
+    if keyword == 'call':
+        return _parse_call(' '.join(expression[1:]))
+
+    if keyword == 'cache':
+        return _parse_cache(expression[1:])
+
+    # The first token decides which rule can match, so only that rule
+    # is tried.
+    parser = _grammar.get(keyword)
+    if parser is None:
+        raise Exception("Invalid expression '%s'" % expression)
 
     try:
         return parser.parse(expression)
@@ -92,6 +140,213 @@ def parse_expression(expression):
         raise Exception("Invalid expression '%s'" % expression)
 
 
+def _parse_include(argument):
+    if not argument:
+        raise Exception("Invalid expression 'include'")
+
+    match = re.match(r'^"([^"]*)"$', argument)
+    if match:
+        return IncludeNode(match.group(1), None)
+    else:
+        return IncludeNode(None, argument)
+
+
+def _parse_macro(signature):
+    try:
+        function_def = ast.parse("def %s: pass" % signature).body[0]
+    except SyntaxError:
+        raise Exception("Invalid macro '%s'" % signature)
+
+    arguments = function_def.args
+    if arguments.vararg or arguments.kwonlyargs or arguments.kwarg:
+        raise Exception("Macro arguments must be names, optionally with "
+                        "default values, in '%s'" % signature)
+
+    return MacroNode(function_def.name, arguments)
+
+
+def _parse_call(expression):
+    try:
+        call = ast.parse(expression, mode="eval").body
+    except SyntaxError:
+        raise Exception("Invalid call '%s'" % expression)
+
+    if not isinstance(call, ast.Call) or not isinstance(call.func, ast.Name):
+        raise Exception("Invalid call '%s'" % expression)
+
+    return CallNode(call)
+
+
+def _parse_cache(arguments):
+    # The TTL, if there is one, follows the key as "ttl=<expression>".
+    # An "=" can't appear outside brackets in an expression, so this
+    # can't be mistaken for part of the key.
+    source = ' '.join(arguments)
+    (key, ttl) = (source, None)
+
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(source).readline))
+    except (tokenize.TokenError, SyntaxError):
+        # The key is invalid, which is reported below.
+        tokens = []
+
+    depth = 0
+    for (token, next_token) in zip(tokens, tokens[1:]):
+        if token.string in ("(", "[", "{"):
+            depth += 1
+        elif token.string in (")", "]", "}"):
+            depth -= 1
+        elif depth == 0 and token.string == "ttl" \
+                and next_token.string == "=":
+            key = source[:token.start[1]].strip()
+            ttl = source[next_token.end[1]:].strip()
+            break
+
+    if not key:
+        raise Exception("Invalid expression 'cache %s'" % source)
+
+    for source in (key, ttl):
+        if source is None:
+            continue
+        try:
+            ast.parse(source, mode="eval")
+        except SyntaxError:
+            raise Exception("Invalid cache expression '%s'" % source)
+
+    return CacheNode(key, ttl)
+
+
+_filter_pattern = re.compile(r"\s*([A-Za-z_]\w*)\s*(?::(.*))?$", re.DOTALL)
+
+
+def parse_filters(expression):
+    """Split the expression in a variable expansion (i.e. a block
+    delimited by ``{{ }}``) into the expression for the value and the
+    filters that are applied to it, as in ``value|lower|cut:" "``.
+
+    As in Django, a ``|`` outside any brackets separates filters. A
+    ``|`` inside brackets is Python's bitwise or operator.
+
+    :return: A tuple of the source of the value expression and a list
+      of :py:class:`FilterNode` objects, each of which has the source
+      of its argument, or ``None``.
+
+    """
+    parts = _split_filters(expression)
+
+    filters = []
+    for part in parts[1:]:
+        match = _filter_pattern.match(part)
+        if not match or match.group(2) == "":
+            raise Exception("Invalid filter '%s'" % part.strip())
+
+        argument = match.group(2)
+        filters.append(FilterNode(match.group(1),
+                                  argument.strip() if argument else None))
+
+    return (parts[0], filters)
+
+
+def _split_filters(expression):
+    # Most expansions have no filters, so they aren't tokenised.
+    if "|" not in expression:
+        return [expression]
+
+    line_offsets = [0]
+    for line in expression.splitlines(keepends=True):
+        line_offsets.append(line_offsets[-1] + len(line))
+
+    separators = []
+    depth = 0
+
+    try:
+        for token in tokenize.generate_tokens(
+                io.StringIO(expression).readline):
+            if token.type != tokenize.OP:
+                continue
+
+            if token.string in ("(", "[", "{"):
+                depth += 1
+            elif token.string in (")", "]", "}"):
+                depth -= 1
+            elif token.string == "|" and depth == 0:
+                (row, column) = token.start
+                separators.append(line_offsets[row - 1] + column)
+    except (tokenize.TokenError, SyntaxError):
+        # The expression is invalid, which is reported when it's
+        # compiled.
+        return [expression]
+
+    parts = []
+    start = 0
+    for separator in separators:
+        parts.append(expression[start:separator])
+        start = separator + 1
+    parts.append(expression[start:])
+
+    return parts
+
+
+class ParsedTemplateCache:
+    """A cache of the parse trees of templates that other templates
+    extend, so that a parent template is only parsed once however many
+    templates extend it.
+
+    Entries are keyed by the template name, and record a hash of the
+    source that was parsed. An entry is replaced when the parent
+    template's source changes. When the cache holds ``max_size``
+    entries, the least recently used one is dropped.
+
+    The cached trees are shared by every template that extends the
+    parent, so they must not be modified.
+
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, template_name, source_hash):
+        """Return the parse tree and dependencies of a template, or
+        ``None`` if the template hasn't been parsed or the source with
+        this hash hasn't been parsed.
+
+        """
+        with self._lock:
+            entry = self._entries.get(template_name)
+            if entry is None or entry[0] != source_hash:
+                return None
+
+            self._entries.move_to_end(template_name)
+            return entry[1:]
+
+    def store(self, template_name, source_hash, sequence, dependencies):
+        """Store the parse tree of a template.
+
+        :param list dependencies: The templates that the template
+          itself extends, as recorded in :py:attr:`Parser.dependencies`.
+
+        """
+        with self._lock:
+            self._entries[template_name] = (source_hash,
+                                            sequence,
+                                            list(dependencies))
+            self._entries.move_to_end(template_name)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# The cache of parent templates that is shared by every parser that
+# isn't given its own.
+parsed_template_cache = ParsedTemplateCache()
+
+
 class Parser:
     """The Parser is responsible for turning a template in "tokenised"
     form into a tree structure from which it is straightforward to
@@ -106,15 +361,80 @@ class Parser:
 
     """
 
-    def __init__(self, template_locator=None):
+    def __init__(self, template_locator=None, template_cache=None,
+                 template_chain=(), template_id=""):
+        """
+        :param template_chain: The names of the templates that include
+          or extend the template being parsed, directly or indirectly,
+          which is used to detect a template that includes or extends
+          itself.
+        :param str template_id: Identifies the template being parsed
+          (the compiler uses a hash of its source). It's combined with
+          the position of each ``{% cache %}`` block to keep the
+          fragments of different templates apart in the fragment
+          cache.
+        """
+        self._template_id = template_id
+        self._fragment_count = 0
 
-        def _get_related_template(template_name):
+        # The templates that the parsed template extends or includes,
+        # as a list of (template name, source hash) pairs. This is
+        # recorded by the bytecode cache so that it can tell when one
+        # of them has changed.
+        self.dependencies = []
+
+        if template_cache is None:
+            template_cache = parsed_template_cache
+
+        def _read_template(template_name):
             template = template_locator.find_template(template_name)
             if not template:
                 raise FileNotFoundError()
             with open(template) as template_file:
+                return template_file.read()
+
+        def _get_related_template(template_name):
+            if template_name in template_chain:
+                raise Exception("Template '%s' includes or extends itself"
+                                % template_name)
+            if len(template_chain) >= MAX_TEMPLATE_DEPTH:
+                raise Exception("Templates are nested more than %d deep "
+                                "at '%s'" % (MAX_TEMPLATE_DEPTH,
+                                             template_name))
+
+            source = _read_template(template_name)
+            template_hash = bytecode_cache.source_hash(source)
+            entry = template_cache.get(template_name, template_hash)
+
+            # The cached tree includes the templates that the parent
+            # extends in turn, so it's only valid if none of them
+            # has changed either.
+            if entry is not None \
+               and any(bytecode_cache.source_hash(_read_template(name))
+                       != expected_hash
+                       for (name, expected_hash) in entry[1]):
+                entry = None
+
+            if entry is None:
+                # The parent is parsed by a parser of its own, so that
+                # the templates that it extends in turn can be cached
+                # with it.
+                parent_parser = Parser(template_locator, template_cache,
+                                       template_chain + (template_name,),
+                                       template_hash)
                 compiler_obj = compiler.Compiler(template_locator)
-                return compiler_obj._get_chunks(template_file.read())
+                sequence = parent_parser.parse(
+                    compiler_obj._get_chunks(source))
+                parent_dependencies = parent_parser.dependencies
+                template_cache.store(template_name, template_hash,
+                                     sequence, parent_dependencies)
+            else:
+                (sequence, parent_dependencies) = entry
+
+            self.dependencies.append((template_name, template_hash))
+            self.dependencies += parent_dependencies
+
+            return sequence
 
         self._sub_template_locator = _get_related_template
 
@@ -138,7 +458,7 @@ class Parser:
             while True:
                 token = next(token_iter)
                 if termination_condition and termination_condition(token):
-                    return
+                    return token
 
                 if isinstance(token, code_generation.Execution):
                     # An execution node always starts a subsequence
@@ -148,10 +468,28 @@ class Parser:
                     # any Execution node is the start of a new block.
                     block = self._parse_subsequence(token, token_iter)
                     sequence.add_element(block)
+                elif isinstance(token, code_generation.VariableExpansion):
+                    (value, filters) = parse_filters(token.variable_name)
+
+                    # The content of block.super is template code
+                    # that's written straight to the output, rather
+                    # than a value that filters could be applied to.
+                    if value.strip() == "block.super":
+                        if filters:
+                            raise Exception(
+                                "Filters can't be applied to block.super "
+                                "in '%s'" % token.variable_name.strip())
+                        sequence.add_element(code_generation.BlockSuper())
+                    elif filters:
+                        sequence.add_element(
+                            code_generation.VariableExpansion(value,
+                                                              filters))
+                    else:
+                        sequence.add_element(token)
                 else:
                     sequence.add_element(token)
         except StopIteration:
-            return
+            return None
 
     def _parse_subsequence(self, token, token_iter):
         node = parse_expression(
@@ -163,18 +501,42 @@ class Parser:
             inner_termination_condition = self._end_sequence("endif")
         elif isinstance(node, ForNode):
             block = code_generation.ForBlock(node)
-            inner_termination_condition = self._end_sequence("endfor")
+            inner_termination_condition = self._end_sequence("empty",
+                                                             "endfor")
         elif isinstance(node, ExtendsNode):
             if self._sub_template_locator is None:
                 raise UnsupportedElementException(
                     "Parser is not configured to support "
                     "extending other templates")
 
-            content = self._sub_template_locator(
-                node.template_name)
-            parsed = self.parse(content)
+            parsed = self._sub_template_locator(node.template_name)
             block = code_generation.ExtendsBlock(parsed)
             inner_termination_condition = None
+        elif isinstance(node, MacroNode):
+            block = code_generation.MacroBlock(node.name, node.arguments)
+            inner_termination_condition = self._end_sequence("endmacro")
+        elif isinstance(node, CacheNode):
+            block = code_generation.CacheBlock(
+                node.key,
+                node.ttl,
+                "%s:%d" % (self._template_id, self._fragment_count))
+            self._fragment_count += 1
+            inner_termination_condition = self._end_sequence("endcache")
+        elif isinstance(node, CallNode):
+            return code_generation.MacroCall(node.call)
+        elif isinstance(node, IncludeNode):
+            # An include has no body, so it ends here.
+            if node.template_name is None:
+                return code_generation.DynamicInclude(node.expression)
+
+            if self._sub_template_locator is None:
+                raise UnsupportedElementException(
+                    "Parser is not configured to support "
+                    "including other templates")
+
+            return code_generation.IncludeBlock(
+                node.template_name,
+                self._sub_template_locator(node.template_name))
         elif isinstance(node, BlockNode):
             block = code_generation.ReplaceableBlock(
                 node.block_name)
@@ -182,15 +544,22 @@ class Parser:
         else:
             raise Exception("Unrecognised block type")
 
-        self._parse_into_sequence(block.sequence,
-                                  token_iter,
-                                  inner_termination_condition)
+        end_token = self._parse_into_sequence(block.sequence,
+                                              token_iter,
+                                              inner_termination_condition)
+
+        if isinstance(node, ForNode) \
+           and end_token is not None \
+           and end_token.expression == "empty":
+            self._parse_into_sequence(block.empty_sequence,
+                                      token_iter,
+                                      self._end_sequence("endfor"))
 
         return block
 
-    def _end_sequence(self, end_token):
+    def _end_sequence(self, *end_tokens):
         def is_end_token(token):
             return (isinstance(token, code_generation.Execution)
-                    and token.expression == end_token)
+                    and token.expression in end_tokens)
 
         return is_end_token
@@ -0,0 +1,238 @@
+"""The template cache holds compiled templates in memory, so that each
+template is only compiled once per process.
+
+The cache is bounded: when it is full, the least recently used
+template is evicted. Each entry records a fingerprint of the template
+(such as its modification time, or a hash of its contents) when it
+was loaded, and this is compared with the current fingerprint at most
+once every ``check_interval`` seconds, so that a changed template is
+recompiled without checking the filesystem on every render.
+
+The cache can be used from several threads at once. When several
+threads miss on the same template at the same time, only one of them
+loads it and the others wait for the result.
+
+A :py:class:`DependencyGraph` records which templates extend which, so
+that when a template changes, the templates that extend it can be
+invalidated too, without flushing the whole cache.
+
+"""
+
+import time
+import threading
+from collections import OrderedDict, defaultdict
+
+
+class _Entry:
+    __slots__ = ["value", "fingerprint", "checked"]
+
+    def __init__(self, value, fingerprint, checked):
+        self.value = value
+        self.fingerprint = fingerprint
+        self.checked = checked
+
+
+class TemplateCache:
+    """A thread-safe LRU cache of compiled templates.
+
+    :param int max_size: The maximum number of entries, or ``None``
+      for no limit.
+    :param float check_interval: The minimum number of seconds
+      between checks of the fingerprint of an entry, or ``None`` to
+      never check.
+    :param fingerprint: A function that takes a key and returns a
+      value that changes whenever the template changes, for example
+      its modification time. If this is ``None``, entries are never
+      invalidated.
+    :param clock: The function used to find the current time.
+
+    """
+
+    def __init__(self, max_size=None, check_interval=None,
+                 fingerprint=None, clock=time.monotonic):
+        if max_size is not None and max_size < 1:
+            raise ValueError("The template cache size must be at least 1")
+
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self._fingerprint = fingerprint
+        self._clock = clock
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # A lock for each key that is being loaded, which other
+        # threads that miss on the same key wait for.
+        self._loading = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, load):
+        """Get the value for a key, loading it if it's not in the cache
+        or has changed.
+
+        :param load: A function that takes the key and returns the
+          value to cache. Exceptions that it raises are passed on, and
+          nothing is cached.
+
+        """
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry.value
+
+        with self._lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            try:
+                # Another thread may have loaded the value while this
+                # one was waiting for the lock.
+                entry = self._lookup(key, count_miss=True)
+                if entry is not None:
+                    return entry.value
+
+                # The fingerprint is taken before loading, so that a
+                # change made during loading is noticed at the next
+                # check.
+                fingerprint = self._get_fingerprint(key)
+                value = load(key)
+                self._store(key, _Entry(value, fingerprint, self._clock()))
+                return value
+            finally:
+                with self._lock:
+                    if self._loading.get(key) is key_lock:
+                        del self._loading[key]
+
+    def set(self, key, value, fingerprint):
+        """Store a value that was loaded outside the cache, for example
+        when templates are compiled ahead of time.
+
+        :param fingerprint: The fingerprint of the template, taken
+          before the value was loaded.
+
+        """
+        self._store(key, _Entry(value, fingerprint, self._clock()))
+
+    def invalidate(self, key):
+        """Remove the entry for a key, if there is one."""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def _lookup(self, key, count_miss=False):
+        """Return the entry for a key if it's present and up to date,
+        otherwise ``None``. Stale entries are removed.
+
+        """
+        now = self._clock()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+
+            if not self._needs_check(entry, now):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        # The fingerprint may need to look at the filesystem, so it
+        # is found without holding the lock.
+        fingerprint = self._get_fingerprint(key)
+
+        with self._lock:
+            current = self._entries.get(key) is entry
+
+            if fingerprint != entry.fingerprint:
+                if current:
+                    del self._entries[key]
+                    self.invalidations += 1
+                current = False
+
+            # The entry may also have been invalidated by another
+            # thread (or by the fingerprint function) in the meantime.
+            if not current:
+                if count_miss:
+                    self.misses += 1
+                return None
+
+            entry.checked = now
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def _needs_check(self, entry, now):
+        return (self._fingerprint is not None
+                and self.check_interval is not None
+                and now - entry.checked >= self.check_interval)
+
+    def _get_fingerprint(self, key):
+        if self._fingerprint is None:
+            return None
+        return self._fingerprint(key)
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+
+            if self.max_size is not None:
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+
+
+class DependencyGraph:
+    """Records the templates that each template extends, directly or
+    indirectly, and so the templates that are affected when one
+    changes.
+
+    """
+
+    def __init__(self):
+        self._ancestors = {}
+        self._descendants = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def set_ancestors(self, template_name, ancestors):
+        """Record the templates that a template extends, replacing any
+        that were recorded before.
+
+        :param ancestors: The names of the templates that the template
+          extends, including the ones that its parent extends.
+
+        """
+        with self._lock:
+            for ancestor in self._ancestors.get(template_name, ()):
+                self._descendants[ancestor].discard(template_name)
+
+            self._ancestors[template_name] = tuple(ancestors)
+
+            for ancestor in ancestors:
+                self._descendants[ancestor].add(template_name)
+
+    def get_ancestors(self, template_name):
+        """Return the names of the templates that a template extends."""
+        return self._ancestors.get(template_name, ())
+
+    def get_descendants(self, template_name):
+        """Return the names of the templates that extend a template,
+        directly or indirectly."""
+        with self._lock:
+            return set(self._descendants.get(template_name, ()))
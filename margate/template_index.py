@@ -0,0 +1,137 @@
+"""The template index maps template names to the files that they're
+loaded from.
+
+Finding a template by trying each template directory in turn costs a
+filesystem call per directory for every lookup, and most of them fail
+when there are many directories. Instead, the index walks all the
+template directories once and records the path of every template in
+them. Names that aren't found are remembered too, so that a missing
+template doesn't cause the directories to be searched again.
+
+Adding or removing a file changes the modification time of the
+directory that contains it, so the index records the modification
+time of every directory that it walks, and rebuilds itself when any
+of them has changed. These are checked at most once every
+``check_interval`` seconds.
+
+"""
+
+import os
+import time
+import threading
+
+from .compiler import TemplateLocator, find_templates
+
+
+class TemplateIndex(TemplateLocator):
+    """A :py:class:`~margate.compiler.TemplateLocator` that looks up
+    templates in an index of a list of directories. When a template
+    name is in more than one directory, the first directory wins, in
+    the same way as Django's filesystem loader.
+
+    :param directories: The template directories, in the order they're
+      searched.
+    :param float check_interval: The minimum number of seconds
+      between checks for changes to the directories, or ``None`` to
+      never check.
+    :param clock: The function used to find the current time.
+
+    """
+
+    def __init__(self, directories, check_interval=1.0,
+                 clock=time.monotonic):
+        self.directories = list(directories)
+        self.check_interval = check_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+
+        # These are all replaced together when the index is rebuilt.
+        self._paths = None
+        self._misses = set()
+        self._directory_mtimes = {}
+        self._checked = None
+
+    def find_template(self, template_name):
+        self._check()
+
+        path = self._paths.get(template_name)
+        if path is not None:
+            return path
+
+        if template_name in self._misses:
+            return None
+
+        # The name may not be in the form the index uses (for example
+        # "./page.html"), so the directories are searched once, and
+        # the result is remembered until the index is rebuilt.
+        path = self._search(template_name)
+        with self._lock:
+            if path is None:
+                self._misses.add(template_name)
+            else:
+                self._paths[template_name] = path
+
+        return path
+
+    def rescan(self):
+        """Rebuild the index from the contents of the directories."""
+        paths = {}
+        directory_mtimes = {}
+
+        for directory in self.directories:
+            directory_mtimes.update(self._get_directory_mtimes(directory))
+
+            for (name, path) in find_templates(directory):
+                paths.setdefault(name, path)
+
+        with self._lock:
+            self._paths = paths
+            self._misses = set()
+            self._directory_mtimes = directory_mtimes
+            self._checked = self._clock()
+
+    def _check(self):
+        if self._paths is None:
+            self.rescan()
+            return
+
+        now = self._clock()
+        if self.check_interval is None \
+           or now - self._checked < self.check_interval:
+            return
+
+        self._checked = now
+        for (directory, mtime) in self._directory_mtimes.items():
+            if self._get_mtime(directory) != mtime:
+                self.rescan()
+                return
+
+    def _search(self, template_name):
+        for directory in self.directories:
+            # Like Django's loaders, don't allow the name to refer to
+            # a file outside the template directory.
+            root = os.path.abspath(directory)
+            candidate = os.path.abspath(os.path.join(root, template_name))
+            if not candidate.startswith(root + os.sep):
+                continue
+
+            if os.path.isfile(candidate):
+                return candidate
+
+        return None
+
+    def _get_directory_mtimes(self, directory):
+        mtimes = {directory: self._get_mtime(directory)}
+
+        for (dirpath, dirnames, _) in os.walk(directory):
+            for dirname in dirnames:
+                path = os.path.join(dirpath, dirname)
+                mtimes[path] = self._get_mtime(path)
+
+        return mtimes
+
+    def _get_mtime(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
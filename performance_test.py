@@ -7,7 +7,9 @@ import timeit
 
 from django.template import Context, Engine
 
-from margate.compiler import Compiler
+from margate.compiler import Compiler, DEFAULT_BACKEND
+from margate.parser import Parser
+from margate.code_generation import Execution
 
 expression = """
 Hello {{ name }}, I am a {{ whom }}
@@ -61,5 +63,236 @@ def do_performance_test():
                    2)))
 
 
+def do_backend_comparison_test():
+    """Compare the time to compile and render the template with each
+    of the code generation backends.
+
+    The bytecode backend only works on versions of Python before 3.8,
+    so on later versions only the AST backend is measured.
+
+    """
+    backends = ["ast"]
+    if DEFAULT_BACKEND == "bytecode":
+        backends.insert(0, "bytecode")
+
+    iterations = 1000
+
+    for backend in backends:
+        backend_compiler = Compiler(backend=backend)
+
+        compile_time = timeit.timeit(
+            lambda: backend_compiler.compile(expression),
+            number=100) / 100
+
+        backend_func = backend_compiler.compile(expression)
+        assert backend_func(**variables) == margate_render()
+
+        render_time = timeit.timeit(lambda: backend_func(**variables),
+                                    number=iterations) / iterations
+
+        print("{backend} backend: compile took {compile} microseconds, "
+              "render took {render} microseconds".format(
+                  backend=backend,
+                  compile=round(compile_time * 1000 * 1000, 2),
+                  render=round(render_time * 1000 * 1000, 2)))
+
+
+# Templates of different shapes, with the variables to render them
+# with, for comparing the output strategies.
+template_shapes = {
+    "loop": (expression, variables),
+    "mostly literal": (
+        "<p>" + "Lorem ipsum dolor sit amet. " * 200 + "</p>\n"
+        "{{ name }}\n" + "<p>" + "Consectetur adipiscing elit. " * 200
+        + "</p>\n",
+        {"name": "world"}),
+    "many expansions": (
+        "{% for i in numbers %}{{ i }}{{ name }}{{ whom }}{% endfor %}",
+        variables),
+}
+
+
+def do_output_strategy_test():
+    """Compare the render times of the output strategies over templates
+    of different shapes.
+
+    """
+    iterations = 1000
+
+    for (shape, (source, shape_variables)) in sorted(
+            template_shapes.items()):
+        for strategy in ["stringio", "list", "bytes"]:
+            strategy_func = Compiler(output_strategy=strategy).compile(
+                source)
+
+            render_time = timeit.timeit(
+                lambda: strategy_func(**shape_variables),
+                number=iterations) / iterations
+
+            print("{shape}, {strategy}: {time} microseconds".format(
+                shape=shape,
+                strategy=strategy,
+                time=round(render_time * 1000 * 1000, 2)))
+
+
+# A template where most of the tags can be resolved at compile time.
+block_heavy_template = """
+{% block header %}<header>{% if True %}<h1>Title</h1>{% endif %}</header>{% endblock %}
+{% for i in numbers %}
+{% if True %}<li>{% endif %}{% block item %}{{ i }}{% endblock %}{% if False %}debug{% endif %}</li>
+{% endfor %}
+{% block footer %}<footer>Footer</footer>{% endblock %}
+"""  # noqa
+
+
+def do_optimiser_test():
+    """Compare the render time of a template with and without the
+    optimiser.
+
+    """
+    iterations = 1000
+
+    for optimise in [False, True]:
+        optimise_func = Compiler(optimise=optimise).compile(
+            block_heavy_template)
+
+        render_time = timeit.timeit(lambda: optimise_func(**variables),
+                                    number=iterations) / iterations
+
+        print("optimise={optimise}: {time} microseconds".format(
+            optimise=optimise,
+            time=round(render_time * 1000 * 1000, 2)))
+
+
+# A single row of a large report. The compile scaling test repeats
+# this to make templates of increasing size.
+report_row = """<tr>
+  <td>{{ row }}</td>
+  {% if row %}<td>yes</td>{% endif %}
+</tr>
+"""
+
+
+def do_compile_scaling_test():
+    """Tokenise and parse templates of increasing size, to show that
+    compile time grows linearly with the size of the template.
+
+    """
+    compiler = Compiler()
+
+    def front_end(source):
+        return Parser().parse(compiler._get_chunks(source))
+
+    for rows in [1000, 2000, 4000, 8000, 16000]:
+        source = report_row * rows
+        time_taken = timeit.timeit(lambda: front_end(source), number=1)
+
+        print("{size} KB took {time} ms ({per_kb} microseconds "
+              "per KB)".format(
+                  size=len(source) // 1024,
+                  time=round(time_taken * 1000, 2),
+                  per_kb=round(time_taken / len(source) * 1024
+                               * 1000 * 1000, 2)))
+
+
+# A template made almost entirely of {% %} tags, so that parsing the
+# tags dominates the time taken to compile it.
+tag_heavy_template = """{% block row %}
+{% for item in items %}{% if item %}{{ item }}{% endif %}{% endfor %}
+{% endblock %}
+"""
+
+
+def do_parse_throughput_test():
+    """Measure how many {% %} tags per second the parser handles."""
+    compiler = Compiler()
+    source = tag_heavy_template * 1000
+    chunks = list(compiler._get_chunks(source))
+    tags = sum(1 for chunk in chunks if isinstance(chunk, Execution))
+    iterations = 10
+
+    time_taken = timeit.timeit(lambda: Parser().parse(chunks),
+                               number=iterations) / iterations
+
+    print("Parsed {tags} tags in {time} ms ({rate} tags per "
+          "second)".format(
+              tags=tags,
+              time=round(time_taken * 1000, 2),
+              rate=int(tags / time_taken)))
+
+
+# A large table, which spends nearly all of its time in one loop.
+table_template = """<table>
+{% for row in rows %}<tr><td>{{ row }}</td><td>{{ unit }}</td></tr>
+{% endfor %}</table>
+"""
+
+
+def do_loop_test():
+    """Render a table of 10,000 rows with each backend."""
+    backends = ["ast"]
+    if DEFAULT_BACKEND == "bytecode":
+        backends.insert(0, "bytecode")
+
+    iterations = 20
+    variables = {"rows": range(10000), "unit": "kg"}
+
+    for backend in backends:
+        table_func = Compiler(backend=backend).compile(table_template)
+
+        render_time = timeit.timeit(lambda: table_func(**variables),
+                                    number=iterations) / iterations
+
+        print("{backend}: {time} ms for 10000 rows".format(
+            backend=backend,
+            time=round(render_time * 1000, 2)))
+
+
+escape_template = """<table>
+{% for row in rows %}<tr><td>{{ row.name }}</td><td>{{ row.note }}</td>\
+<td>{{ row.count }}</td></tr>
+{% endfor %}</table>
+"""
+
+
+def do_escape_test():
+    """Render an autoescaped table of 10,000 rows with Django and with
+    margate, with and without autoescaping. Most cells need no
+    escaping, but some do."""
+
+    class Row:
+        def __init__(self, i):
+            self.name = "Row %d" % i
+            self.note = "Tom & Jerry" if i % 10 == 0 else "Nothing"
+            self.count = str(i)
+
+    rows = [Row(i) for i in range(10000)]
+    iterations = 10
+
+    django_template = engine.from_string(escape_template)
+    django_context = Context({"rows": rows})
+    render_time = timeit.timeit(
+        lambda: django_template.render(django_context),
+        number=iterations) / iterations
+    print("Django: {time} ms for 10000 escaped rows".format(
+        time=round(render_time * 1000, 2)))
+
+    for autoescape in [True, False]:
+        table_func = Compiler(autoescape=autoescape).compile(escape_template)
+        render_time = timeit.timeit(lambda: table_func(rows=rows),
+                                    number=iterations) / iterations
+
+        print("Margate, autoescape={autoescape}: {time} ms for 10000 rows"
+              .format(autoescape=autoescape,
+                      time=round(render_time * 1000, 2)))
+
+
 if __name__ == '__main__':
     do_performance_test()
+    do_backend_comparison_test()
+    do_output_strategy_test()
+    do_optimiser_test()
+    do_compile_scaling_test()
+    do_parse_throughput_test()
+    do_loop_test()
+    do_escape_test()
@@ -7,6 +7,7 @@ setup(name="margate",
       author_email='tim@asymptotic.co.uk',
       license='MIT',
       packages=['margate'],
+      python_requires='>=3.6',
       install_requires=['django',
                         'bytecode>=0.5',
                         'funcparserlib>=0.3'],
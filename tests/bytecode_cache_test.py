@@ -0,0 +1,68 @@
+import unittest
+import unittest.mock
+import os.path
+
+from margate.compiler import Compiler
+from margate.bytecode_cache import BytecodeCache
+
+from tests.template_dir import TemplateDirTestCase
+
+
+class FixedTemplateLocator:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def find_template(self, template_name):
+        return os.path.join(self.directory, template_name)
+
+
+class BytecodeCacheTest(TemplateDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = self.make_temp_dir()
+
+    def make_compiler(self):
+        return Compiler(FixedTemplateLocator(self.template_dir),
+                        bytecode_cache=BytecodeCache(self.cache_dir))
+
+    def test_cached_template_skips_parser(self):
+        function = self.make_compiler().compile("Hello {{ whom }}")
+        self.assertEqual(function(whom="world"), "Hello world")
+
+        with unittest.mock.patch('margate.parser.Parser') as mock_parser:
+            function = self.make_compiler().compile("Hello {{ whom }}")
+
+        mock_parser.assert_not_called()
+        self.assertEqual(function(whom="cache"), "Hello cache")
+
+    def test_changed_source_is_recompiled(self):
+        self.make_compiler().compile("Hello {{ whom }}")
+        function = self.make_compiler().compile("Goodbye {{ whom }}")
+
+        self.assertEqual(function(whom="world"), "Goodbye world")
+
+    def test_changed_parent_is_recompiled(self):
+        source = ('{% extends "base.html" %}'
+                  '{% block title %}The title{% endblock %}')
+
+        self.write_template("base.html",
+                            "Title: {% block title %}{% endblock %}")
+        function = self.make_compiler().compile(source)
+        self.assertEqual(function(), "Title: The title")
+
+        self.write_template("base.html",
+                            "Heading: {% block title %}{% endblock %}")
+        function = self.make_compiler().compile(source)
+        self.assertEqual(function(), "Heading: The title")
+
+    def test_corrupt_entry_is_ignored(self):
+        cache = BytecodeCache(self.cache_dir)
+        self.make_compiler().compile("fish")
+
+        for filename in os.listdir(self.cache_dir):
+            with open(os.path.join(self.cache_dir, filename), "wb") as f:
+                f.write(b"not a cache entry")
+
+        self.assertIsNone(cache.load(cache.get_key("fish")))
+        self.assertEqual(self.make_compiler().compile("fish")(), "fish")
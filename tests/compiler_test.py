@@ -1,12 +1,17 @@
 import unittest
 import unittest.mock
 import io
+import dis
+import asyncio
 from collections import namedtuple
 
-from margate.compiler import Compiler
+from margate.compiler import Compiler, DirectoryTemplateLocator, render_many
+from margate.code_generation import Literal, VariableExpansion, Execution
 
+from tests.template_dir import TemplateDirTestCase
 
-class CompilerTest(unittest.TestCase):
+
+class CompilerTest(TemplateDirTestCase):
 
     def test_extend_template(self):
         template_locator = unittest.mock.MagicMock()
@@ -28,3 +33,611 @@ class CompilerTest(unittest.TestCase):
         self.assertEquals(
             function(),
             "Title: The title")
+
+    def test_get_chunks(self):
+        compiler = Compiler()
+
+        chunks = list(compiler._get_chunks(
+            "Hello {{ whom }}{% if x %}!{% endif %}"))
+
+        self.assertEqual(chunks[0], Literal("Hello "))
+        self.assertIsInstance(chunks[1], VariableExpansion)
+        self.assertEqual(chunks[1].variable_name, "whom")
+        self.assertEqual(chunks[2], Literal(""))
+        self.assertIsInstance(chunks[3], Execution)
+        self.assertEqual(chunks[3].expression, "if x")
+        self.assertEqual(chunks[4], Literal("!"))
+        self.assertEqual(chunks[5].expression, "endif")
+        self.assertEqual(chunks[6], Literal(""))
+        self.assertEqual(7, len(chunks))
+
+    def test_get_chunks_syntax_error(self):
+        compiler = Compiler()
+
+        for source in ["Unclosed {{ expression",
+                       "Unclosed {% execution",
+                       "Unopened }} expression",
+                       "Nested {{ {% if %} }}"]:
+            with self.assertRaises(Exception):
+                list(compiler._get_chunks(source))
+
+    def test_template_is_function(self):
+        compiler = Compiler()
+
+        function = compiler.compile(
+            "{{ len(items) }} items:"
+            "{% for item in items %} {{ item }}{% endfor %}")
+
+        self.assertEqual(function(items=["a", "b"], unused=1),
+                         "2 items: a b")
+
+        instructions = [instr.opname
+                        for instr in dis.get_instructions(function)]
+        self.assertNotIn("LOAD_NAME", instructions)
+        self.assertNotIn("STORE_NAME", instructions)
+
+    def test_optional_variables(self):
+        for backend in ["bytecode", "ast"]:
+            compiler = Compiler(backend=backend)
+
+            # A variable is only needed if the code that uses it runs.
+            function = compiler.compile("{% if x %}{{ y }}{% endif %}")
+            self.assertEqual(function(x=False), "")
+
+            with self.assertRaises(NameError):
+                function(x=True)
+
+    def test_underscore_variables_required(self):
+        for backend in ["bytecode", "ast"]:
+            function = Compiler(backend=backend).compile("{{ _x }}")
+
+            self.assertEqual(function(_x="a"), "a")
+
+            # The marker for a missing variable is never rendered.
+            with self.assertRaises(TypeError):
+                function()
+
+    def test_loop_variable_shadows_context(self):
+        for backend in ["bytecode", "ast"]:
+            function = Compiler(backend=backend).compile(
+                "Hi {{ user }}: "
+                "{% for user in users %}{{ user }} {% endfor %}")
+
+            self.assertEqual(function(user="me", users=["a", "b"]),
+                             "Hi me: a b ")
+
+    def test_backends_agree(self):
+        """The AST backend generates the same output as the bytecode
+        backend."""
+        template_locator = unittest.mock.MagicMock()
+        template_locator.find_template.return_value = '/wherever/foo.html'
+
+        cases = [
+            ("fish", {}),
+            ("Hello {{ whom }}", {"whom": "world"}),
+            ("{% if x < 10 %}small{% endif %}", {"x": 5}),
+            ("{% if x < 10 %}small{% endif %}", {"x": 20}),
+            ("{% for i in numbers %}{% if i % 2 %}{{ i }} "
+             "{% endif %}{% endfor %}", {"numbers": range(10)}),
+            ("{% for i in numbers %}{% endfor %}", {"numbers": [1]}),
+            ("{{ [n * 2 for n in numbers] }}", {"numbers": [1, 2]}),
+            ('{% extends "base.html" %}'
+             '{% block title %}{{ title }}{% endblock %}',
+             {"title": "The title"}),
+        ]
+
+        for (source, context) in cases:
+            outputs = []
+            for backend in ["bytecode", "ast"]:
+                mock_file = io.StringIO(
+                    "Title: {% block title %}{% endblock %}")
+                mock_open = unittest.mock.MagicMock(return_value=mock_file)
+
+                with unittest.mock.patch('builtins.open', mock_open):
+                    compiler = Compiler(template_locator, backend=backend)
+                    function = compiler.compile(source)
+
+                outputs.append(function(**context))
+
+            self.assertEqual(outputs[0], outputs[1])
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            Compiler(backend="llvm")
+
+    def test_output_strategies(self):
+        source = "Hé {{ whom }}{% for i in numbers %} {{ i }}{% endfor %}"
+
+        for strategy in ["list", "stringio"]:
+            function = Compiler(output_strategy=strategy).compile(source)
+            self.assertEqual(function(whom="wörld", numbers=range(3)),
+                             "Hé wörld 0 1 2")
+
+        function = Compiler(output_strategy="bytes").compile(source)
+        self.assertEqual(function(whom="wörld", numbers=range(3)),
+                         "Hé wörld 0 1 2".encode("utf-8"))
+
+        with self.assertRaises(ValueError):
+            Compiler(output_strategy="carrier pigeon")
+
+    def test_optimise_switch(self):
+        source = "a{% if True %}b{% endif %}{% if False %}c{% endif %}d"
+
+        for optimise in [True, False]:
+            function = Compiler(optimise=optimise).compile(source)
+            self.assertEqual(function(), "abd")
+
+    def test_compile_stream(self):
+        source = ("{% block head %}<h1>{{ title }}</h1>{% endblock %}"
+                  "{% for i in numbers %}<p>{{ i }}</p>{% endfor %}")
+
+        for backend in ["bytecode", "ast"]:
+            compiler = Compiler(backend=backend)
+
+            function = compiler.compile_stream(source, flush_size=16)
+            chunks = list(function(title="Numbers", numbers=range(5)))
+
+            self.assertEqual(chunks, ["<h1>Numbers</h1>",
+                                      "<p>0</p><p>1</p>",
+                                      "<p>2</p><p>3</p>",
+                                      "<p>4</p>"])
+
+            function = compiler.compile_stream(source, flush_size=None,
+                                               flush_at_blocks=False)
+            chunks = list(function(title="Numbers", numbers=range(2)))
+
+            self.assertEqual(chunks, ["<h1>Numbers</h1><p>0</p><p>1</p>"])
+
+    def test_compile_stream_bytes(self):
+        compiler = Compiler(output_strategy="bytes")
+
+        function = compiler.compile_stream(
+            "{% for i in numbers %}é{% endfor %}", flush_size=4)
+
+        self.assertEqual(list(function(numbers=range(3))),
+                         ["éé".encode("utf-8"), "é".encode("utf-8")])
+
+    def test_compile_async(self):
+        async def get_title():
+            return "Async"
+
+        async def get_numbers():
+            return [1, 2]
+
+        async def generate_letters():
+            for letter in "ab":
+                yield letter
+
+        function = Compiler(backend="bytecode").compile_async(
+            "<h1>{{ title }}</h1>"
+            "{% for i in numbers %}{{ i }}{% endfor %}"
+            "{% for c in letters %}{{ c }}{% endfor %}"
+            "{{ plain }}")
+
+        result = asyncio.get_event_loop().run_until_complete(
+            function(title=get_title(),
+                     numbers=get_numbers(),
+                     letters=generate_letters(),
+                     plain=3))
+
+        self.assertEqual(result, "<h1>Async</h1>12ab3")
+
+    def test_async_for_is_lazy(self):
+        generated = []
+
+        async def generate_numbers():
+            for number in range(3):
+                generated.append(number)
+                yield number
+
+        function = Compiler().compile_async(
+            "{% for i in numbers %}"
+            "{{ forloop.counter }}:{{ len(generated) }}"
+            "{% if not forloop.last %},{% endif %}"
+            "{% endfor %}")
+
+        result = asyncio.get_event_loop().run_until_complete(
+            function(numbers=generate_numbers(), generated=generated))
+
+        # Each item is rendered before the one after the next is read.
+        self.assertEqual(result, "1:2,2:3,3:3")
+
+    def test_dependencies(self):
+        self.write_template("base.html", "{% block a %}{% endblock %}")
+        self.write_template("section.html",
+                            '{% extends "base.html" %}'
+                            '{% block a %}Section{% endblock %}')
+
+        compiler = Compiler(DirectoryTemplateLocator([self.template_dir]))
+        source = '{% extends "section.html" %}'
+
+        function = compiler.compile(source)
+        self.assertEqual([name for (name, _) in function.dependencies],
+                         ["section.html", "base.html"])
+        self.assertEqual(function(), "Section")
+
+        # A change to the grandparent is picked up, even though the
+        # parent is unchanged.
+        self.write_template("base.html", "Base {% block a %}{% endblock %}")
+        self.assertEqual(compiler.compile(source)(), "Base Section")
+
+    def test_multi_level_inheritance(self):
+        templates = {
+            "site.html": "<title>{% block title %}Site{% endblock %}"
+                         "</title>{% block body %}{% endblock %}",
+            "section.html": '{% extends "site.html" %}'
+                            "{% block title %}Section - {{ block.super }}"
+                            "{% endblock %}",
+        }
+        for (name, contents) in templates.items():
+            self.write_template(name, contents)
+
+        source = ('{% extends "section.html" %}'
+                  "{% block title %}{{ name }} | {{ block.super }}"
+                  "{% endblock %}"
+                  "{% block body %}Body{% endblock %}")
+
+        template_locator = DirectoryTemplateLocator([self.template_dir])
+
+        for backend in ["bytecode", "ast"]:
+            for optimise in [True, False]:
+                compiler = Compiler(template_locator,
+                                    backend=backend,
+                                    optimise=optimise)
+                function = compiler.compile(source)
+
+                self.assertEqual(function(name="Page"),
+                                 "<title>Page | Section - Site</title>Body")
+
+    def test_loop_fast_path(self):
+        source = ("{% for row in rows %}"
+                  "<td>{{ row }}</td><td>{{ unit }}</td>"
+                  "{% if row %}{{ unit }}{% endif %}"
+                  "{% endfor %}")
+
+        for backend in ["bytecode", "ast"]:
+            for output_strategy in ["list", "stringio", "bytes"]:
+                compiler = Compiler(backend=backend,
+                                    output_strategy=output_strategy)
+                result = compiler.compile(source)(rows=range(2), unit="kg")
+                if isinstance(result, bytes):
+                    result = result.decode("utf-8")
+
+                self.assertEqual(result,
+                                 "<td>0</td><td>kg</td>"
+                                 "<td>1</td><td>kg</td>kg")
+
+    def test_nested_loop_invariant(self):
+        # The outer loop variable doesn't change during the inner loop,
+        # but it must be evaluated again for each outer iteration.
+        source = ("{% for x in outer %}"
+                  "{% for y in inner %}{{ x }}{{ y }}{% endfor %}"
+                  "{% endfor %}")
+
+        for backend in ["bytecode", "ast"]:
+            function = Compiler(backend=backend).compile(source)
+
+            self.assertEqual(function(outer=range(2), inner="ab"),
+                             "0a0b1a1b")
+
+    def test_loop_invariant_not_reached(self):
+        # A variable that a loop would use, but doesn't set, is only
+        # needed if the loop actually reaches the code that uses it.
+        sources = [
+            ("{% for i in xs %}{{ y }}{% endfor %}ok", []),
+            ("{% for i in xs %}{% if i %}{{ y }}{% endif %}{% endfor %}ok",
+             [0, 0]),
+        ]
+
+        for backend in ["bytecode", "ast"]:
+            for optimise in [True, False]:
+                compiler = Compiler(backend=backend, optimise=optimise)
+
+                for (source, xs) in sources:
+                    function = compiler.compile(source)
+
+                    self.assertEqual(function(xs=xs), "ok")
+                    self.assertEqual(function(xs=[1, 2], y="-"), "--ok")
+                    with self.assertRaises(NameError):
+                        function(xs=[1])
+
+    def test_forloop(self):
+        source = ("{% for x in items %}"
+                  "{{ forloop.counter }}:{{ x }}"
+                  "{% if forloop.first %}<{% endif %}"
+                  "{% if forloop.last %}>{% endif %}"
+                  "{{ forloop.revcounter0 }},"
+                  "{% empty %}Nothing"
+                  "{% endfor %}")
+
+        for backend in ["bytecode", "ast"]:
+            function = Compiler(backend=backend).compile(source)
+
+            self.assertEqual(function(items=(c for c in "abc")),
+                             "1:a<2,2:b1,3:c>0,")
+            self.assertEqual(function(items=[]), "Nothing")
+
+    def test_nested_forloop(self):
+        source = ("{% for x in outer %}"
+                  "{% for y in x %}{{ forloop.counter0 }}{% endfor %}"
+                  "{% if forloop.last %}!{% endif %}"
+                  "{% endfor %}")
+
+        for backend in ["bytecode", "ast"]:
+            function = Compiler(backend=backend).compile(source)
+
+            self.assertEqual(function(outer=["ab", "c"]), "010!")
+
+    def test_unknown_forloop_attribute(self):
+        compiler = Compiler()
+
+        with self.assertRaises(Exception):
+            compiler.compile("{% for x in items %}"
+                             "{{ forloop.parentloop }}"
+                             "{% endfor %}")
+
+    def test_forloop_in_string_literal(self):
+        source = ('{% for x in items %}'
+                  '{{ "forloop.counter" }} {{ "see forloop.parentloop" }} '
+                  '{{ x|default:"forloop.last" }} {{ forloop.counter }}'
+                  '{% cache "forloop.first", forloop.counter0 %}'
+                  '!{% endcache %}'
+                  '{% endfor %}')
+
+        for backend in ["bytecode", "ast"]:
+            for optimise in [True, False]:
+                compiler = Compiler(backend=backend, optimise=optimise)
+                function = compiler.compile(source)
+
+                self.assertEqual(function(items=[None]),
+                                 "forloop.counter see forloop.parentloop "
+                                 "forloop.last 1!")
+
+    def test_loop_errors_propagate(self):
+        source = "{% for x in items %}{{ 1 / x }}{% endfor %}"
+
+        for backend in ["bytecode", "ast"]:
+            function = Compiler(backend=backend).compile(source)
+
+            with self.assertRaises(ZeroDivisionError):
+                function(items=[1, 0])
+
+    def test_filters(self):
+        source = ("{{ title|lower|truncatechars:8 }}"
+                  "{% for tag in tags %}"
+                  " {{ forloop.counter|add:offset }}={{ tag|shout:2 }}"
+                  "{% endfor %}"
+                  " {{ (a|b) }}")
+
+        def shout(value, count):
+            return value.upper() + "!" * count
+
+        for backend in ["bytecode", "ast"]:
+            compiler = Compiler(backend=backend, filters={"shout": shout})
+            function = compiler.compile(source)
+
+            self.assertEqual(function(title="HELLO WORLD",
+                                      tags=["a", "b"],
+                                      offset=10,
+                                      a=1,
+                                      b=2),
+                             "hello w\u2026 11=A!! 12=B!! 3")
+
+    def test_unknown_filter(self):
+        with self.assertRaises(Exception):
+            Compiler().compile("{{ title|frobnicate }}")
+
+    def test_autoescape(self):
+        source = ("<p>{{ text }} {{ count }} {{ html|safe }}"
+                  " {{ '<br>'|upper }}</p>")
+        variables = {"text": "Tom & Jerry <3",
+                     "count": 3,
+                     "html": "<b>ok</b>"}
+
+        for backend in ["bytecode", "ast"]:
+            for output_strategy in ["list", "stringio", "bytes"]:
+                compiler = Compiler(backend=backend,
+                                    output_strategy=output_strategy)
+                result = compiler.compile(source)(**variables)
+                if isinstance(result, bytes):
+                    result = result.decode("utf-8")
+
+                self.assertEqual(result,
+                                 "<p>Tom &amp; Jerry &lt;3 3 <b>ok</b>"
+                                 " &lt;BR&gt;</p>")
+
+            compiler = Compiler(backend=backend, autoescape=False)
+            self.assertEqual(compiler.compile(source)(**variables),
+                             "<p>Tom & Jerry <3 3 <b>ok</b> <BR></p>")
+
+    def test_include(self):
+        self.write_template("include_row.html",
+                            "<td>{{ row }} {{ unit }}</td>"
+                            "{% if forloop.last %}.{% endif %}")
+        self.write_template("include_dynamic.html", "[{{ row }}]")
+
+        for backend in ["bytecode", "ast"]:
+            compiler = Compiler(DirectoryTemplateLocator([self.template_dir]),
+                                backend=backend)
+
+            function = compiler.compile(
+                '{% for row in rows %}'
+                '{% include "include_row.html" %}'
+                '{% endfor %}')
+            self.assertEqual(function(rows=[1, 2], unit="kg"),
+                             "<td>1 kg</td><td>2 kg</td>.")
+            self.assertEqual([name for (name, _) in function.dependencies],
+                             ["include_row.html"])
+
+            function = compiler.compile(
+                '{% for row in rows %}{% include name %}{% endfor %}')
+            self.assertEqual(function(rows=[1, 2],
+                                      name="include_dynamic.html"),
+                             "[1][2]")
+
+    def test_recursive_include(self):
+        for (name, other) in [("ping.html", "pong.html"),
+                              ("pong.html", "ping.html")]:
+            self.write_template(name, '{%% include "%s" %%}' % other)
+
+        compiler = Compiler(DirectoryTemplateLocator([self.template_dir]))
+
+        with self.assertRaisesRegex(Exception, "includes or extends itself"):
+            compiler.compile('{% include "ping.html" %}')
+
+    def check_macro(self, backend):
+        source = ('{% macro cell(value, css="plain") %}'
+                  '<td class="{{ css }}">{{ value }}{{ unit }}</td>'
+                  '{% endmacro %}'
+                  '{% for row in rows %}'
+                  '{% call cell(row) %}{% call cell(row * 2, css="double") %}'
+                  '{% endfor %}')
+
+        for output_strategy in ["list", "stringio", "bytes"]:
+            compiler = Compiler(backend=backend,
+                                output_strategy=output_strategy)
+            result = compiler.compile(source)(rows=[1, 2], unit="kg")
+            if isinstance(result, bytes):
+                result = result.decode("utf-8")
+
+            self.assertEqual(result,
+                             '<td class="plain">1kg</td>'
+                             '<td class="double">2kg</td>'
+                             '<td class="plain">2kg</td>'
+                             '<td class="double">4kg</td>')
+
+        # The names that the macro uses are looked up when it's
+        # called, so it can use a loop variable.
+        function = Compiler(backend=backend).compile(
+            '{% macro item() %}<li>{{ entry }}</li>{% endmacro %}'
+            '{% for entry in entries %}{% call item() %}{% endfor %}')
+        self.assertEqual(function(entries=["a", "b"]),
+                         "<li>a</li><li>b</li>")
+
+    def test_macro_bytecode(self):
+        self.check_macro("bytecode")
+
+    def test_macro_ast(self):
+        self.check_macro("ast")
+
+    def test_fragment_cache(self):
+        source = ('{% for row in rows %}'
+                  '{% cache "row", row ttl=60 %}'
+                  '<td>{{ forloop.counter }}: {{ render(row) }}</td>'
+                  '{% endcache %}'
+                  '{% endfor %}')
+
+        for backend in ["bytecode", "ast"]:
+            for output_strategy in ["list", "stringio", "bytes"]:
+                compiler = Compiler(backend=backend,
+                                    output_strategy=output_strategy)
+                template = compiler.compile(source)
+                rendered = []
+
+                def render(row):
+                    rendered.append(row)
+                    return row
+
+                for (rows, expected) in [
+                        ([1, 2], "<td>1: 1</td><td>2: 2</td>"),
+                        ([2, 3], "<td>2: 2</td><td>2: 3</td>")]:
+                    result = template(rows=rows, render=render)
+                    if isinstance(result, bytes):
+                        result = result.decode("utf-8")
+                    self.assertEqual(result, expected)
+
+                # Each row is only rendered the first time, and the
+                # cached output is written as it was.
+                self.assertEqual(rendered, [1, 2, 3])
+                self.assertEqual(len(compiler.fragment_cache), 3)
+
+    def test_fragment_cache_keys(self):
+        for backend in ["bytecode", "ast"]:
+            compiler = Compiler(backend=backend)
+            first = compiler.compile(
+                '{% cache "sidebar" %}First{% endcache %}'
+                '{% cache "sidebar" %}Second{% endcache %}')
+            second = compiler.compile(
+                '<p>{% cache "sidebar" %}Other{% endcache %}</p>')
+
+            # The same key in different blocks or templates names
+            # different fragments.
+            for _ in range(2):
+                self.assertEqual(first(), "FirstSecond")
+                self.assertEqual(second(), "<p>Other</p>")
+
+    def test_fragment_cache_macro_call(self):
+        source = ('{% macro m(x) %}<{{ x }}>{% endmacro %}'
+                  '{% cache "k" %}A{% call m(1) %}B{% endcache %}'
+                  '{% call m(2) %}')
+
+        for backend in ["bytecode", "ast"]:
+            for output_strategy in ["list", "stringio", "bytes"]:
+                compiler = Compiler(backend=backend,
+                                    output_strategy=output_strategy)
+                template = compiler.compile(source)
+
+                # The output of a macro called in the block is part of
+                # the cached fragment, on a miss and on a hit.
+                for _ in range(2):
+                    result = template()
+                    if isinstance(result, bytes):
+                        result = result.decode("utf-8")
+                    self.assertEqual(result, "A<1>B<2>")
+
+    def check_compile_block(self, backend):
+        template_locator = unittest.mock.MagicMock()
+        template_locator.find_template.return_value = '/wherever/base.html'
+
+        mock_open = unittest.mock.MagicMock(
+            side_effect=lambda path: io.StringIO(
+                "<title>{% block title %}Base{% endblock %}</title>"
+                "{% block content %}{% endblock %}"))
+
+        source = ('{% extends "base.html" %}'
+                  '{% block title %}Page - {{ block.super }}{% endblock %}')
+
+        with unittest.mock.patch('builtins.open', mock_open):
+            compiler = Compiler(template_locator, backend=backend)
+            title = compiler.compile_block(source, "title")
+
+        self.assertEqual(title(), "Page - Base")
+
+        # Macros defined before the block can be called from it.
+        content = compiler.compile_block(
+            '{% macro item(value) %}<li>{{ value }}</li>{% endmacro %}'
+            '<ul>{% block content %}'
+            '{% for row in rows %}{% call item(row) %}{% endfor %}'
+            '{% endblock %}</ul>',
+            "content")
+        self.assertEqual(content(rows=[1, 2]), "<li>1</li><li>2</li>")
+
+        with self.assertRaises(Exception):
+            compiler.compile_block("{% block a %}{% endblock %}", "b")
+
+    def test_compile_block_bytecode(self):
+        self.check_compile_block("bytecode")
+
+    def test_compile_block_ast(self):
+        self.check_compile_block("ast")
+
+    def test_render_many(self):
+        function = Compiler().compile("<p>{{ name|upper }}</p>")
+        contexts = [{"name": "name %d" % i} for i in range(100)]
+        expected = ["<p>NAME %d</p>" % i for i in range(100)]
+
+        self.assertEqual(list(render_many(function, contexts)), expected)
+        self.assertEqual(list(render_many(function,
+                                          iter(contexts),
+                                          processes=2,
+                                          chunk_size=7)),
+                         expected)
+
+        dynamic = Compiler().compile("{% include name %}")
+        with self.assertRaises(ValueError):
+            list(render_many(dynamic, contexts, processes=2))
+
+    def test_macro_called_before_definition(self):
+        with self.assertRaises(Exception):
+            Compiler().compile('{% call cell(1) %}'
+                               '{% macro cell(value) %}{% endmacro %}')
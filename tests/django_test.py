@@ -0,0 +1,185 @@
+import unittest
+import unittest.mock
+import os
+import asyncio
+
+import django
+from django.conf import settings
+from django.template import TemplateDoesNotExist
+
+if not settings.configured:
+    settings.configure()
+    django.setup()
+
+from margate.django import (MargateEngine, MargateLoader,  # noqa: E402
+                            DjangoFragmentCache)
+
+from tests.template_dir import TemplateDirTestCase  # noqa: E402
+
+
+class MargateEngineTest(TemplateDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.write_template("base.html",
+                            "<title>{% block title %}{% endblock %}</title>")
+        self.write_template("page.html",
+                            '{% extends "base.html" %}'
+                            "{% block title %}{{ title }}{% endblock %}")
+
+    def make_engine(self, **options):
+        with unittest.mock.patch.object(MargateLoader, "get_dirs",
+                                        return_value=[self.template_dir]):
+            return MargateEngine({"NAME": "margate",
+                                  "DIRS": [],
+                                  "APP_DIRS": True,
+                                  "OPTIONS": options})
+
+    def test_render(self):
+        engine = self.make_engine()
+        template = engine.get_template("page.html")
+
+        self.assertEqual(template.render({"title": "Hello"}),
+                         "<title>Hello</title>")
+        self.assertIs(engine.get_template("page.html"), template)
+
+    def test_parent_change(self):
+        engine = self.make_engine(template_check_method="hash",
+                                  template_check_interval=0)
+        engine.get_template("page.html")
+        engine.get_template("base.html")
+        self.write_template("other.html", "Other")
+        other = engine.get_template("other.html")
+
+        self.write_template("base.html",
+                            "<h1>{% block title %}{% endblock %}</h1>")
+
+        self.assertEqual(
+            engine.get_template("page.html").render({"title": "Hello"}),
+            "<h1>Hello</h1>")
+        self.assertIs(engine.get_template("other.html"), other)
+
+    def test_warm_up(self):
+        self.write_template("broken.html", "{% frobnicate %}")
+        engine = self.make_engine()
+
+        failed = engine.warm_up(processes=2)
+
+        self.assertEqual(failed, ["broken.html"])
+        self.assertEqual(len(engine.cache), 2)
+        self.assertEqual(
+            engine.get_template("page.html").render({"title": "Warm"}),
+            "<title>Warm</title>")
+        self.assertEqual(engine.cache.misses, 0)
+
+    def test_register_filter(self):
+        self.write_template("shout.html", "{{ title|shout }}")
+        engine = self.make_engine()
+
+        with self.assertRaises(Exception):
+            engine.get_template("shout.html")
+
+        engine.register_filter("shout", lambda value: value.upper() + "!")
+
+        self.assertEqual(
+            engine.get_template("shout.html").render({"title": "hello"}),
+            "HELLO!")
+
+    def test_autoescape(self):
+        from django.utils.safestring import mark_safe
+
+        self.write_template("escape.html", "{{ text }} {{ html }}")
+        engine = self.make_engine()
+
+        self.assertEqual(
+            engine.get_template("escape.html").render(
+                {"text": "<i>", "html": mark_safe("<b>")}),
+            "&lt;i&gt; <b>")
+
+    def test_dynamic_include(self):
+        self.write_template("partial.html", "<b>{{ title }}</b>")
+        self.write_template("outer.html", "{% include partial %}")
+        engine = self.make_engine(template_check_interval=0)
+        template = engine.get_template("outer.html")
+
+        self.assertEqual(template.render({"partial": "partial.html",
+                                          "title": "Hi"}),
+                         "<b>Hi</b>")
+
+        # The included template is compiled through the engine's
+        # cache, so changes to it are picked up.
+        self.write_template("partial.html", "<i>{{ title }}</i>")
+        os.utime(os.path.join(self.template_dir, "partial.html"),
+                 ns=(0, 0))
+        self.assertEqual(template.render({"partial": "partial.html",
+                                          "title": "Hi"}),
+                         "<i>Hi</i>")
+
+    def test_fragment_cache(self):
+        self.write_template("cached.html",
+                            '{% cache "greeting" %}{{ name }}{% endcache %}')
+        engine = self.make_engine(
+            fragment_cache="margate.django.DjangoFragmentCache")
+        self.assertIsInstance(engine.fragment_cache, DjangoFragmentCache)
+        engine.fragment_cache.clear()
+
+        template = engine.get_template("cached.html")
+        self.assertEqual(template.render({"name": "Ann"}), "Ann")
+        self.assertEqual(template.render({"name": "Bob"}), "Ann")
+
+    def test_render_block(self):
+        engine = self.make_engine()
+        template = engine.get_template("page.html")
+
+        self.assertEqual(template.render_block("title", {"title": "Hello"}),
+                         "Hello")
+
+        # The context can be left out.
+        template = engine.get_template("base.html")
+        self.assertEqual(template.render_block("title"), "")
+
+    def test_stream(self):
+        engine = self.make_engine()
+
+        template = engine.get_template("page.html")
+        self.assertEqual("".join(template.stream({"title": "Hello"})),
+                         "<title>Hello</title>")
+
+        template = engine.get_template("base.html")
+        self.assertEqual("".join(template.stream()), "<title></title>")
+
+    def test_render_async(self):
+        async def get_title():
+            return "Hello"
+
+        engine = self.make_engine()
+        loop = asyncio.get_event_loop()
+
+        template = engine.get_template("page.html")
+        self.assertEqual(
+            loop.run_until_complete(
+                template.render_async({"title": get_title()})),
+            "<title>Hello</title>")
+
+        template = engine.get_template("base.html")
+        self.assertEqual(loop.run_until_complete(template.render_async()),
+                         "<title></title>")
+
+    def test_render_many(self):
+        engine = self.make_engine()
+        template = engine.get_template("page.html")
+
+        self.assertEqual(list(template.render_many([{"title": "A"},
+                                                    {"title": "B"}])),
+                         ["<title>A</title>", "<title>B</title>"])
+
+    def test_template_does_not_exist(self):
+        engine = self.make_engine()
+
+        with self.assertRaises(TemplateDoesNotExist) as context:
+            engine.get_template("missing.html")
+
+        self.assertEqual(
+            [origin.name for (origin, _) in context.exception.tried],
+            [os.path.join(self.template_dir, "missing.html")])
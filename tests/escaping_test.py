@@ -0,0 +1,37 @@
+import unittest
+
+from margate.escaping import SafeString, mark_safe, escape
+
+
+class EscapeTest(unittest.TestCase):
+
+    def test_escape(self):
+        self.assertEqual(escape("<a href=\"x\">Tom & Jerry's</a>"),
+                         "&lt;a href=&quot;x&quot;&gt;"
+                         "Tom &amp; Jerry&#39;s&lt;/a&gt;")
+
+    def test_plain_string_unchanged(self):
+        value = "Nothing to escape"
+        self.assertIs(escape(value), value)
+
+    def test_numbers(self):
+        self.assertEqual(escape(42), "42")
+        self.assertEqual(escape(1.5), "1.5")
+        self.assertEqual(escape(True), "True")
+
+    def test_safe_strings(self):
+        value = mark_safe("<b>Bold</b>")
+
+        self.assertIsInstance(value, SafeString)
+        self.assertIs(escape(value), value)
+        self.assertIs(mark_safe(value), value)
+
+    def test_html_method(self):
+        class Markup:
+            def __html__(self):
+                return "<i>Markup</i>"
+
+        self.assertEqual(escape(Markup()), "<i>Markup</i>")
+
+    def test_other_values(self):
+        self.assertEqual(escape(["<"]), "[&#39;&lt;&#39;]")
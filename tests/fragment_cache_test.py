@@ -0,0 +1,47 @@
+import unittest
+
+from margate.fragment_cache import LocMemFragmentCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class LocMemFragmentCacheTest(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LocMemFragmentCache(max_size=2)
+        cache.set("a", "A")
+        cache.set("b", "B")
+        self.assertEqual(cache.get("a"), "A")
+
+        # "b" is the least recently used.
+        cache.set("c", "C")
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "A")
+        self.assertEqual(cache.get("c"), "C")
+
+    def test_ttl(self):
+        clock = FakeClock()
+        cache = LocMemFragmentCache(clock=clock)
+        cache.set("a", "A", 10)
+        cache.set("b", "B")
+
+        clock.now = 9
+        self.assertEqual(cache.get("a"), "A")
+
+        clock.now = 10
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), "B")
+        self.assertEqual(len(cache), 1)
+
+    def test_clear(self):
+        cache = LocMemFragmentCache()
+        cache.set("a", "A")
+        cache.clear()
+        self.assertIsNone(cache.get("a"))
@@ -0,0 +1,137 @@
+import unittest
+import ast
+
+from margate.optimiser import optimise
+from margate.parser import ForNode
+from margate.code_generation import (Literal, Sequence, IfBlock,
+                                     ForBlock, ExtendsBlock,
+                                     ReplaceableBlock, VariableExpansion,
+                                     BlockSuper)
+
+
+def make_sequence(*elements):
+    sequence = Sequence()
+    for element in elements:
+        sequence.add_element(element)
+    return sequence
+
+
+def make_if_block(condition, *elements):
+    block = IfBlock(ast.parse(condition, mode="eval"))
+    block.sequence = make_sequence(*elements)
+    return block
+
+
+def make_replaceable_block(name, *elements):
+    block = ReplaceableBlock(name)
+    block.sequence = make_sequence(*elements)
+    return block
+
+
+class OptimiserTest(unittest.TestCase):
+
+    def test_merge_literals(self):
+        sequence = optimise(make_sequence(Literal("Foo"),
+                                          Literal(""),
+                                          Literal("Bar")))
+
+        self.assertEqual(sequence.elements, [Literal("FooBar")])
+
+    def test_drop_empty_literals(self):
+        expansion = VariableExpansion("x")
+        sequence = optimise(make_sequence(Literal(""),
+                                          expansion,
+                                          Literal("")))
+
+        self.assertEqual(sequence.elements, [expansion])
+
+    def test_constant_conditions(self):
+        sequence = optimise(make_sequence(
+            Literal("a"),
+            make_if_block("True", Literal("b")),
+            make_if_block("False", Literal("c")),
+            make_if_block("0", Literal("d")),
+            Literal("e")))
+
+        self.assertEqual(sequence.elements, [Literal("abe")])
+
+    def test_variable_condition_is_kept(self):
+        sequence = optimise(make_sequence(
+            make_if_block("x", Literal("a"), Literal("b"))))
+
+        self.assertEqual(1, len(sequence.elements))
+        self.assertIsInstance(sequence.elements[0], IfBlock)
+        self.assertEqual(sequence.elements[0].sequence.elements,
+                         [Literal("ab")])
+
+    def test_loop_body(self):
+        loop = ForBlock(ForNode("x", "things"))
+        loop.sequence = make_sequence(Literal("a"), Literal("b"))
+
+        sequence = optimise(make_sequence(loop))
+
+        self.assertEqual(sequence.elements[0].sequence.elements,
+                         [Literal("ab")])
+        # The original tree is left alone
+        self.assertEqual(loop.sequence.elements,
+                         [Literal("a"), Literal("b")])
+
+    def test_extends(self):
+        extends = ExtendsBlock(make_sequence(
+            Literal("<title>"),
+            make_replaceable_block("title", Literal("Default")),
+            Literal("</title>"),
+            make_replaceable_block("body", Literal("Body"))))
+        extends.sequence = make_sequence(
+            make_replaceable_block("title", Literal("Mine")))
+
+        sequence = optimise(make_sequence(extends))
+
+        self.assertEqual(sequence.elements,
+                         [Literal("<title>Mine</title>Body")])
+
+    def test_multi_level_extends(self):
+        site = make_sequence(
+            Literal("<title>"),
+            make_replaceable_block("title", Literal("Site")),
+            Literal("</title>"),
+            make_replaceable_block(
+                "body",
+                make_replaceable_block("content")))
+
+        section = ExtendsBlock(site)
+        section.sequence = make_sequence(
+            make_replaceable_block("title", Literal("Section - "),
+                                   BlockSuper()))
+
+        page = ExtendsBlock(make_sequence(section))
+        page.sequence = make_sequence(
+            make_replaceable_block("title", Literal("Page | "),
+                                   BlockSuper()),
+            make_replaceable_block("content", Literal("Content")))
+
+        sequence = optimise(make_sequence(page))
+
+        self.assertEqual(sequence.elements,
+                         [Literal("<title>Page | Section - Site</title>"
+                                  "Content")])
+
+    def test_constant_filters(self):
+        sequence = optimise(make_sequence(
+            Literal("<h1>"),
+            VariableExpansion('"news"', [("upper", None),
+                                         ("truncatechars", "3")]),
+            Literal("</h1>"),
+            VariableExpansion("title", [("upper", None)])))
+
+        self.assertEqual(sequence.elements,
+                         [Literal("<h1>NE\u2026</h1>"),
+                          VariableExpansion("title", [("upper", None)])])
+
+    def test_custom_filters_not_applied(self):
+        expansion = VariableExpansion('"news"', [("upper", None)])
+
+        sequence = optimise(make_sequence(expansion),
+                            filters={"upper": str.lower})
+
+        self.assertEqual(sequence.elements, [expansion])
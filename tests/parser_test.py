@@ -3,11 +3,12 @@ import unittest.mock
 import ast
 import io
 
-from margate.parser import (Parser, parse_expression, IfNode, ForNode,
-                            ExtendsNode)
+from margate.parser import (Parser, ParsedTemplateCache, parse_expression,
+                            parse_filters, IfNode, ForNode, ExtendsNode,
+                            FilterNode, IncludeNode, CacheNode)
 from margate.code_generation import (Literal, Sequence, IfBlock,
                                      ForBlock, ExtendsBlock, ReplaceableBlock,
-                                     Execution)
+                                     VariableExpansion, Execution)
 
 
 class ParserTest(unittest.TestCase):
@@ -56,6 +57,23 @@ class ParserTest(unittest.TestCase):
         self.assertEqual(sequence.elements,
                          expected_sequence.elements)
 
+    def test_parse_for_empty(self):
+        parser = Parser()
+
+        sequence = parser.parse([Execution("for x in things"),
+                                 Literal("bar"),
+                                 Execution("empty"),
+                                 Literal("none"),
+                                 Execution("endfor"),
+                                 Literal("baz")])
+
+        block = ForBlock(ForNode('x', 'things'))
+        block.sequence.add_element(Literal("bar"))
+        block.empty_sequence.add_element(Literal("none"))
+
+        self.assertEqual(sequence.elements,
+                         [block, Literal("baz")])
+
     def test_parse_nested(self):
         parser = Parser()
 
@@ -97,3 +115,96 @@ class ParserTest(unittest.TestCase):
         self.assertIsInstance(node, ExtendsNode)
         self.assertEqual(node.template_name,
                          "other.html")
+
+        node = parse_expression(["macro", "cell(value,", 'css="x")'])
+        self.assertEqual(node.name, "cell")
+        self.assertEqual([argument.arg for argument in node.arguments.args],
+                         ["value", "css"])
+
+        with self.assertRaises(Exception):
+            parse_expression(["macro", "cell(*values)"])
+
+        node = parse_expression(["call", "cell(1)"])
+        self.assertEqual(node.call.func.id, "cell")
+
+        node = parse_expression(["include", '"row.html"'])
+        self.assertEqual(node, IncludeNode("row.html", None))
+
+        node = parse_expression(["include", "prefix", "+", '".html"'])
+        self.assertEqual(node, IncludeNode(None, 'prefix + ".html"'))
+
+        node = parse_expression(["cache", '"sidebar"', "+", "user",
+                                 "ttl=60"])
+        self.assertEqual(node, CacheNode('"sidebar" + user', "60"))
+
+        node = parse_expression(["cache", '"footer"'])
+        self.assertEqual(node, CacheNode('"footer"', None))
+
+        node = parse_expression(["cache", "(a,", "b)"])
+        self.assertEqual(node, CacheNode("(a, b)", None))
+
+        node = parse_expression(["cache", "key", "ttl", "=", "60", "*", "5"])
+        self.assertEqual(node, CacheNode("key", "60 * 5"))
+
+        node = parse_expression(["cache", "f(ttl=1)", "ttl=ttl"])
+        self.assertEqual(node, CacheNode("f(ttl=1)", "ttl"))
+
+        # The TTL must be given with "ttl=", after the key.
+        for arguments in [[], ["key", "60"], ["ttl=60"], ["key", "ttl="],
+                          ["key", "60", "*", "5"]]:
+            with self.assertRaises(Exception):
+                parse_expression(["cache"] + arguments)
+
+    def test_filter_parser(self):
+        self.assertEqual(parse_filters(" title "), (" title ", []))
+
+        self.assertEqual(
+            parse_filters(' title|lower|truncatechars:30|cut:"|" '),
+            (" title", [FilterNode("lower", None),
+                        FilterNode("truncatechars", "30"),
+                        FilterNode("cut", '"|"')]))
+
+        # A bar inside brackets is Python's bitwise or.
+        self.assertEqual(parse_filters("(a | b)|add:f(c | d)"),
+                         ("(a | b)", [FilterNode("add", "f(c | d)")]))
+
+        with self.assertRaises(Exception):
+            parse_filters("title|lower:")
+
+    def test_parse_filters(self):
+        parser = Parser()
+
+        sequence = parser.parse([VariableExpansion(" title|upper ")])
+
+        self.assertEqual(sequence.elements,
+                         [VariableExpansion(" title",
+                                            [FilterNode("upper", None)])])
+
+        with self.assertRaisesRegex(Exception, "block.super"):
+            parser.parse([VariableExpansion(" block.super|upper ")])
+
+    def test_parent_template_cache(self):
+        template_locator = unittest.mock.MagicMock()
+        template_locator.find_template.return_value = '/wherever/base.html'
+        cache = ParsedTemplateCache()
+
+        def parse_child(parent_source):
+            mock_open = unittest.mock.MagicMock(
+                return_value=io.StringIO(parent_source))
+            parser = Parser(template_locator, cache)
+            with unittest.mock.patch('builtins.open', mock_open):
+                sequence = parser.parse([Execution('extends "base.html"')])
+            return (sequence.elements[0].template, parser.dependencies)
+
+        (first, first_dependencies) = parse_child("Base")
+        (second, second_dependencies) = parse_child("Base")
+
+        self.assertIs(first, second)
+        self.assertEqual(first_dependencies, second_dependencies)
+        self.assertEqual(first.elements, [Literal("Base")])
+
+        # A change to the parent is parsed again.
+        (changed, changed_dependencies) = parse_child("Changed")
+
+        self.assertEqual(changed.elements, [Literal("Changed")])
+        self.assertNotEqual(first_dependencies, changed_dependencies)
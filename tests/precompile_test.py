@@ -0,0 +1,99 @@
+import unittest
+import unittest.mock
+import os
+import io
+import sys
+import subprocess
+
+from margate.__main__ import main
+from margate.compiler import Compiler
+from margate.bytecode_cache import BytecodeCache
+
+from tests.template_dir import TemplateDirTestCase
+
+
+class PrecompileTest(TemplateDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.output_dir = self.make_temp_dir()
+
+        self.write_template("base.html",
+                            "Title: {% block title %}{% endblock %}")
+        self.write_template(os.path.join("pages", "page.html"),
+                            '{% extends "base.html" %}'
+                            '{% block title %}{{ title }}{% endblock %}')
+
+    def run_main(self, *args):
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        with unittest.mock.patch('sys.stdout', stdout), \
+                unittest.mock.patch('sys.stderr', stderr):
+            status = main(["compile", "--output", self.output_dir]
+                          + list(args))
+        return (status, stdout.getvalue(), stderr.getvalue())
+
+    def test_compile_directory(self):
+        (status, stdout, stderr) = self.run_main(self.template_dir)
+
+        self.assertEqual(status, 0)
+        self.assertIn("base.html: ", stdout)
+        self.assertIn("pages/page.html: ", stdout)
+        self.assertEqual(stderr, "")
+        self.assertEqual(2, len(os.listdir(self.output_dir)))
+
+    def test_failure_exit_status(self):
+        self.write_template("broken.html", "{% frobnicate %}")
+
+        (status, stdout, stderr) = self.run_main(self.template_dir)
+
+        self.assertEqual(status, 1)
+        self.assertIn("FAILED broken.html", stderr)
+        self.assertIn("Compiled 2 templates, 1 failed", stdout)
+
+    def test_extension_filter(self):
+        self.write_template("notes.txt", "{% frobnicate %}")
+
+        (status, _, _) = self.run_main("--extension", ".html",
+                                       self.template_dir)
+
+        self.assertEqual(status, 0)
+
+    def test_no_autoescape(self):
+        (status, _, _) = self.run_main("--no-autoescape", self.template_dir)
+        self.assertEqual(status, 0)
+
+        # The templates are found by an engine that doesn't escape its
+        # output, and not by one that does.
+        cache = BytecodeCache(self.output_dir)
+        with open(os.path.join(self.template_dir, "base.html")) as f:
+            source = f.read()
+
+        for (autoescape, found) in [(False, True), (True, False)]:
+            compiler = Compiler(bytecode_cache=cache, autoescape=autoescape)
+            key = cache.get_key(source, compiler._get_configuration())
+            self.assertEqual(cache.load(key) is not None, found)
+
+    def test_load_without_parser(self):
+        """Loading a precompiled template must not import the parser
+        or the bytecode library."""
+        self.run_main(self.template_dir)
+
+        script = """
+import sys
+from margate.compiler import Compiler, DirectoryTemplateLocator
+from margate.bytecode_cache import BytecodeCache
+
+compiler = Compiler(DirectoryTemplateLocator([sys.argv[1]]),
+                    bytecode_cache=BytecodeCache(sys.argv[2]))
+with open(sys.argv[3]) as f:
+    print(compiler.compile(f.read())(title="Precompiled"))
+print("bytecode" in sys.modules, "funcparserlib" in sys.modules)
+"""
+        output = subprocess.check_output(
+            [sys.executable, "-c", script,
+             self.template_dir, self.output_dir,
+             os.path.join(self.template_dir, "pages", "page.html")],
+            universal_newlines=True)
+
+        self.assertEqual(output, "Title: Precompiled\nFalse False\n")
@@ -0,0 +1,134 @@
+import unittest
+import threading
+import time
+
+from margate.template_cache import TemplateCache, DependencyGraph
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TemplateCacheTest(unittest.TestCase):
+
+    def test_hits_and_misses(self):
+        cache = TemplateCache()
+        loaded = []
+
+        def load(key):
+            loaded.append(key)
+            return key.upper()
+
+        self.assertEqual(cache.get("a", load), "A")
+        self.assertEqual(cache.get("a", load), "A")
+        self.assertEqual(cache.get("b", load), "B")
+
+        self.assertEqual(loaded, ["a", "b"])
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_lru_eviction(self):
+        cache = TemplateCache(max_size=2)
+
+        cache.get("a", str.upper)
+        cache.get("b", str.upper)
+        cache.get("a", str.upper)
+        cache.get("c", str.upper)
+
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_check_interval(self):
+        clock = FakeClock()
+        versions = {"a": 1}
+        checks = []
+
+        def fingerprint(key):
+            checks.append(key)
+            return versions[key]
+
+        cache = TemplateCache(check_interval=5, fingerprint=fingerprint,
+                              clock=clock)
+        loads = []
+
+        def load(key):
+            loads.append(versions[key])
+            return versions[key]
+
+        self.assertEqual(cache.get("a", load), 1)
+        versions["a"] = 2
+
+        # The change isn't noticed until the interval has passed.
+        clock.now = 4
+        self.assertEqual(cache.get("a", load), 1)
+        self.assertEqual(len(checks), 1)
+
+        clock.now = 5
+        self.assertEqual(cache.get("a", load), 2)
+        self.assertEqual(loads, [1, 2])
+        self.assertEqual(cache.invalidations, 1)
+
+    def test_failed_load_is_not_cached(self):
+        cache = TemplateCache()
+
+        def fail(key):
+            raise KeyError(key)
+
+        with self.assertRaises(KeyError):
+            cache.get("a", fail)
+
+        self.assertEqual(cache.get("a", str.upper), "A")
+
+    def test_single_flight(self):
+        cache = TemplateCache()
+        loads = []
+
+        def load(key):
+            loads.append(key)
+            time.sleep(0.05)
+            return key.upper()
+
+        results = []
+
+        def worker():
+            results.append(cache.get("a", load))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(loads, ["a"])
+        self.assertEqual(results, ["A"] * 8)
+        self.assertEqual(cache.misses, 1)
+
+
+class DependencyGraphTest(unittest.TestCase):
+
+    def test_descendants(self):
+        graph = DependencyGraph()
+        graph.set_ancestors("page.html", ["section.html", "base.html"])
+        graph.set_ancestors("section.html", ["base.html"])
+        graph.set_ancestors("other.html", ["other_base.html"])
+
+        self.assertEqual(graph.get_descendants("base.html"),
+                         {"page.html", "section.html"})
+        self.assertEqual(graph.get_descendants("section.html"),
+                         {"page.html"})
+        self.assertEqual(graph.get_ancestors("other.html"),
+                         ("other_base.html",))
+
+    def test_replace_ancestors(self):
+        graph = DependencyGraph()
+        graph.set_ancestors("page.html", ["base.html"])
+        graph.set_ancestors("page.html", ["other_base.html"])
+
+        self.assertEqual(graph.get_descendants("base.html"), set())
+        self.assertEqual(graph.get_descendants("other_base.html"),
+                         {"page.html"})
@@ -0,0 +1,23 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+
+class TemplateDirTestCase(unittest.TestCase):
+    """A test case with a temporary directory of templates, which is
+    removed when the test finishes."""
+
+    def setUp(self):
+        self.template_dir = self.make_temp_dir()
+
+    def make_temp_dir(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return directory
+
+    def write_template(self, name, contents, directory=None):
+        path = os.path.join(directory or self.template_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(contents)
@@ -0,0 +1,67 @@
+import unittest
+import unittest.mock
+import os
+
+from margate.template_index import TemplateIndex
+
+from tests.template_dir import TemplateDirTestCase
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TemplateIndexTest(TemplateDirTestCase):
+
+    def setUp(self):
+        self.first_dir = self.make_temp_dir()
+        self.second_dir = self.make_temp_dir()
+
+        self.write_template("page.html", "page.html", self.first_dir)
+        self.write_template("page.html", "page.html", self.second_dir)
+        self.write_template(os.path.join("sub", "a.html"), "a.html",
+                            self.second_dir)
+
+    def test_find_template(self):
+        index = TemplateIndex([self.first_dir, self.second_dir])
+
+        self.assertEqual(index.find_template("page.html"),
+                         os.path.join(self.first_dir, "page.html"))
+        self.assertEqual(index.find_template("sub/a.html"),
+                         os.path.join(self.second_dir, "sub", "a.html"))
+        self.assertIsNone(index.find_template("missing.html"))
+        self.assertIsNone(index.find_template("../page.html"))
+
+    def test_no_probing(self):
+        index = TemplateIndex([self.first_dir, self.second_dir])
+        index.find_template("page.html")
+
+        with unittest.mock.patch("os.path.isfile",
+                                 return_value=False) as isfile:
+            index.find_template("page.html")
+            index.find_template("missing.html")
+            index.find_template("missing.html")
+
+        # The miss is only searched for once.
+        self.assertEqual(isfile.call_count, 2)
+
+    def test_rescan_on_change(self):
+        clock = FakeClock()
+        index = TemplateIndex([self.first_dir, self.second_dir],
+                              check_interval=5,
+                              clock=clock)
+        self.assertIsNone(index.find_template("sub/new.html"))
+
+        self.write_template(os.path.join("sub", "new.html"), "new.html",
+                            self.second_dir)
+
+        clock.now = 4
+        self.assertIsNone(index.find_template("sub/new.html"))
+
+        clock.now = 5
+        self.assertEqual(index.find_template("sub/new.html"),
+                         os.path.join(self.second_dir, "sub", "new.html"))